@@ -1,18 +1,23 @@
-from securicad import enterprise
-from securicad.model import Model
-from attack_graph import AttackGraph, merge_attack_graphs
-from json_helpers import read_json_file, write_json_file
+from client_recording import RecordingClient, ReplayClient
+from instrumentation import PhaseTimer
+from json_helpers import read_json_file, write_json_file_atomic
+from results_journal import ResultsJournal
+from simulation_cache import DEFAULT_CACHE_SIZE, SimulationCache
+from simulation_runner import DEFAULT_SAMPLES, SimulationRunner, \
+    estimate_ttc_errors, relative_ttc_error, simulation_ttcs
 import configparser
 import argparse
 import logging
 import json
 import zipfile
 import base64
+import io
+import math
 import os
-import xml.etree.ElementTree as ET
-import numpy as np
 import sys
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 TEMP_INF = 1.7976931348623157e+308
 
@@ -45,72 +50,373 @@ def calculate_efficiency(previous_ttcs, current_ttcs):
     steps that are not initially compromised. So, previous_ttcs 0 values will
     be changed to 0.001
     '''
-    result = 0
+    return calculate_efficiencies(previous_ttcs, [current_ttcs])[0]
+
+def calculate_efficiencies(previous_ttcs, candidate_ttcs):
+    '''
+    Score every dictionary of current ttcs in candidate_ttcs against the
+    same previous_ttcs, see calculate_efficiency, in a single pass over a
+    matrix holding the ttc5 and ttc50 values of all the candidates.
+    The contributions of the attack steps are added up in the order of
+    previous_ttcs, so the results are identical to scoring the candidates
+    one at a time.
+    '''
+    if not candidate_ttcs:
+        return []
+    import numpy as np
+    steps = list(previous_ttcs)
+    previous = np.array([previous_ttcs[x][:2] for x in steps],
+        dtype = float).reshape(len(steps), 2)
+    current = np.array([[current_ttcs[x][:2] for x in steps]
+        for current_ttcs in candidate_ttcs],
+        dtype = float).reshape(len(candidate_ttcs), len(steps), 2)
+
+    # attack steps with an infinite previous ttc5 do not contribute, and
+    # neither does the ttc50 of the ones with an infinite previous ttc50
+    finite5 = previous[:, 0] != TEMP_INF
+    finite50 = previous[:, 1] != TEMP_INF
+    if not finite5.any():
+        return [0] * len(candidate_ttcs)
+
     c = 150
+    previous = np.maximum(previous, 0.001)
+    current = np.maximum(current, 0.001)
+    terms = np.power(1.05, -previous) * np.minimum(current - previous, c)
+    contributions = np.where(finite5,
+        terms[..., 0] + np.where(finite50, terms[..., 1], 0), 0)
+    # a cumulative sum adds the contributions up sequentially, unlike sum
+    running = np.cumsum(contributions, axis = 1)
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for current_ttcs, results in zip(candidate_ttcs, running):
+            for x, result in zip(steps, results):
+                logging.debug(f"Calculating efficiency\nPrevious ttcs: "+
+                    f"ttc5: {previous_ttcs[x][0]} " +
+                    f"ttc50: {previous_ttcs[x][1]}\n" +
+                    f"Current ttcs: ttc5: {current_ttcs[x][0]} " +
+                    f"ttc50: {current_ttcs[x][1]}\n" +
+                    f"Resulting efficiency: {round(result, 3)}")
+
+    return [round(result, 3) for result in running[:, -1]]
+
+def estimate_efficiency_error(previous_ttcs, previous_samples, current_ttcs,
+    current_samples):
+    '''
+    Rough standard error of calculate_efficiency, from the standard errors
+    of the ttcs estimated by estimate_ttc_errors for the number of samples
+    of both simulations, treating the weights of the attack steps as exact.
+    Differences beyond the cap of the efficiency metric do not contribute.
+    If previous_samples is None, the previous ttcs are taken to be exact.
+    '''
+    previous_errors = estimate_ttc_errors(previous_ttcs, previous_samples) \
+        if previous_samples else {}
+    current_errors = estimate_ttc_errors(current_ttcs, current_samples)
+    variance = 0
     for x in previous_ttcs:
-        previous_ttcs5 = max(previous_ttcs[x][0], 0.001)
-        previous_ttcs50 = max(previous_ttcs[x][1], 0.001)
-        current_ttcs5 = max(current_ttcs[x][0], 0.001)
-        current_ttcs50 = max(current_ttcs[x][1], 0.001)
-        if previous_ttcs[x][0] != TEMP_INF:
-            if previous_ttcs[x][1] == TEMP_INF:
-                # ttc5_i is finite, ttc50_i is not
-                result += np.power(1.05, -previous_ttcs5) * min(current_ttcs5 - previous_ttcs5, c)
+        if previous_ttcs[x][0] == TEMP_INF:
+            continue
+        for i in range(2):
+            if previous_ttcs[x][i] == TEMP_INF:
+                continue
+            previous = max(previous_ttcs[x][i], 0.001)
+            current = max(current_ttcs[x][i], 0.001)
+            if current - previous >= 150:
+                continue
+            variance += 1.05 ** (-2 * previous) * \
+                (previous_errors.get(x, [0, 0])[i] ** 2 +
+                current_errors.get(x, [0, 0])[i] ** 2)
+    return math.sqrt(variance)
+
+def get_ttcs(simres):
+    '''
+    Return a dictionary mapping the attack step id of every risk in the
+    simulation results to its rounded [ttc5, ttc50, ttc95] values.
+    '''
+    ttcs = {}
+    for risks_i in simres["results"]["risks"]:
+        ttcs[risks_i["attackstep_id"]] = [round(float(risks_i["ttc5"]), 3),
+            round(float(risks_i["ttc50"]), 3),
+            round(float(risks_i["ttc95"]), 3)]
+    return ttcs
+
+def defense_tuning(object_name, defense, ref):
+    return {
+        "type": "probability",
+        "op": "apply",
+        "filter": {"object_name": object_name, "defense": defense,
+                   "tags": {"ref": ref}},
+        "probability": 1.0
+    }
+
+def run_lookahead(runner, name, iteration, model, tunings, graph,
+    candidates, previous_ttcs, samples = DEFAULT_SAMPLES, max_samples = None,
+    impact_model = None):
+    '''
+    Simulate every candidate defense, each on top of the current tunings,
+    in parallel and pick the one with the highest efficiency per unit of
+    cost. Ties are broken in favour of the better ranked candidate.
+
+    With max_samples, the candidates are screened with samples samples and
+    as long as several of them score within the estimated noise of the
+    best one, those are simulated again with twice the samples, up to
+    max_samples. The winner is simulated again as well if its ttcs are
+    noisier than the noise threshold of the runner. The noise of the
+    previous ttcs is left out of the estimate, since it is the same for
+    every candidate and does not tell them apart.
+
+    If an ImpactModel is given, it is fitted to the efficiencies of all of
+    the candidates, which need to have their features added.
+
+    Returns the winning candidate together with its simulation and
+    simulation results, or (None, None, None) if all of the candidate
+    simulations failed.
+    '''
+    candidate_tunings = []
+    for candidate in candidates:
+        node = graph.nodes[candidate["node"]]
+        candidate_tunings.append(tunings + [defense_tuning(node["name"],
+            node["attackstep"], candidate["asset_tags"]["ref"])])
+
+    def simulate(k, samples, max_samples = None):
+        return runner.submit(name + " c=" + str(k), iteration, model,
+            candidate_tunings[k], samples, max_samples)
+
+    outcomes = {}
+    scores = {}
+    pool = list(range(len(candidates)))
+    best = None
+    while pool:
+        futures = [(k, simulate(k, samples)) for k in pool]
+        for k, future in futures:
+            simulation, simres = future.result()
+            if simres:
+                outcomes[k] = (simulation, simres)
             else:
-                # ttc5_i is finite, ttc50_i is also finite
-                result += np.power(1.05, -previous_ttcs5) * \
-                    min(current_ttcs5 - previous_ttcs5, c) + np.power(1.05, -previous_ttcs50) * \
-                    min(current_ttcs50 - previous_ttcs50, c)
-        logging.debug(f"Calculating efficiency\nPrevious ttcs: "+
-            f"ttc5: {previous_ttcs[x][0]} ttc50: {previous_ttcs[x][1]}\n" +
-            f"Current ttcs: ttc5: {current_ttcs[x][0]} " +
-            f"ttc50: {current_ttcs[x][1]}\n" +
-            f"Resulting efficiency: {round(result, 3)}")
-    return round(result, 3)
-
-def create_simulation(client, scenario, name, iteration, model, tunings = []):
-
-        # create new simulation
-        retries = 0
-        samples = 100
-        simulation = None
-
-        while retries < MAX_SIMULATION_CREATION_RETRIES:
-            try:
-                model.model["samples"] = samples
-                logging.info(f'For iteration {iteration} create new ' +
-                    'simulation with the following tunings:\n' +
-                    json.dumps(tunings, indent = 2))
-                simulation = client.simulations.create_simulation(scenario,
-                    name = name + " s=" + str(samples), model = model, raw_tunings = tunings)
-                simres = simulation.get_results()
-
-                if simres:
-                    logging.info(f'Simulation {name} ran successfully')
-                    logging.debug(f'Simulation results for {name}:\n' +
-                        json.dumps(simres, indent = 2))
-                    return simulation, simres
-
-            except Exception as e:
-                retries += 1
-                if retries < MAX_SIMULATION_CREATION_RETRIES:
-                    samples = samples + 100 * retries
-                    logging.warning(f"Simulation failed with:\n{e}\n" +
-                        "Retrying failed simulation with more samples.\n" +
-                        f"Retries:{retries}. Retrying with {samples} " +
-                        "samples.")
-
-        logging.error("Simulation failed")
-        print("Simulation failed")
-        return None, None
+                outcomes.pop(k, None)
+                logging.warning('Lookahead simulation for defense ' +
+                    f'{graph.nodes[candidates[k]["node"]]["id"]} failed, ' +
+                    'the candidate is discarded.')
+        pool = [k for k in pool if k in outcomes]
+        efficiencies = calculate_efficiencies(previous_ttcs,
+            [get_ttcs(outcomes[k][1]) for k in pool])
+
+        best = None
+        for k, eff in zip(pool, efficiencies):
+            error = estimate_efficiency_error(previous_ttcs, None,
+                get_ttcs(outcomes[k][1]), outcomes[k][1]["samples"]) \
+                if max_samples else 0
+            # the score and its estimated error per unit of cost
+            cost = max(candidates[k]["cost"], 1)
+            scores[k] = (eff, error, eff / cost, error / cost)
+            if best is None or scores[k][2] > scores[best][2]:
+                best = k
+        if best is None or not max_samples or samples >= max_samples:
+            break
+
+        contenders = [k for k in pool if scores[k][2] + scores[k][3] >=
+            scores[best][2] - scores[best][3]]
+        if len(contenders) <= 1:
+            break
+        samples = min(2 * samples, max_samples)
+        logging.info(f'Lookahead candidates ' +
+            ", ".join(graph.nodes[candidates[k]["node"]]["id"]
+            for k in contenders) + f' for iteration {iteration} score ' +
+            'within the estimated noise of each other, simulating them ' +
+            f'again with {samples} samples.')
+        pool = contenders
+
+    if best is None:
+        return None, None, None
+
+    simulation, simres = outcomes[best]
+    if max_samples and simres["samples"] < max_samples and \
+        relative_ttc_error(simulation_ttcs(simres), simres["samples"]) > \
+        runner.noise_threshold:
+        logging.info('The ttcs of the winning lookahead candidate for ' +
+            f'iteration {iteration} are noisy, simulating it again.')
+        simulation, simres = simulate(best, min(2 * simres["samples"],
+            max_samples), max_samples).result()
+        if simres:
+            outcomes[best] = (simulation, simres)
+
+    winner = graph.nodes[candidates[best]["node"]]["id"]
+    for k in sorted(outcomes):
+        if impact_model is not None:
+            impact_model.observe(iteration, candidates[k], scores[k][0])
+        node_id = graph.nodes[candidates[k]["node"]]["id"]
+        eff, error = scores[k][:2]
+        noise = f' (estimated error {round(error, 3)} with ' + \
+            f'{outcomes[k][1]["samples"]} samples)' if max_samples else ''
+        logging.info(f'Lookahead candidate {node_id} for iteration ' +
+            f'{iteration} has an efficiency of {eff}{noise}' +
+            f' with a cost of {candidates[k]["cost"]} ' +
+            f'({outcomes[k][1]["report_url"]})' +
+            (', selected.' if node_id == winner else ', discarded.'))
+    return (candidates[best],) + outcomes[best]
+
+def fetch_attack_graphs(simulation, risks, lang_meta, workers = 1,
+    paths_per_request = 1, defense_index = None, timer = None,
+    graph_class = None):
+    '''
+    Fetch the critical paths of all the risks that have a finite ttc5 and
+    convert them into attack graphs.
+
+    The critical paths are requested by a pool of worker threads, grouping
+    up to paths_per_request attack step ids into a single
+    get_critical_paths call. Attack graphs are built as soon as a request
+    returns, while the remaining requests are still in flight. The returned
+    list of attack graphs preserves the order of the risks so that the
+    result is identical to fetching the paths one at a time.
+
+    The attack graphs are instances of graph_class, AttackGraph (the
+    default) or CompactAttackGraph. Critical paths the simulation can open
+    as files, the ones in the simulation cache, are read into the attack
+    graphs incrementally if graph_class supports it, and fetched critical
+    paths are dropped as soon as their attack graph is built. If a
+    PhaseTimer is given, the time spent building attack graphs is recorded
+    as graph_build and the rest of the time as path_fetch.
+    '''
+    if graph_class is None:
+        from attack_graph import AttackGraph as graph_class
+    stage_start = time.perf_counter()
+    total_build_time = 0
+    targets = [risks_i["attackstep_id"] for risks_i in risks
+        if round(float(risks_i["ttc5"]), 3) != TEMP_INF]
+    batches = [list(range(i, min(i + paths_per_request, len(targets))))
+        for i in range(0, len(targets), paths_per_request)]
+
+    open_critical_paths = getattr(simulation, "open_critical_paths", None) \
+        if hasattr(graph_class, "from_stream") else None
+
+    def close_streams(streams):
+        for stream in streams.values():
+            stream.close()
+
+    def fetch(batch):
+        start = time.perf_counter()
+        batch_targets = [targets[position] for position in batch]
+        streams = open_critical_paths(batch_targets) \
+            if open_critical_paths else {}
+        missing = [target for target in batch_targets
+            if target not in streams]
+        try:
+            crit_paths = simulation.get_critical_paths(missing) \
+                if missing else {}
+        except BaseException:
+            close_streams(streams)
+            raise
+        return batch, crit_paths, streams, time.perf_counter() - start
+
+    attack_graphs = [None] * len(targets)
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = [executor.submit(fetch, batch) for batch in batches]
+        try:
+            for future in as_completed(futures):
+                batch, crit_paths, streams, fetch_time = future.result()
+                for position in batch:
+                    target = targets[position]
+                    start = time.perf_counter()
+                    if target in streams:
+                        with streams.pop(target) as stream:
+                            attack_graphs[position] = \
+                                graph_class.from_stream(stream, None,
+                                lang_meta, defense_index)
+                    else:
+                        if logging.getLogger().isEnabledFor(logging.DEBUG):
+                            logging.debug(f"Critical path of {target} " +
+                                "fetched:\n" +
+                                json.dumps(crit_paths[target], indent = 2))
+                        attack_graphs[position] = graph_class(crit_paths,
+                            target, lang_meta, defense_index)
+                        del crit_paths[target]
+                    build_time = time.perf_counter() - start
+                    total_build_time += build_time
+                    logging.info("Critical path for " +
+                        f"{targets[position]} fetched in " +
+                        f"{fetch_time:.3f}s (shared by {len(batch)} " +
+                        "attack steps) and converted to an attack graph " +
+                        f"in {build_time:.3f}s.")
+        finally:
+            # when a request or a conversion fails, the requests that did
+            # not start are cancelled and the files of the critical paths
+            # that were opened but not read are closed
+            for future in futures:
+                if not future.cancel() and future.exception() is None:
+                    close_streams(future.result()[2])
+
+    if timer is not None:
+        timer.add("graph_build", total_build_time)
+        timer.add("path_fetch",
+            time.perf_counter() - stage_start - total_build_time)
+    return attack_graphs
+
+def update_attack_graphs(risk_graphs, simulation, risks, ttcs, lang_meta,
+    applied = [], refetch = False, workers = 1, paths_per_request = 1,
+    defense_index = None, timer = None):
+    '''
+    Return the attack graphs of the risks that have a finite ttc5, keyed
+    by attack step id in the order of the risks, fetching only the
+    critical paths of the risks whose ttcs changed since their attack
+    graphs in risk_graphs were fetched, or whose attack graphs contain one
+    of the applied defense nodes, since applied defenses drop out of the
+    critical paths. risk_graphs maps the attack step id of a risk to its
+    ttcs and attack graph and is kept up to date.
+
+    With refetch, the critical paths of all the risks are fetched anyway,
+    but only used for the risks whose ttcs changed. The fetched attack
+    graphs of all the risks are returned as well, otherwise only those of
+    the changed risks.
+    '''
+    targets = [risks_i["attackstep_id"] for risks_i in risks
+        if round(float(risks_i["ttc5"]), 3) != TEMP_INF]
+    changed = [target for target in targets
+        if target not in risk_graphs or risk_graphs[target][0] != ttcs[target]
+        or any(node in risk_graphs[target][1] for node in applied)]
+    fetched_targets = set(targets if refetch else changed)
+    fetched = dict(zip([target for target in targets
+        if target in fetched_targets], fetch_attack_graphs(simulation,
+        [risks_i for risks_i in risks
+        if risks_i["attackstep_id"] in fetched_targets], lang_meta,
+        workers = workers, paths_per_request = paths_per_request,
+        defense_index = defense_index, timer = timer)))
+    logging.info(f"Reusing the attack graphs of {len(targets) - len(changed)}" +
+        f" of {len(targets)} risks that did not change.")
+
+    for target in list(risk_graphs):
+        if target not in targets:
+            del risk_graphs[target]
+    for target in changed:
+        risk_graphs[target] = (ttcs[target], fetched[target])
+    return {target: risk_graphs[target][1] for target in targets}, fetched
+
+def check_merged_graph(graph, attack_paths, metric, iteration):
+    '''
+    Compare the incrementally merged and ranked attack graph with the one
+    merged from scratch out of attack_paths, logging the differences.
+    Returns True if they match.
+    '''
+    from attack_graph import attack_graph_differences, merge_attack_graphs
+
+    expected = merge_attack_graphs(attack_paths)
+    expected.find_critical_attack_step(metric)
+    differences = attack_graph_differences(graph, expected)
+    if differences:
+        logging.error("The incrementally merged attack graph of iteration " +
+            f"{iteration} differs from a full rebuild: " +
+            "; ".join(differences))
+        return False
+    logging.info("The incrementally merged attack graph of iteration " +
+        f"{iteration} matches a full rebuild.")
+    return True
 
 def update_costs_from_file(costsfile, lang_meta):
     survey_costs = None
     with open(costsfile, 'r') as f:
         survey_costs = json.load(f)
 
-    logging.debug(f"Costs updates found in {costsfile}:\n" +
-        json.dumps(survey_costs, indent = 2))
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"Costs updates found in {costsfile}:\n" +
+            json.dumps(survey_costs, indent = 2))
 
     for asset in lang_meta["assets"]:
         for defense in lang_meta["assets"][asset]["defenses"]:
@@ -118,92 +424,95 @@ def update_costs_from_file(costsfile, lang_meta):
                 defense["name"] in survey_costs[asset]:
                 defense["metaInfo"]["cost"] = survey_costs[asset][defense["name"]]
 
-def load_model_dictionary(model_scad_dump, model_name):
-    # save the model locally
-    datapath = 'data-models'
-    if not os.path.exists(datapath):
-        os.makedirs(datapath)
-    model_path = "data-models/temp.sCAD"
-    f1 = open(model_path, "wb")
-    f1.write(model_scad_dump)
-    f1.close()
-
-    # unzip the model
-    model_dir_path = model_path[:model_path.rindex('/')]
-    model_file_name = model_path[model_path.rindex('/') + 1:model_path.rindex('.')]
-    unzip_dir = "scad_dir"
-    unzip_dir_path = "{}/{}".format(model_dir_path, unzip_dir)
-    with zipfile.ZipFile(model_path, 'r') as zip_ref:
-        zip_ref.extractall(unzip_dir_path)
-    eom_path = "{}/{}.eom".format(unzip_dir_path, model_name)
-
-    # delete the saved model file
-    os.remove(model_path)
-
-    # xml parsing
-    with open(eom_path, 'rt') as f:
-        tree = ET.parse(f)
-        root = tree.getroot()
-
-    model_dict_list = []
-
-    for object in root.iter("objects"):
-        model_dict = {}
-        model_dict["name"] = object.attrib['name']
-        model_dict["metaConcept"] = object.attrib['metaConcept']
-        model_dict["exportedId"] = object.attrib['exportedId']
-        model_dict["attributesJsonString"] = json.loads(object.attrib['attributesJsonString'])
-        model_dict_list.append(model_dict)
-
-    return model_dict_list
-
-
-def run_coa():
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-l', '--logfile', default='log.txt',
-        help='filename to use for the log (default: %(default)s)')
-    parser.add_argument('-c', '--configfile', default='coa.ini',
-        help='filename to use for the configuration (default: %(default)s)')
-    parser.add_argument('-o', '--costsfile',
-        help='filename to use for the costs')
-    parser.add_argument('-r', '--resultsfile', default='results.json',
-        help='filename to use for the results (default: %(default)s)')
-    parser.add_argument('-m', '--metric', default='frequency',
-        help='metric used to find the most critical attack step (default: %(default)s)')
-    parser.add_argument('-i', '--max_iterations', type=int, default=100,
-        help='number of maximum simulation iterations the analyser will ' +
-            'run (default: %(default)s)')
-    parser.add_argument('-b', '--initial_budget', type=int, default=1000,
-        help='initial budget (default: %(default)s)')
-    parser.add_argument('-n', '--simulation_name_prefix', default="",
-        help='simulation name prefix (default: %(default)s)')
-
-    args = vars(parser.parse_args())
-    logfile = args['logfile']
-    configfile = args['configfile']
-    costsfile = args['costsfile']
-    resultsfile = args['resultsfile']
-    metric = args['metric']
-    max_iterations = args['max_iterations']
-    initial_budget = args['initial_budget']
-    simulation_name_prefix = args['simulation_name_prefix']
-
-    logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-                    datefmt='%m-%d %H:%M',
-                    filename=logfile,
-                    filemode='w')
-
-    if os.path.isfile(resultsfile):
-        os.remove(resultsfile)
-    config = configparser.ConfigParser()
-    config.read(configfile)
+def get_use_counters(lang_meta):
+    use_counters = {}
+    for asset in lang_meta["assets"]:
+        for defense in lang_meta["assets"][asset]["defenses"]:
+            if "use_counter" in defense["metaInfo"]:
+                use_counters.setdefault(asset, {})[defense["name"]] = \
+                    defense["metaInfo"]["use_counter"]
+    return use_counters
 
-    budget_remaining = initial_budget
-    logging.info(f"Starting budget: {budget_remaining}")
+def set_use_counters(lang_meta, use_counters):
+    for asset in lang_meta["assets"]:
+        for defense in lang_meta["assets"][asset]["defenses"]:
+            if asset in use_counters and \
+                defense["name"] in use_counters[asset]:
+                defense["metaInfo"]["use_counter"] = \
+                    use_counters[asset][defense["name"]]
+
+def write_checkpoint(checkpointfile, iteration, simulation_name, simres,
+    raw_tunings, budget_remaining, previous_ttcs, lang_meta, journal,
+    samples, previous_samples, observed = None):
+    '''
+    Save everything a resumed run needs to continue with the given
+    iteration without running any of the previous simulations again.
+    samples is the number of samples the next simulations start with and
+    previous_samples the number of samples of the previous simulation.
+    observed is the candidate applied in the previous iteration whose
+    efficiency the impact model has yet to observe, of which only what
+    ImpactModel.observe needs is kept.
+    '''
+    if observed is not None:
+        observed = {"rank": observed["rank"], "cost": observed["cost"],
+            "features": observed["features"]}
+    write_json_file_atomic(checkpointfile, {
+        "iteration": iteration,
+        "simulation_name": simulation_name,
+        "simid": simres["simid"],
+        "simulation_samples": simres.get("samples", samples),
+        "raw_tunings": raw_tunings,
+        "budget_remaining": budget_remaining,
+        "previous_ttcs": previous_ttcs,
+        "samples": samples,
+        "previous_samples": previous_samples,
+        "observed": observed,
+        "use_counters": get_use_counters(lang_meta),
+        "journal_offset": journal.tell()
+    })
 
-    # Create an authenticated enterprise client
+def load_model_dictionary(model_scad_dump, model_name):
+    '''
+    Extract the objects of the model from the sCAD archive in memory and
+    return a ModelIndex mapping their exportedId to their model dictionary
+    entry. The .eom member is parsed incrementally and every element is
+    dropped once it has been read, so neither the archive nor the full XML
+    tree is ever written to disk or held in memory.
+    '''
+    from attack_graph import ModelIndex
+    import xml.etree.ElementTree as ET
+
+    model_index = ModelIndex()
+    with zipfile.ZipFile(io.BytesIO(model_scad_dump), 'r') as zip_ref:
+        with zip_ref.open(f"{model_name}.eom") as eom:
+            parents = []
+            for event, element in ET.iterparse(eom,
+                events = ("start", "end")):
+                if event == "start":
+                    # the attributes are complete at the start event, which
+                    # keeps the objects in document order
+                    if element.tag == "objects":
+                        model_index.add(element.attrib['name'],
+                            element.attrib['metaConcept'],
+                            element.attrib['exportedId'],
+                            element.attrib['attributesJsonString'])
+                    parents.append(element)
+                    continue
+                parents.pop()
+                # the element that just ended is the last child of its
+                # parent, removing it keeps the tree from growing
+                if parents:
+                    del parents[-1][-1]
+
+    return model_index
+
+
+def create_client(config):
+    '''
+    Create an authenticated enterprise client from the enterprise-client
+    section of the configuration.
+    '''
+    from securicad import enterprise
 
     logging.info("Log in to Enterprise.")
     client = enterprise.client(
@@ -214,38 +523,97 @@ def run_coa():
         cacert=config["enterprise-client"]["cacert"] if config["enterprise-client"]["cacert"] else False
     )
     logging.info("Successfully logged on to Enterprise.")
+    return client
+
+def get_language_metadata(client, cache = None, url = None,
+    language_version = "", refresh = False):
+    '''
+    Download the language metadata, or read it from the cache if one is
+    given, where it is keyed by the server url and the language version.
+    With refresh the cached metadata is replaced by a new download.
+    '''
+    if cache is not None:
+        key = SimulationCache.metadata_key(url, language_version)
+        if not refresh:
+            lang_meta = cache.get(key, "metadata")
+            if lang_meta is not None:
+                logging.info("Read the language metadata of " +
+                    f"{url} from the cache.")
+                return lang_meta
 
     # Must "cheat" here and call a raw API to obtain full language meta.
     # The SDK method client.metadata.get_metadata() will not provide everything needed.
     lang_meta = client._get("metadata")
+    if cache is not None:
+        cache.put(key, "metadata", lang_meta)
+    return lang_meta
 
-    if (costsfile):
-        update_costs_from_file(costsfile, lang_meta)
-        logging.debug("Client's language metadata after costs update:\n" +
-            json.dumps(lang_meta, indent = 2))
-
-    if "project" in config and "name" in config["project"] and \
-        config["project"]["name"]:
-        # Get the project where the model will be added
-        project_name = config["project"]["name"]
-        project = client.projects.get_project_by_name(name = project_name)
+def configure_logging(logfile, log_level):
+    logging.basicConfig(level=getattr(logging, log_level),
+                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                    datefmt='%m-%d %H:%M',
+                    filename=logfile,
+                    filemode='w',
+                    force=True)
 
-    else:
+def check_config(config, configfile):
+    '''
+    Check the project settings of the configuration before logging in.
+    Returns SUCCESS, or ERROR_INCORRECT_CONFIG after reporting what is
+    missing.
+    '''
+    if not ("project" in config and "name" in config["project"] and \
+        config["project"]["name"]):
         logging.critical('Could not find project or project name in ' +
             f'{configfile} config file.')
         print('Could not find project or project name in',
             f'{configfile} config file.')
         return ERROR_INCORRECT_CONFIG
 
-    if  "scenario" in config["project"] and config["project"]["scenario"]:
-        scenario = client.scenarios.get_scenario_by_name(project = project,
-            name = config["project"]["scenario"])
-    else:
+    if not ("scenario" in config["project"] and \
+        config["project"]["scenario"]):
         logging.critical(f'Could not find scenario in {configfile} '
             + 'config file.')
         print(f'Could not find scenario in {configfile} config file.')
         return ERROR_INCORRECT_CONFIG
 
+    if not (config["project"].get("simID") or config["project"].get("model")):
+        logging.critical('Could not find simulation id or model name in ' +
+            f'{configfile} config file.')
+        print('Could not find simulation id or model name in',
+            f'{configfile} config file.')
+        return ERROR_INCORRECT_CONFIG
+    return SUCCESS
+
+def open_client(args, config, append = False):
+    '''
+    The client the run talks to: a replay of a recorded run, or an
+    authenticated enterprise client, recording to an archive if asked to.
+    With append, the recording is added to the existing archive.
+    '''
+    if args['replay']:
+        return ReplayClient(args['replay'], latency = args['replay_latency'],
+            simulation_time = args['replay_simulation_time'])
+    # Create an authenticated enterprise client
+    client = create_client(config)
+    if args['record']:
+        client = RecordingClient(client, args['record'], append = append)
+    return client
+
+def load_project(client, config):
+    '''
+    Find the project and scenario of the configuration and load the model
+    to analyse, from the simulation id if one is given and by its name
+    otherwise. Returns the scenario, the model, its name, its sCAD archive
+    and the ids the results start from.
+    '''
+    # Get the project where the model will be added
+    project_name = config["project"]["name"]
+    project = client.projects.get_project_by_name(name = project_name)
+
+    scenario = client.scenarios.get_scenario_by_name(project = project,
+        name = config["project"]["scenario"])
+
     results = {}
 
     # If a simulation id is specified we prioritise that over the model
@@ -253,149 +621,562 @@ def run_coa():
         simID = config["project"]["simID"]
         res = client._post("model/file", data={"pid": project.pid, "mids": [simID]})
         base_model_dict = client._post("model/json", data={"pid": project.pid, "mids": [simID]})
+        from securicad.model import Model
         model = Model(base_model_dict)
-        resp = client._post("scenarios", data={"pid": project.pid})
+        client._post("scenarios", data={"pid": project.pid})
         logging.info(f"Loaded initial simulation with project name: " +
             f"{project_name} and simulation id: {simID}")
 
-        simulations = enterprise.simulations.Simulations(client)
         simulation = client.simulations.get_simulation_by_simid(scenario, simID)
         model_name = simulation.name
         scad_dump = base64.b64decode(res["data"].encode("utf-8"), validate=True)
         results["initial_simid"] = simID
 
-    elif "model" in config["project"] and config["project"]["model"]:
+    else:
         model_name = config["project"]["model"]
-        models = enterprise.models.Models(client)
-        modelinfo = models.get_model_by_name(project, model_name)
+        modelinfo = client.models.get_model_by_name(project, model_name)
         model = modelinfo.get_model()
         scad_dump = modelinfo.get_scad()
         results["initial_ids"] = {"pid": project.pid, "tid": scenario.tid}
-    else:
-        logging.critical('Could not find simulation id or model name in ' +
-            f'{configfile} config file.')
-        print('Could not find simulation id or model name in',
-            f'{configfile} config file.')
+
+    return scenario, model, model_name, scad_dump, results
+
+def parse_arguments(argv = None):
+    '''
+    Parse the command line arguments of the analyser, from argv if given,
+    into a dictionary.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--logfile', default='log.txt',
+        help='filename to use for the log (default: %(default)s)')
+    parser.add_argument('--log_level', '--log-level', default='DEBUG',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+        help='lowest level of the messages written to the log, large ' +
+            'payloads such as simulation results are only serialized at ' +
+            'DEBUG (default: %(default)s)')
+    parser.add_argument('--metricsfile', default='metrics.json',
+        help='filename to use for the wall time spent in every phase of ' +
+            'every iteration (default: %(default)s)')
+    parser.add_argument('-c', '--configfile', default='coa.ini',
+        help='filename to use for the configuration (default: %(default)s)')
+    parser.add_argument('-o', '--costsfile',
+        help='filename to use for the costs')
+    parser.add_argument('-r', '--resultsfile', default='results.json',
+        help='filename to use for the results (default: %(default)s)')
+    parser.add_argument('--compact_results', action='store_true',
+        help='write the results in the compact format, where every CoA ' +
+            'only holds the defense it added and the TTCs that changed')
+    parser.add_argument('-j', '--journalfile', default='results.jsonl',
+        help='filename to use for the journal the results are recorded ' +
+            'in while running (default: %(default)s)')
+    parser.add_argument('-s', '--checkpointfile', default='checkpoint.json',
+        help='filename to use for the checkpoint written after every ' +
+            'simulation (default: %(default)s)')
+    parser.add_argument('--resume', action='store_true',
+        help='resume the run from the checkpoint file instead of ' +
+            'starting over')
+    parser.add_argument('-m', '--metric', default='frequency',
+        help='metric used to find the most critical attack step, one of ' +
+            'frequency, weighted_out_degrees, path_count and ' +
+            'ttc_weighted_path_count (default: %(default)s)')
+    parser.add_argument('-i', '--max_iterations', type=int, default=100,
+        help='number of maximum simulation iterations the analyser will ' +
+            'run (default: %(default)s)')
+    parser.add_argument('-b', '--initial_budget', type=int, default=1000,
+        help='initial budget (default: %(default)s)')
+    parser.add_argument('-n', '--simulation_name_prefix', default="",
+        help='simulation name prefix (default: %(default)s)')
+    parser.add_argument('--graph_backend', default='networkx',
+        choices=['networkx', 'compact'],
+        help='attack graph implementation, compact stores the graphs in ' +
+            'arrays, which takes less memory and time on large models ' +
+            '(default: %(default)s)')
+    parser.add_argument('--incremental_merge', action='store_true',
+        help='keep the merged attack graph between iterations and only ' +
+            'fetch and merge again the critical paths of the risks whose ' +
+            'ttcs changed, which assumes that the critical paths of the ' +
+            'other risks did not change either (networkx backend only)')
+    parser.add_argument('--check_incremental', action='store_true',
+        help='with --incremental_merge, fetch all of the critical paths ' +
+            'every iteration anyway and report where the incrementally ' +
+            'merged and ranked attack graph differs from a full rebuild')
+    parser.add_argument('-k', '--lookahead', type=int, default=1,
+        help='number of best ranked defenses that are simulated in ' +
+            'parallel in every iteration, keeping the one with the highest ' +
+            'efficiency per unit of cost (default: %(default)s)')
+    parser.add_argument('-d', '--defenses_per_iteration',
+        '--defenses-per-iteration', type=int, default=1,
+        help='number of defenses blocking disjoint attack steps that are ' +
+            'applied in every iteration and simulated together, which ' +
+            'takes fewer simulations at the expense of picking defenses ' +
+            'on less recent results (default: %(default)s)')
+    parser.add_argument('--surrogate_candidates', type=int, default=0,
+        help='number of affordable defenses, in ranking order, whose ' +
+            'efficiency per unit of cost is estimated every iteration by a ' +
+            'surrogate fitted to the efficiencies observed so far; only ' +
+            'the best --lookahead of them are simulated (default: ' +
+            '%(default)s, no surrogate)')
+    parser.add_argument('--observationsfile', default=None,
+        help='filename of a JSON lines file to record the defenses whose ' +
+            'efficiency was observed in, with what the surrogate knows ' +
+            'about them, for evaluating it offline')
+    parser.add_argument('--adaptive_samples', action='store_true',
+        help='start simulations with few samples and only raise them when ' +
+            'the results are too noisy to go by: when the ttcs have a ' +
+            'larger estimated error than the noise threshold, or when ' +
+            'lookahead candidates score within the estimated noise of ' +
+            'each other')
+    parser.add_argument('--min_samples', type=int, default=25,
+        help='number of samples adaptive simulations start with, and ' +
+            'lookahead candidates are screened with (default: %(default)s)')
+    parser.add_argument('--max_samples', type=int, default=800,
+        help='number of samples adaptive simulations are raised to at ' +
+            'most (default: %(default)s)')
+    parser.add_argument('--noise_threshold', type=float, default=0.1,
+        help='largest estimated error of a ttc5 or ttc50, relative to the ' +
+            'ttc50 of the risk, that adaptive simulations accept ' +
+            '(default: %(default)s)')
+    parser.add_argument('--poll_interval', type=float, default=5,
+        help='seconds between two simulation progress checks ' +
+            '(default: %(default)s)')
+    parser.add_argument('--simulation_deadline', type=float, default=None,
+        help='seconds after which a simulation that has not finished is ' +
+            'given up on (default: no deadline)')
+    parser.add_argument('--transport_retries', type=int, default=5,
+        help='number of times a request that failed because of a ' +
+            'transport error is retried (default: %(default)s)')
+    parser.add_argument('--cache_dir', default=None,
+        help='directory of the on-disk cache of simulation results and ' +
+            'critical paths (default: no cache)')
+    parser.add_argument('--cache_size', type=int,
+        default=DEFAULT_CACHE_SIZE >> 20,
+        help='maximum size of the cache in MiB, the least recently used ' +
+            'entries are evicted beyond it (default: %(default)s)')
+    parser.add_argument('--language_version', default='',
+        help='version of the language on the server, the language ' +
+            'metadata is cached per server url and language version')
+    parser.add_argument('--refresh_metadata', action='store_true',
+        help='download the language metadata again instead of reading it ' +
+            'from the cache, e.g. after the language on the server changed')
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument('--record', metavar='ARCHIVEFILE', default=None,
+        help='record the responses of the enterprise server to the given ' +
+            'archive, to replay the run offline later')
+    recording.add_argument('--replay', metavar='ARCHIVEFILE', default=None,
+        help='serve the run from the given archive instead of the ' +
+            'enterprise server')
+    parser.add_argument('--replay_latency', type=float, default=0,
+        help='seconds every replayed request is delayed by ' +
+            '(default: %(default)s)')
+    parser.add_argument('--replay_simulation_time', type=float, default=0,
+        help='seconds a replayed simulation takes to finish ' +
+            '(default: %(default)s)')
+    parser.add_argument('-w', '--fetch_workers', type=int, default=4,
+        help='number of critical paths requests that are run ' +
+            'concurrently (default: %(default)s)')
+    parser.add_argument('-p', '--paths_per_request', type=int, default=1,
+        help='number of attack steps whose critical paths are fetched ' +
+            'with a single request (default: %(default)s)')
+
+    args = vars(parser.parse_args(argv))
+    if args['fetch_workers'] < 1:
+        parser.error('--fetch_workers has to be at least 1')
+    if args['paths_per_request'] < 1:
+        parser.error('--paths_per_request has to be at least 1')
+    if args['defenses_per_iteration'] < 1:
+        parser.error('--defenses_per_iteration has to be at least 1')
+    if args['lookahead'] > 1 and args['defenses_per_iteration'] > 1:
+        parser.error('--lookahead and --defenses_per_iteration cannot be ' +
+            'combined')
+    if 0 < args['surrogate_candidates'] < args['lookahead']:
+        parser.error('--surrogate_candidates has to be at least --lookahead')
+    if (args['surrogate_candidates'] or args['observationsfile']) and \
+        args['defenses_per_iteration'] > 1:
+        parser.error('--surrogate_candidates and --observationsfile cannot ' +
+            'be combined with --defenses_per_iteration')
+    if args['incremental_merge'] and args['graph_backend'] != 'networkx':
+        parser.error('--incremental_merge requires the networkx graph backend')
+    if args['check_incremental'] and not args['incremental_merge']:
+        parser.error('--check_incremental requires --incremental_merge')
+    if args['min_samples'] < 1 or args['max_samples'] < args['min_samples']:
+        parser.error('--min_samples has to be at least 1 and at most ' +
+            '--max_samples')
+    return args
+
+def run_coa(args = None, config = None, lang_meta = None,
+    defense_index = None):
+    '''
+    Run the analysis with the arguments returned by parse_arguments, parsed
+    from the command line if not given. The configuration is read from the
+    configuration file and the language metadata is downloaded, unless
+    they are given, e.g. by the batch runner. A given defense_index has to
+    be compiled from the given language metadata.
+    '''
+    if args is None:
+        args = parse_arguments()
+    logfile = args['logfile']
+    log_level = args['log_level']
+    metricsfile = args['metricsfile']
+    configfile = args['configfile']
+    costsfile = args['costsfile']
+    resultsfile = args['resultsfile']
+    compact = args['compact_results']
+    journalfile = args['journalfile']
+    checkpointfile = args['checkpointfile']
+    resume = args['resume']
+    metric = args['metric']
+    max_iterations = args['max_iterations']
+    initial_budget = args['initial_budget']
+    simulation_name_prefix = args['simulation_name_prefix']
+    lookahead = args['lookahead']
+    defenses_per_iteration = args['defenses_per_iteration']
+    adaptive_samples = args['adaptive_samples']
+    min_samples = args['min_samples']
+    max_samples = args['max_samples'] if adaptive_samples else None
+    noise_threshold = args['noise_threshold']
+    poll_interval = args['poll_interval']
+    simulation_deadline = args['simulation_deadline']
+    transport_retries = args['transport_retries']
+    cache_dir = args['cache_dir']
+    cache_size = args['cache_size']
+    language_version = args['language_version']
+    refresh_metadata = args['refresh_metadata']
+    fetch_workers = args['fetch_workers']
+    paths_per_request = args['paths_per_request']
+    incremental_merge = args['incremental_merge']
+    surrogate_candidates = args['surrogate_candidates']
+    observationsfile = args['observationsfile']
+    check_incremental = args['check_incremental']
+
+    configure_logging(logfile, log_level)
+
+    timer = PhaseTimer(metricsfile)
+    checkpoint = read_json_file(checkpointfile) if resume else {}
+    if resume and not checkpoint:
+        logging.warning(f'No checkpoint found in {checkpointfile}, ' +
+            'starting from the beginning.')
+    if os.path.isfile(resultsfile) and not checkpoint:
+        os.remove(resultsfile)
+    if config is None:
+        config = configparser.ConfigParser()
+        config.read(configfile)
+
+    # Check the configuration before logging in
+    if check_config(config, configfile) != SUCCESS:
         return ERROR_INCORRECT_CONFIG
 
+    budget_remaining = initial_budget
+    logging.info(f"Starting budget: {budget_remaining}")
+
+    cache = SimulationCache(cache_dir, cache_size << 20) if cache_dir \
+        else None
+
+    client = open_client(args, config, append = bool(checkpoint))
+
+    if lang_meta is None:
+        lang_meta = get_language_metadata(client, cache,
+            config.get("enterprise-client", "url", fallback = None),
+            language_version, refresh_metadata)
+        defense_index = None
+
+    if (costsfile):
+        update_costs_from_file(costsfile, lang_meta)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Client's language metadata after costs update:\n" +
+                json.dumps(lang_meta, indent = 2))
+        defense_index = None
+
+    scenario, model, model_name, scad_dump, results = load_project(client,
+        config)
+
     if simulation_name_prefix:
         simulation_name = simulation_name_prefix + " " + model_name + " "
     else:
         simulation_name = model_name + " "
 
-    # Create an initial simulation to be used for the first iteration
-    simulation, simres = create_simulation(client = client,
-        scenario = scenario, name = simulation_name + "Initial Simulation",
-        model = model, iteration = -1)
-
-    if not simres:
-        return ERROR_FAILED_SIM
-
-    model_dict_list = load_model_dictionary(scad_dump, model_name)
+    # adaptive simulations start with the number of samples the previous
+    # one ended up with
+    samples = min_samples if adaptive_samples else DEFAULT_SAMPLES
 
     raw_tunings = []
-    previous = {}
+    previous_ttcs = None
+    previous_samples = samples
     results["CoAs"] = []
     results["initial_TTC"] = {}
+    start_iteration = 0
+
+    if checkpoint and checkpoint["simulation_name"] != simulation_name:
+        logging.critical(f'The checkpoint in {checkpointfile} belongs ' +
+            f'to {checkpoint["simulation_name"]!r} and not to ' +
+            f'{simulation_name!r}.')
+        print(f'The checkpoint in {checkpointfile} does not belong to',
+            f'the model in the {configfile} config file.')
+        return ERROR_INCORRECT_CONFIG
 
-    for main_i in range(max_iterations):
-        logging.debug(f'Current results for iteration {main_i}:\n' +
-            json.dumps(results, indent = 2))
-
-        ttcs = {}
-        if "simID" in config["project"] and config["project"]["simID"]:
-            results["final_simid"] = simres["simid"]
-
-        for risks_i in simres["results"]["risks"]:
-            ttcs[risks_i["attackstep_id"]] = [round(float(risks_i["ttc5"]), 3), round(float(risks_i["ttc50"]), 3), round(float(risks_i["ttc95"]), 3)]
-
-            previous_ttcs_json = ttcs[risks_i["attackstep_id"]]
-            risk_index = risks_i['object_id'] + "." + risks_i['attackstep']
+    if checkpoint:
+        start_iteration = checkpoint["iteration"]
+        raw_tunings = checkpoint["raw_tunings"]
+        budget_remaining = checkpoint["budget_remaining"]
+        previous_ttcs = checkpoint["previous_ttcs"]
+        samples = checkpoint["samples"]
+        previous_samples = checkpoint["previous_samples"]
+        journal = ResultsJournal(journalfile,
+            offset = checkpoint["journal_offset"])
+        set_use_counters(lang_meta, checkpoint["use_counters"])
+        logging.info(f"Resuming from iteration {start_iteration} with a " +
+            f"remaining budget of {budget_remaining}.")
+    else:
+        journal = ResultsJournal(journalfile, results)
+
+    runner = SimulationRunner(client, scenario,
+        poll_interval = poll_interval, deadline = simulation_deadline,
+        max_retries = MAX_SIMULATION_CREATION_RETRIES,
+        transport_retries = transport_retries, cache = cache,
+        noise_threshold = noise_threshold if adaptive_samples else None)
+    impact_model = None
+
+    # The results file is produced from the journal however the run ends,
+    # and the simulations still in flight are cancelled
+    try:
+        if checkpoint:
+            # Attach to the simulation the interrupted run was about to
+            # analyse
+            initial_simulation = runner.resume(checkpoint["simid"],
+                simulation_name + (" i=" + str(start_iteration - 1)
+                if start_iteration else "Initial Simulation"),
+                start_iteration - 1, model, raw_tunings,
+                checkpoint["simulation_samples"])
+        else:
+            # Create an initial simulation to be used for the first
+            # iteration and extract the model dictionary while it runs
+            initial_simulation = runner.submit(
+                simulation_name + "Initial Simulation", -1, model,
+                samples = samples, max_samples = max_samples)
+        timer.add("startup", time.perf_counter() - timer.start)
+
+        # The graph code is only needed once the initial simulation is
+        # done, so it is loaded while the simulation runs
+        from attack_graph import AttackGraph, CompactAttackGraph, \
+            IncrementalMerge, build_defense_index, merge_attack_graphs
+        graph_class = CompactAttackGraph \
+            if args['graph_backend'] == 'compact' else AttackGraph
+        # attack step id of every risk to the ttcs its attack graph was
+        # fetched for and the attack graph
+        risk_graphs = {}
+        merged_graphs = IncrementalMerge() if incremental_merge else None
+        # the ids of the defenses applied in the previous iteration
+        applied = []
+        if surrogate_candidates or observationsfile:
+            from surrogate import ImpactModel
+            impact_model = ImpactModel(observationsfile,
+                until_iteration = start_iteration if checkpoint else None)
+        # the candidate applied in the previous iteration without lookahead
+        observed = checkpoint["observed"] if checkpoint else None
+        if defense_index is None:
+            defense_index = build_defense_index(lang_meta)
+
+        with timer.phase("model_load"):
+            model_index = load_model_dictionary(scad_dump, model_name)
+
+        with timer.phase("simulation_wait"):
+            simulation, simres = initial_simulation.result()
+        if not simres:
+            return ERROR_FAILED_SIM
 
-            if main_i == 0:
-                results["initial_TTC"][risk_index] = previous_ttcs_json
+        for main_i in range(start_iteration, max_iterations):
+            timer.start_iteration(main_i)
+            with timer.phase("persistence"):
+                write_checkpoint(checkpointfile, main_i, simulation_name,
+                    simres, raw_tunings, budget_remaining, previous_ttcs,
+                    lang_meta, journal, samples, previous_samples, observed)
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(f'Current results for iteration {main_i}:\n' +
+                    json.dumps(journal.results, indent = 2))
+
+            ttcs = get_ttcs(simres)
+            current_samples = simres.get("samples", samples)
+            if adaptive_samples:
+                logging.info(f"Simulation for iteration {main_i} ran with " +
+                    f"{current_samples} samples, its ttcs have an " +
+                    "estimated error of " +
+                    f"{relative_ttc_error(ttcs, current_samples):.1%}.")
+                samples = max(samples, current_samples)
+            risk_ttcs = {}
+            for risks_i in simres["results"]["risks"]:
+                risk_index = risks_i['object_id'] + "." + risks_i['attackstep']
+                risk_ttcs[risk_index] = ttcs[risks_i["attackstep_id"]]
+
+            with timer.phase("persistence"):
+                if "simID" in config["project"] and \
+                    config["project"]["simID"]:
+                    journal.set("final_simid", simres["simid"])
+                if main_i == 0:
+                    journal.set_initial_ttcs(risk_ttcs)
+                elif risk_ttcs:
+                    journal.set_coa_ttcs(risk_ttcs, simres["report_url"])
+
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                steps_of_interest = ["{}".format(risks_i["attackstep_id"]) for risks_i in simres["results"]["risks"]]
+                logging.debug("Steps of interest are:\n" +
+                    json.dumps(steps_of_interest, indent = 2))
+
+            if main_i != 0:
+                eff = calculate_efficiency(previous_ttcs, ttcs)
+                if adaptive_samples:
+                    error = estimate_efficiency_error(previous_ttcs,
+                        previous_samples, ttcs, current_samples)
+                    logging.debug(f"Efficiency for step {main_i} is {eff} " +
+                        f"with an estimated error of {round(error, 3)}")
+                else:
+                    logging.debug(f"Efficiency for step {main_i} is {eff}")
+                with timer.phase("persistence"):
+                    journal.set_efficiency(str(eff))
+                if observed is not None:
+                    impact_model.observe(main_i, observed, eff)
+                    observed = None
+
+            previous_ttcs = ttcs
+            previous_samples = current_samples
+
+            # get selected critical paths - where ttc5 is less than infinity
+            if merged_graphs is None:
+                attack_paths = fetch_attack_graphs(simulation,
+                    simres["results"]["risks"], lang_meta,
+                    workers = fetch_workers,
+                    paths_per_request = paths_per_request,
+                    defense_index = defense_index, timer = timer,
+                    graph_class = graph_class)
             else:
-                coa_index = len(results["CoAs"]) - 1
-                if "coaTTC" not in results["CoAs"][coa_index].keys():
-                    results["CoAs"][coa_index]["coaTTC"] = {}
-                results["CoAs"][coa_index]["coaTTC"][risk_index] = previous_ttcs_json
-                results["CoAs"][coa_index]["report_url"] = simres["report_url"]
-
-        write_json_file(resultsfile, results)
-        steps_of_interest = ["{}".format(risks_i["attackstep_id"]) for risks_i in simres["results"]["risks"]]
-        logging.debug("Steps of interest are:\n" +
-            json.dumps(steps_of_interest, indent = 2))
-
-        if main_i != 0:
-            eff = calculate_efficiency(previous_ttcs, ttcs)
-            logging.debug(f"Efficiency for step {main_i} is {eff}")
-            results["CoAs"][coa_index]["efficiency"] = str(eff)
-            write_json_file(resultsfile, results)
-
-        previous_ttcs = ttcs
-
-        attack_paths = []
-
-        # get selected critical paths - where ttc5 is less than infinity
-        for risks_i in simres["results"]["risks"]:
-            if round(float(risks_i["ttc5"]), 3) == TEMP_INF:
-                continue
-            crit_path = simulation.get_critical_paths([risks_i["attackstep_id"]])
-            logging.debug("Critical path fetched:\n" +
-                json.dumps(crit_path, indent = 2))
-            ag = AttackGraph(crit_path, risks_i["attackstep_id"], lang_meta)
-            logging.debug("Critical path converted to an attack graph.")
-            attack_paths.append(ag)
-
-        if len(attack_paths) == 0:
-            logging.info("Simulation terminating successfully after " +
-                "protecting all of the high value assets.")
-            return SUCCESS
-
-        graph = merge_attack_graphs(attack_paths)
-
-        if (graph.find_critical_attack_step(metric) != 0):
-            return ERROR_UNKNOWN_METRIC
-
-        write_json_file(resultsfile, results)
-        best_def_info, budget_remaining = graph.find_best_defense(lang_meta,
-            model_dict_list, budget_remaining, results, resultsfile)
-        results = read_json_file(resultsfile)
-        if (best_def_info):
-            logging.info(f"Best defense for iteration {main_i} is:\n" +
-                json.dumps(best_def_info, indent = 2))
+                attack_paths, fetched = update_attack_graphs(risk_graphs,
+                    simulation, simres["results"]["risks"], ttcs, lang_meta,
+                    applied = applied, refetch = check_incremental,
+                    workers = fetch_workers,
+                    paths_per_request = paths_per_request,
+                    defense_index = defense_index, timer = timer)
+
+            if len(attack_paths) == 0:
+                logging.info("Simulation terminating successfully after " +
+                    "protecting all of the high value assets.")
+                return SUCCESS
+
+            with timer.phase("merge"):
+                if merged_graphs is None:
+                    graph = merge_attack_graphs(attack_paths)
+                else:
+                    graph = merged_graphs.update(list(attack_paths.items()))
+
+            with timer.phase("ranking"):
+                ranked = graph if merged_graphs is None else merged_graphs
+                if (ranked.find_critical_attack_step(metric) != 0):
+                    return ERROR_UNKNOWN_METRIC
+
+            if check_incremental:
+                with timer.phase("consistency_check"):
+                    check_merged_graph(graph, list(fetched.values()), metric,
+                        main_i)
+
+            best_defs = []
+            if lookahead > 1 or impact_model is not None:
+                with timer.phase("defense_selection"):
+                    candidates = graph.find_defense_candidates(lang_meta,
+                        model_index, budget_remaining,
+                        max(lookahead, surrogate_candidates), defense_index)
+                    if impact_model is not None:
+                        impact_model.add_features(graph, candidates)
+                    if surrogate_candidates:
+                        # only the most promising candidates are simulated
+                        candidates = impact_model.rank(candidates)[:lookahead]
+                if candidates and lookahead <= 1:
+                    candidate = candidates[0]
+                    # its efficiency is known after the next simulation
+                    observed = candidate
+                    best_defs = [graph.nodes[candidate["node"]]]
+                    with timer.phase("defense_selection"):
+                        budget_remaining = graph.apply_defense(
+                            candidate["node"], budget_remaining,
+                            candidate["cost"], journal,
+                            candidate["asset_tags"],
+                            candidate["defense_info"], lang_meta)
+                elif candidates:
+                    with timer.phase("simulation_wait"):
+                        candidate, simulation, simres = run_lookahead(
+                            runner = runner,
+                            name = simulation_name + " i=" + str(main_i),
+                            iteration = main_i, model = model,
+                            tunings = raw_tunings, graph = graph,
+                            candidates = candidates,
+                            previous_ttcs = previous_ttcs,
+                            samples = min_samples if adaptive_samples
+                                else DEFAULT_SAMPLES,
+                            max_samples = max_samples,
+                            impact_model = impact_model)
+                    if not simres:
+                        return ERROR_FAILED_SIM
+                    best_defs = [graph.nodes[candidate["node"]]]
+                    with timer.phase("defense_selection"):
+                        budget_remaining = graph.apply_defense(
+                            candidate["node"], budget_remaining,
+                            candidate["cost"], journal,
+                            candidate["asset_tags"],
+                            candidate["defense_info"], lang_meta)
+            elif defenses_per_iteration > 1:
+                with timer.phase("defense_selection"):
+                    best_defs, budget_remaining = graph.find_best_defenses(
+                        lang_meta, model_index, budget_remaining, journal,
+                        defenses_per_iteration, defense_index)
+            else:
+                with timer.phase("defense_selection"):
+                    best_def_info, budget_remaining = graph.find_best_defense(
+                        lang_meta, model_index, budget_remaining,
+                        journal, defense_index)
+                if best_def_info:
+                    best_defs = [best_def_info]
+            applied = [best_def_info["id"] for best_def_info in best_defs]
+            if best_defs:
+                for best_def_info in best_defs:
+                    raw_tunings.append(defense_tuning(best_def_info["name"],
+                        best_def_info["attackstep"], best_def_info["ref"]))
+            else:
+                logging.error("Failed to find an applicable defense for " +
+                    f"iteration {main_i}.")
+                print("Failed to find an applicable defense for " +
+                    f"iteration {main_i}.")
+                return ERROR_NO_DEFENCE
+
+            if lookahead <= 1:
+                next_simulation = runner.submit(
+                    simulation_name + " i=" + str(main_i), main_i, model,
+                    raw_tunings, samples, max_samples)
+
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                for best_def_info in best_defs:
+                    logging.info(f"Best defense for iteration {main_i} " +
+                        "is:\n" + json.dumps(best_def_info, indent = 2))
             logging.info(f"Remaining budget after iteration {main_i} is " +
                 f"{budget_remaining}")
-            raw_tunings.append(
-                {
-                    "type": "probability",
-                    "op": "apply",
-                    "filter": {"object_name": best_def_info["name"], "defense": best_def_info["attackstep"],
-                               "tags": {"ref": best_def_info["ref"]}},
-                    "probability": 1.0
-                }
-            )
-        else:
-            logging.error("Failed to find an applicable defense for " +
-                f"iteration {main_i}.")
-            print("Failed to find an applicable defense for " +
-                f"iteration {main_i}.")
-            return ERROR_NO_DEFENCE
-
-        simulation, simres = create_simulation(client = client,
-            scenario = scenario,
-            name = simulation_name + " i=" + str(main_i),
-            iteration = main_i, model = model, tunings = raw_tunings)
-
-        if not simres:
-            return ERROR_FAILED_SIM
 
-    logging.error("Ran the maximum number of " +
-    f"simulations allowed({max_iterations}) without finding all the " +
-    "defenses required to stop all of the attacks on high value assets.")
-    print("Ran the maximum number of " +
-    f"simulations allowed({max_iterations}) without finding all the " +
-    "defenses required to stop all of the attacks on high value assets.")
+            if lookahead <= 1:
+                with timer.phase("simulation_wait"):
+                    simulation, simres = next_simulation.result()
+                if not simres:
+                    return ERROR_FAILED_SIM
+            timer.end_iteration()
+
+        logging.error("Ran the maximum number of " +
+        f"simulations allowed({max_iterations}) without finding all the " +
+        "defenses required to stop all of the attacks on high value assets.")
+        print("Ran the maximum number of " +
+        f"simulations allowed({max_iterations}) without finding all the " +
+        "defenses required to stop all of the attacks on high value assets.")
+
+    finally:
+        runner.close()
+        with timer.phase("persistence"):
+            journal.write(resultsfile, compact)
+        journal.close()
+        if impact_model is not None:
+            impact_model.close()
+        timer.close()
 
 if __name__ == "__main__":
     exit(run_coa())
@@ -1,253 +1,1334 @@
-from json_helpers import read_json_file, write_json_file
+from json_helpers import JsonStreamReader
+import bisect
 import json
 import networkx as nx
+import numpy as np
+import heapq
 import logging
+import threading
+from collections.abc import Mapping
 
-class AttackGraph(nx.DiGraph):
+def build_defense_index(metadata):
+    '''
+    Compile the language metadata into a dictionary that maps
+    (asset class, defense name) to a dictionary holding the defense entry
+    of the language ("info"), whether the defense is suppressed
+    ("suppressed") and its language cost array ("cost", None if the
+    language does not specify one).
 
-    def __init__(self, path = None, target = None, metadata = None):
-        self.nodes_sorted = []
-        super().__init__()
-        self._get_params_from_json(path, target, metadata)
+    The index refers to the defense entries of the metadata rather than
+    copying them, so the use counters written into them stay visible.
+    It has to be rebuilt if the costs in the metadata are updated.
+    '''
+    defense_index = {}
+    for asset in metadata["assets"]:
+        for d in metadata["assets"][asset]["defenses"]:
+            key = (asset, d["name"])
+            suppressed = "suppress" in d["tags"]
+            if key in defense_index:
+                # a defense is only suppressed if all its entries are
+                defense_index[key]["suppressed"] &= suppressed
+                continue
+            defense_index[key] = {"info": d, "suppressed": suppressed,
+                "cost": d["metaInfo"].get("cost")}
+    return defense_index
 
 
-    def _get_params_from_json(self, path = None, target = None, metadata = None):
-        if path is None:
+def build_model_index(model_dict_list):
+    '''
+    Map the exportedId of every object in the model dictionary list to its
+    entry. If several entries share an exportedId the first one is kept.
+    '''
+    model_index = {}
+    for model_dict in model_dict_list:
+        model_index.setdefault(model_dict["exportedId"], model_dict)
+    return model_index
+
+
+class ModelIndex(Mapping):
+    '''
+    Read-only mapping from exportedId to the entry of the object in the
+    model dictionary, like the one returned by build_model_index. The
+    attributesJsonString of an object is kept encoded until the object is
+    looked up for the first time. If several objects share an exportedId
+    the first one is kept.
+    '''
+
+    def __init__(self):
+        self.objects = {}
+        self.encoded = {}
+
+    def add(self, name, meta_concept, exported_id, attributes_json):
+        if exported_id in self.objects:
             return
-        # finding out the edges by index values
-        edges_by_indices = []
-        for link in path[target]["links"]:
-            edges_by_indices.append((link["source"], link["target"]))
-        # map index to id
-        mapping = {}
-        for node in path[target]["nodes"]:
-            if node["isDefense"] == True:
-                # get all the defenses (classdefs) for the corresponding class object
-                classdefs = metadata["assets"][node["class"]]["defenses"]
-                # find info for one defense from classdefs.
-                for d in classdefs:
-                    # name of that particular defense = attackstep value for the path node
-                    if d["name"] == node["attackstep"]:
-                        if "suppress" not in d["tags"]:
-                            mapping[node["index"]] = node["id"]
-                            continue
-            else:
-                mapping[node["index"]] = node["id"]
-        # transform edges from index to id
-        edges_by_ids = []
-        for edge in edges_by_indices:
-            # only if both the nodes in edges are in mapping dict then append those edges in edges_by_ids
-            if mapping.get(edge[0],False) and mapping.get(edge[1],False):
-                edges_by_ids.append((mapping[edge[0]], mapping[edge[1]]))
-        self.add_edges_from(edges_by_ids)
-        for node in path[target]["nodes"]:
-            # only those nodes which are mapped that means are nor suppressed
-            if mapping.get(node["index"],False):
-                # as name field is given as example - (32) Given Name; and we only need the "Given Name"
-                temp = node["name"]
-                object_name = temp[temp.index(' ')+1:]
-                self.nodes[node["id"]]["id"] = node["id"]
-                self.nodes[node["id"]]["index"] = node["index"]
-                self.nodes[node["id"]]["eid"] = node["eid"]
-                self.nodes[node["id"]]["name"] = object_name
-                self.nodes[node["id"]]["class"] = node["class"]
-                self.nodes[node["id"]]["attackstep"] = node["attackstep"]
-                self.nodes[node["id"]]["frequency"] = node["frequency"]
-                self.nodes[node["id"]]["isDefense"] = node["isDefense"]
-                self.nodes[node["id"]]["ttc"] = node["ttc"]
-        logging.debug("Loaded the following graph nodes from json:\n" +
-            str(self.nodes))
+        self.objects[exported_id] = {"name": name,
+            "metaConcept": meta_concept, "exportedId": exported_id}
+        self.encoded[exported_id] = attributes_json
 
-    def find_critical_attack_step(self, metric):
-        logging.debug("Find critical attack step according to metric: " +
-            f"{metric}")
-        node_metrics = {}
-        match metric:
-            case 'frequency':
-                for node in self.nodes:
-                    if not self.nodes[node]["isDefense"]:
-                        node_metrics[node] = self.nodes[node]["frequency"]
-                        logging.debug(f'Node:{self.nodes[node]["id"]} ' +
-                            f'frequency:{self.nodes[node]["frequency"]}')
-
-            case 'weighted_out_degrees':
-                weighted_out_degrees = {node: \
-                    [sum([self.nodes[child]["frequency"] \
-                    for child in self.successors(node)])] \
-                    for node in self.nodes}
-                node_metrics = weighted_out_degrees
-
-            case _:
-                logging.error('find_critical_attack_step was given ' +
-                    f'unkwnown metric: {metric}')
-                return -1
-
-        self.nodes_sorted = sorted(node_metrics,
-            key=lambda key: (node_metrics[key]), reverse=True)
-
-        # assigning scores high to low on nodes according to the sorted order
-        score = len(self.nodes_sorted)
-        metric_of_previous_node = None
-        for node in self.nodes_sorted:
-            if metric_of_previous_node is None:
-                # score is being assigned to the most critical attack step
-                self.nodes[node]["crit_score"] = score
-            else:
-                if node_metrics[node] == metric_of_previous_node:
-                    # the metric of this node is the same as the previous one, so it will get the same criticality score
-                    self.nodes[node]["crit_score"] = score
-                else:
-                    self.nodes[node]["crit_score"] = score - 1
-                    score -= 1
-            metric_of_previous_node = node_metrics[node]
-
-        logging.debug('Sorted nodes with criticality scores:')
-        for node in self.nodes_sorted:
-            logging.debug(f'{self.nodes[node]["id"]}\t' +
-                f'{self.nodes[node]["crit_score"]}')
-        return 0
+    def __getitem__(self, exported_id):
+        model_dict = self.objects[exported_id]
+        if exported_id in self.encoded:
+            model_dict["attributesJsonString"] = json.loads(
+                self.encoded.pop(exported_id))
+        return model_dict
+
+    def __iter__(self):
+        return iter(self.objects)
+
+    def __len__(self):
+        return len(self.objects)
+
+
+# cycles are followed for at most this many rounds by the path metrics
+MAX_CYCLE_ROUNDS = 100
 
-    def apply_defense(self, node, budget, cost, results, asset_tags,
-        defense_info, meta_lang, resultsfile):
+
+class GraphArrays:
+    '''
+    The node attributes the criticality metrics are computed from and the
+    edges as compressed sparse row successor and predecessor arrays, with
+    nodes identified by their position in ids. CompactAttackGraph stores
+    its graph this way, AttackGraph.graph_arrays converts to it.
+    '''
+
+    def __init__(self, ids, frequency, is_defense, ttc, succ_ptr, succ,
+        pred_ptr, pred):
+        self.ids = ids
+        self.frequency = frequency
+        self.is_defense = is_defense
+        self.ttc = ttc
+        self.succ_ptr = succ_ptr
+        self.succ = succ
+        self.pred_ptr = pred_ptr
+        self.pred = pred
+
+
+def dense_ranking(values):
+    '''
+    Sort the values from high to low, keeping equal values in their
+    original order, and return the sorting together with the criticality
+    score of every sorted value: the highest value scores the number of
+    values and every lower value one less than the previous one, so equal
+    values share the same score.
+    '''
+    sorting = np.argsort(-values, kind = 'stable')
+    return sorting, dense_scores(values[sorting])
+
+
+def dense_scores(values):
+    '''
+    Criticality scores of values sorted from high to low, as returned by
+    dense_ranking.
+    '''
+    changes = np.zeros(len(values), dtype = np.int64)
+    np.cumsum(values[1:] != values[:-1], out = changes[1:])
+    return len(values) - changes
+
+
+def out_weights(graph):
+    '''
+    Sum of the frequencies of the successors of every node.
+    '''
+    n = len(graph.ids)
+    sources = np.repeat(np.arange(n), np.diff(graph.succ_ptr))
+    weights = np.bincount(sources, weights = graph.frequency[graph.succ],
+        minlength = n)
+    if graph.frequency.dtype.kind == 'i':
+        weights = weights.astype(np.int64)
+    return weights
+
+
+def _csr_ranges(ptr, nodes):
+    '''
+    Positions of the edges of the nodes in the arrays indexed by ptr.
+    '''
+    starts = ptr[nodes]
+    counts = ptr[nodes + 1] - starts
+    offsets = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) + np.repeat(starts - offsets, counts), \
+        counts
+
+
+def _propagate(ptr, adjacent, active, weights):
+    '''
+    One topological pass over the active nodes along the edges given by
+    ptr and adjacent. Every active node gets its weight times the sum of
+    the values of the active nodes with an edge into it, or times one if
+    there are none. With unit weights this counts the paths from the nodes
+    without incoming edges to every node.
+
+    The nodes are processed level by level, each level with a few array
+    operations. Nodes on or behind a cycle are never reached that way;
+    walks through them are followed for at most MAX_CYCLE_ROUNDS rounds.
+    '''
+    n = len(ptr) - 1
+    sources = np.repeat(np.arange(n), np.diff(ptr))
+    keep = active[sources] & active[adjacent]
+    sources = sources[keep]
+    targets = adjacent[keep]
+    out_ptr = np.zeros(n + 1, dtype = np.int64)
+    np.cumsum(np.bincount(sources, minlength = n), out = out_ptr[1:])
+    remaining = np.bincount(targets, minlength = n)
+
+    received = np.zeros(n)
+    value = np.zeros(n)
+    processed = np.zeros(n, dtype = bool)
+    level = np.flatnonzero(active & (remaining == 0))
+    received[level] = 1
+    while len(level):
+        processed[level] = True
+        value[level] = weights[level] * received[level]
+        edges, counts = _csr_ranges(out_ptr, level)
+        heads = targets[edges]
+        np.add.at(received, heads, np.repeat(value[level], counts))
+        np.subtract.at(remaining, heads, 1)
+        heads = np.unique(heads)
+        level = heads[remaining[heads] == 0]
+
+    # everything an unprocessed node leads to is unprocessed as well
+    cyclic = np.flatnonzero(active & ~processed)
+    if len(cyclic):
+        rounds = min(len(cyclic), MAX_CYCLE_ROUNDS)
+        logging.warning(f'{len(cyclic)} attack steps are on or behind a ' +
+            f'cycle, walks through them are followed for {rounds} rounds.')
+        inner = ~processed[sources]
+        sources = sources[inner]
+        targets = targets[inner]
+        for i in range(rounds):
+            total = received.copy()
+            np.add.at(total, targets, value[sources])
+            value[cyclic] = weights[cyclic] * total[cyclic]
+    return value
+
+
+def path_counts(graph, weights = None):
+    '''
+    Number of paths from an entry attack step, one without attack steps
+    leading to it, to a target attack step, one that leads to no further
+    attack steps, through every attack step, with one forward and one
+    backward topological pass. Defenses are not part of any path.
+
+    With weights, every path counts as the product of the weights of its
+    attack steps instead of one. The counts grow exponentially with the
+    depth of the graph and saturate at infinity.
+    '''
+    active = ~graph.is_defense
+    if weights is None:
+        weights = np.ones(len(graph.ids))
+    forward = _propagate(graph.succ_ptr, graph.succ, active, weights)
+    backward = _propagate(graph.pred_ptr, graph.pred, active, weights)
+    # the weight of a step is included in both passes
+    with np.errstate(over = 'ignore', invalid = 'ignore'):
+        counts = np.divide(forward * backward, weights,
+            out = np.zeros(len(graph.ids)), where = weights > 0)
+    return np.nan_to_num(counts, posinf = np.inf)
+
+
+def rank_attack_steps(graph, metric):
+    '''
+    Rank the nodes of the graph arrays by criticality according to metric
+    and return their positions from the most to the least critical,
+    equally critical nodes in node order, together with their dense
+    criticality scores, or None if the metric is unknown.
+
+    frequency: how often the attack step is on a critical path.
+    weighted_out_degrees: the frequency of the successors of the node,
+    ranking defenses as well.
+    path_count: the number of entry to target attack paths through the
+    attack step.
+    ttc_weighted_path_count: the same paths weighted by how fast they
+    are, each attack step contributing 1 / (1 + ttc) to the weight.
+    '''
+    match metric:
+        case 'frequency':
+            ranked = np.flatnonzero(~graph.is_defense)
+            values = graph.frequency[ranked]
+        case 'weighted_out_degrees':
+            ranked = np.arange(len(graph.ids))
+            values = out_weights(graph)
+        case 'path_count':
+            ranked = np.flatnonzero(~graph.is_defense)
+            values = path_counts(graph)[ranked]
+        case 'ttc_weighted_path_count':
+            ranked = np.flatnonzero(~graph.is_defense)
+            weights = 1 / (1 + np.maximum(graph.ttc, 0))
+            values = path_counts(graph, weights)[ranked]
+        case _:
+            return None
+    sorting, crit_scores = dense_ranking(values)
+    return ranked[sorting], crit_scores
+
+
+def critical_path_items(crit_path):
+    '''
+    The nodes and then the links of a critical path as ("nodes", node) and
+    ("links", link) pairs.
+    '''
+    for kind in ["nodes", "links"]:
+        for item in crit_path[kind]:
+            yield kind, item
+
+
+def stream_critical_path(stream, target = None):
+    '''
+    Read a critical path from a binary or text stream incrementally and
+    yield its nodes and links as ("nodes", node) and ("links", link) pairs
+    in the order of the document, one at a time. The document is either a
+    critical path, as stored by the SimulationCache, or, if target is
+    given, a mapping from attack step ids to critical paths, as returned by
+    get_critical_paths, of which only the one of target is read.
+    '''
+    reader = JsonStreamReader(stream)
+    if target is None:
+        yield from _stream_path_items(reader)
+        return
+    for attackstep_id in reader.keys():
+        if attackstep_id == target:
+            yield from _stream_path_items(reader)
+            return
+        reader.skip_value()
+
+
+def _stream_path_items(reader):
+    for key in reader.keys():
+        if key not in ["nodes", "links"]:
+            reader.skip_value()
+            continue
+        for element in reader.elements():
+            yield key, reader.read_value()
+
+
+class _DefenseSelection:
+    '''
+    Defense selection shared by the attack graph backends. A backend
+    provides the nodes mapping from node id to attributes, and the ranked
+    attack steps, their defenses and the frequency blocked by a defense in
+    terms of its own node keys, which _node_id turns into node ids.
+    '''
+
+    def apply_defense(self, node, budget, cost, journal, asset_tags,
+        defense_info, meta_lang, extend = False):
 
         def_name = defense_info["name"]
 
         budget = budget - cost
 
-        results["CoAs"].append({})
-        results["CoAs"][-1]["monetary_cost"] = {"1": int(cost)}
-        results["CoAs"][-1]["defenses"] = []
-        if len(results["CoAs"]) > 1:
-            results["CoAs"][-1]["defenses"] = results["CoAs"][-2]["defenses"].copy()
-        results["CoAs"][-1]["defenses"].append({"ref": asset_tags["ref"],
+        defense = {"ref": asset_tags["ref"],
             "defenseName": def_name,
             "assetName": self.nodes[node]["name"],
             "eid": self.nodes[node]["eid"],
-            "defenseInfo": def_name + " is used" })
+            "defenseInfo": def_name + " is used" }
+        if extend:
+            # the defense is simulated together with the previous one
+            journal.extend_coa(int(cost), defense)
+        else:
+            journal.add_coa(int(cost), defense)
         self.nodes[node]["ref"] = asset_tags["ref"]
         defense_info["metaInfo"]["use_counter"] += 1
 
-        write_json_file(resultsfile, results)
-
         logging.info(f'Defense {def_name} on {self.nodes[node]["name"]}' +
             f'(eid:{self.nodes[node]["eid"]}) with a cost of {cost} fit ' +
             'into the budget and was therefore applied.')
         return budget
 
     def find_best_defense(self, meta_lang, model_dict_list,
-        budget_remaining, results, resultsfile):
-
-        def_cost_list_dict={}
-        for top_attack_step in self.nodes_sorted:
-            block_range_def = {}
-            no_of_def_for_i_node = 0
-            pred_nodes = []
-            logging.debug(f"Analyzing attack step {top_attack_step} to " +
-                "find suitable defense")
-            for pred_node in self.predecessors(top_attack_step):
-                pred_nodes.append(pred_node)
-                if self.nodes[pred_node]["isDefense"]:
-                    no_of_def_for_i_node += 1
-                    block_range_def[pred_node] = sum([self.nodes[child]["frequency"] for child in self.successors(pred_node)])
-
-            if no_of_def_for_i_node > 0:
-                for no_def in range(no_of_def_for_i_node):
-                    best_def = max(block_range_def, key=block_range_def.get)
-                    logging.debug(f"Best defense candidate: {best_def}")
-                    for node in self.nodes:
-                        if self.nodes[node]["id"] == best_def:
-
-                            costs_array = None
-
-                            # Checking for user specified cost tags
-                            for idx, model_dict in enumerate(model_dict_list):
-                                asset_tags = None
-                                if self.nodes[node]["eid"] == model_dict["exportedId"]:
-                                    asset_tags = model_dict["attributesJsonString"]
-                                    cost_tag_name = \
-                                        self.nodes[node]["attackstep"] + '_mc'
-                                    # If the tag has the same name of the defense
-                                    if cost_tag_name in asset_tags:
-                                        costs_array = asset_tags[cost_tag_name].split(" ")
-                                        logging.debug('Found user defined ' +
-                                            'monetary cost tag for ' +
-                                            f'{self.nodes[node]["attackstep"]}' +
-                                            f' on {self.nodes[node]["name"]}' +
-                                            f'(eid:{self.nodes[node]["eid"]}):\n' +
-                                            f'{costs_array}')
-                                    break
-
-                            if not asset_tags:
-                                logging.warning('Failed to find asset in ' +
-                                'the model dictionary with eid:' +
-                                f'{self.nodes[node]["eid"]}.')
-                                continue
-
-                            classdefs = meta_lang["assets"][self.nodes[node]["class"]]["defenses"]
-                            defense_info = next((d for d in classdefs if d["name"] == self.nodes[node]["attackstep"]), False)
-                            # If there was no user defined tag containing the
-                            # cost look for one in the language costs
-                            if not costs_array and 'cost' in defense_info["metaInfo"]:
-                                costs_array = defense_info["metaInfo"]["cost"]
-                                logging.debug('Found language cost' +
-                                    ' for defense ' +
-                                    f'{defense_info["name"]}:\n' +
-                                    f'{costs_array}')
-
-                            if not costs_array:
-                                logging.info('No user defined tag or ' +
-                                    'language cost was found for the ' +
-                                    f'{best_def} defense.')
-                                break
-
-                            if not "use_counter" in defense_info["metaInfo"]:
-                                defense_info["metaInfo"]["use_counter"] = 0
-                            use_counter = \
-                                defense_info["metaInfo"]["use_counter"]
-                            current_cost = int(costs_array[min(
-                                len(costs_array) - 1, use_counter)])
-                            logging.debug('Found the following costs_array ' +
-                                'costs_array for ' +
-                                f'{self.nodes[node]["attackstep"]} on ' +
-                                f'on {self.nodes[node]["name"]}: ' +
-                                f'{costs_array}, with a use counter of: ' +
-                                f'{use_counter}, resulting in a cost of: ' +
-                                f'{current_cost}')
-
-                            if budget_remaining > current_cost:
-                                return self.nodes[node], \
-                                    self.apply_defense(node,
-                                        budget_remaining, current_cost,
-                                        results, asset_tags, defense_info,
-                                        meta_lang, resultsfile)
-                            else:
-                                block_range_def[best_def] = 0  # if both costs are high or no cost given
-                                logging.debug("Defense is beyond the budget " +
-                                    "and therefore cannot be applied.")
-                                break
-
-                    block_range_def[best_def] = 0  # if both costs are high or no cost given
-            else:
-                logging.info("No defense was available for Attack step:" +
-                    f"{top_attack_step}")
+        budget_remaining, journal, defense_index = None):
+
+        for node, cost, asset_tags, defense_info in \
+            self._affordable_defenses(meta_lang, model_dict_list,
+            budget_remaining, defense_index):
+            return self.nodes[node], \
+                self.apply_defense(node, budget_remaining, cost, journal,
+                    asset_tags, defense_info, meta_lang)
         logging.warning("No affordable defense was available for any of " +
             "the attack steps.")
         return None, None
 
+    def find_best_defenses(self, meta_lang, model_dict_list,
+        budget_remaining, journal, count, defense_index = None):
+        '''
+        Apply up to count defenses to be simulated together. They are picked
+        one after the other the way find_best_defense picks one, skipping
+        the defenses that block an attack step blocked by a defense picked
+        before. The costs are evaluated again after every pick, so the use
+        counters raise them within the batch as well. The first defense
+        starts a new CoA and the others are added to it.
+
+        Returns the list of the applied defense nodes and the remaining
+        budget.
+        '''
+        applied = []
+        blocked = set()
+        while len(applied) < count:
+            for node, cost, asset_tags, defense_info in \
+                self._affordable_defenses(meta_lang, model_dict_list,
+                budget_remaining, defense_index):
+                attack_steps = set(self.successors(node))
+                if node in blocked or attack_steps & blocked:
+                    continue
+                blocked.add(node)
+                blocked.update(attack_steps)
+                budget_remaining = self.apply_defense(node, budget_remaining,
+                    cost, journal, asset_tags, defense_info, meta_lang,
+                    extend = bool(applied))
+                applied.append(self.nodes[node])
+                break
+            else:
+                break
+        if not applied:
+            logging.warning("No affordable defense was available for any " +
+                "of the attack steps.")
+        elif len(applied) < count:
+            logging.info(f'Only {len(applied)} of {count} defenses that ' +
+                'block disjoint attack steps fit into the budget.')
+        return applied, budget_remaining
+
+    def find_defense_candidates(self, meta_lang, model_dict_list,
+        budget_remaining, count, defense_index = None):
+        '''
+        Return up to count distinct affordable defenses in the order in which
+        find_best_defense would consider them, without applying any of them.
+        Each candidate is a dictionary containing the defense node, its
+        current cost, the tags of its asset and its language defense info.
+        '''
+        candidates = []
+        for node, cost, asset_tags, defense_info in \
+            self._affordable_defenses(meta_lang, model_dict_list,
+            budget_remaining, defense_index):
+            if any(candidate["node"] == node for candidate in candidates):
+                continue
+            candidates.append({"node": node, "cost": cost,
+                "asset_tags": asset_tags, "defense_info": defense_info})
+            if len(candidates) >= count:
+                break
+        return candidates
+
+    def _affordable_defenses(self, meta_lang, model_dict_list,
+        budget_remaining, defense_index = None):
+        '''
+        Generator yielding (node, cost, asset_tags, defense_info) for the
+        defenses that fit into the remaining budget, from the most to the
+        least preferred one.
+
+        The attack steps are visited in criticality order and, for every
+        attack step, its defenses are visited from the one blocking the
+        highest frequency to the lowest one, ties broken by predecessor
+        order. Frequencies are assumed to be non-negative.
+        '''
+        if defense_index is None:
+            defense_index = build_defense_index(meta_lang)
+        if isinstance(model_dict_list, Mapping):
+            model_index = model_dict_list
+        else:
+            model_index = build_model_index(model_dict_list)
+
+        block_ranges = {}
+        evaluations = {}
+        for top_attack_step in self._ranked_attack_steps():
+            logging.debug("Analyzing attack step " +
+                f"{self._node_id(top_attack_step)} to find suitable defense")
+            defenses = self._defenses(top_attack_step)
+            if not defenses:
+                logging.info("No defense was available for Attack step:" +
+                    f"{self._node_id(top_attack_step)}")
+                continue
+
+            heap = []
+            for order, pred_node in enumerate(defenses):
+                if pred_node not in block_ranges:
+                    block_ranges[pred_node] = \
+                        self._blocked_frequency(pred_node)
+                heap.append((-block_ranges[pred_node], order, pred_node))
+            heapq.heapify(heap)
+
+            visited = set()
+            while heap:
+                if heap[0][0] < 0:
+                    best_def = heapq.heappop(heap)[2]
+                else:
+                    # None of the remaining defenses blocks any frequency,
+                    # the first defense is the only one left to consider
+                    best_def = defenses[0]
+                    heap = []
+                    if best_def in visited:
+                        break
+                visited.add(best_def)
+                logging.debug("Best defense candidate: " +
+                    f"{self._node_id(best_def)}")
+
+                if best_def not in evaluations:
+                    evaluations[best_def] = self._defense_cost(best_def,
+                        model_index, defense_index)
+                if evaluations[best_def] is None:
+                    continue
+                current_cost, asset_tags, defense_info = \
+                    evaluations[best_def]
+
+                if budget_remaining > current_cost:
+                    yield self._node_id(best_def), current_cost, \
+                        asset_tags, defense_info
+                else:
+                    logging.debug("Defense is beyond the budget " +
+                        "and therefore cannot be applied.")
+
+    def _defense_cost(self, node, model_index, defense_index):
+        '''
+        Return (cost, asset_tags, defense_info) for the defense node, using
+        the user defined monetary cost tag of its asset if there is one and
+        the language cost otherwise. Returns None if the asset, the defense
+        or its cost cannot be found.
+        '''
+        costs_array = None
+        attributes = self.nodes[self._node_id(node)]
+
+        # Checking for user specified cost tags
+        model_dict = model_index.get(attributes["eid"])
+        asset_tags = model_dict["attributesJsonString"] if model_dict \
+            else None
+        if not asset_tags:
+            logging.warning('Failed to find asset in ' +
+            'the model dictionary with eid:' +
+            f'{attributes["eid"]}.')
+            return None
+
+        cost_tag_name = attributes["attackstep"] + '_mc'
+        # If the tag has the same name of the defense
+        if cost_tag_name in asset_tags:
+            costs_array = asset_tags[cost_tag_name].split(" ")
+            logging.debug('Found user defined ' +
+                'monetary cost tag for ' +
+                f'{attributes["attackstep"]}' +
+                f' on {attributes["name"]}' +
+                f'(eid:{attributes["eid"]}):\n' +
+                f'{costs_array}')
+
+        defense = defense_index.get((attributes["class"],
+            attributes["attackstep"]))
+        if not defense:
+            logging.warning('Failed to find defense ' +
+                f'{attributes["attackstep"]} ' +
+                'in the language metadata for class ' +
+                f'{attributes["class"]}.')
+            return None
+        defense_info = defense["info"]
+        # If there was no user defined tag containing the
+        # cost look for one in the language costs
+        if not costs_array and defense["cost"]:
+            costs_array = defense["cost"]
+            logging.debug('Found language cost' +
+                ' for defense ' +
+                f'{defense_info["name"]}:\n' +
+                f'{costs_array}')
+
+        if not costs_array:
+            logging.info('No user defined tag or ' +
+                'language cost was found for the ' +
+                f'{self._node_id(node)} defense.')
+            return None
+
+        if not "use_counter" in defense_info["metaInfo"]:
+            defense_info["metaInfo"]["use_counter"] = 0
+        use_counter = defense_info["metaInfo"]["use_counter"]
+        current_cost = int(costs_array[min(
+            len(costs_array) - 1, use_counter)])
+        logging.debug('Found the following costs_array ' +
+            'costs_array for ' +
+            f'{attributes["attackstep"]} on ' +
+            f'on {attributes["name"]}: ' +
+            f'{costs_array}, with a use counter of: ' +
+            f'{use_counter}, resulting in a cost of: ' +
+            f'{current_cost}')
+        return current_cost, asset_tags, defense_info
+
+
+class AttackGraph(_DefenseSelection, nx.DiGraph):
+
+    def __init__(self, path = None, target = None, metadata = None,
+        defense_index = None):
+        self.nodes_sorted = []
+        super().__init__()
+        self._get_params_from_json(path, target, metadata, defense_index)
+
+
+    @classmethod
+    def from_stream(cls, stream, target = None, metadata = None,
+        defense_index = None):
+        '''
+        Build the attack graph of a critical path read incrementally from a
+        binary or text stream, see stream_critical_path, without ever
+        holding the whole JSON document in memory.
+        '''
+        graph = cls()
+        if defense_index is None:
+            defense_index = build_defense_index(metadata)
+        graph._add_critical_path(stream_critical_path(stream, target),
+            defense_index)
+        return graph
+
+    def _get_params_from_json(self, path = None, target = None, metadata = None,
+        defense_index = None):
+        if path is None:
+            return
+        if defense_index is None:
+            defense_index = build_defense_index(metadata)
+        self._add_critical_path(critical_path_items(path[target]),
+            defense_index)
+
+    def _add_critical_path(self, items, defense_index):
+        '''
+        Add the nodes and links of a critical path, given as ("nodes", node)
+        and ("links", link) pairs, in a single pass. Suppressed defenses are
+        left out as their nodes come in, and so are the links to them. A
+        node is added with all of its attributes when the first link to or
+        from it comes in, so the nodes, successors and predecessors are in
+        the order of the links, like with add_edges_from. Links that come
+        before all of the nodes are kept until the nodes are known.
+        '''
+        nodes = self._node
+        succ = self._succ
+        pred = self._pred
+        # the attributes of the nodes that are not suppressed by index
+        attributes = {}
+        early_links = []
+
+        def add_link(link):
+            source = attributes.get(link["source"])
+            target = attributes.get(link["target"])
+            if source is None or target is None:
+                return
+            for data in [source, target]:
+                if data["id"] not in nodes:
+                    nodes[data["id"]] = data
+                    succ[data["id"]] = {}
+                    pred[data["id"]] = {}
+            u = source["id"]
+            v = target["id"]
+            if v not in succ[u]:
+                succ[u][v] = {}
+                pred[v][u] = succ[u][v]
+
+        for kind, item in items:
+            if kind == "links":
+                if attributes:
+                    add_link(item)
+                else:
+                    early_links.append(item)
+                continue
+            if item["isDefense"] == True:
+                # name of the defense = attackstep value for the path node
+                defense = defense_index.get((item["class"], item["attackstep"]))
+                if not defense or defense["suppressed"]:
+                    continue
+            # as name field is given as example - (32) Given Name; and we
+            # only need the "Given Name"
+            name = item["name"]
+            attributes[item["index"]] = {"id": item["id"],
+                "index": item["index"], "eid": item["eid"],
+                "name": name[name.index(' ')+1:], "class": item["class"],
+                "attackstep": item["attackstep"],
+                "frequency": item["frequency"],
+                "isDefense": item["isDefense"], "ttc": item["ttc"]}
+        for link in early_links:
+            add_link(link)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Loaded the following graph nodes from json:\n" +
+                str(self.nodes))
+
+    def graph_arrays(self, edges = True):
+        '''
+        Convert the graph into GraphArrays, keeping the order of the nodes
+        and of the successors and predecessors of every node. Without
+        edges, the arrays describe the nodes only.
+        '''
+        ids = list(self._node)
+        attributes = list(self._node.values())
+        arrays = []
+        for adjacency in [self._succ, self._pred]:
+            ptr = np.zeros(len(ids) + 1, dtype = np.int64)
+            adjacent = np.zeros(0, dtype = np.int64)
+            if edges:
+                positions = {node: i for i, node in enumerate(ids)}
+                np.cumsum([len(adjacency[node]) for node in ids],
+                    out = ptr[1:])
+                adjacent = np.fromiter((positions[other] for node in ids
+                    for other in adjacency[node]), dtype = np.int64,
+                    count = ptr[-1])
+            arrays.extend([ptr, adjacent])
+        frequency = np.array([a["frequency"] for a in attributes]) \
+            if ids else np.zeros(0, dtype = np.int64)
+        return GraphArrays(ids, frequency,
+            np.array([a["isDefense"] for a in attributes], dtype = bool),
+            np.array([a["ttc"] for a in attributes], dtype = np.float64),
+            *arrays)
+
+    def find_critical_attack_step(self, metric):
+        logging.debug("Find critical attack step according to metric: " +
+            f"{metric}")
+        # ranking by frequency does not need the edges converted
+        arrays = self.graph_arrays(edges = metric != 'frequency')
+        ranking = rank_attack_steps(arrays, metric)
+        if ranking is None:
+            logging.error('find_critical_attack_step was given ' +
+                f'unkwnown metric: {metric}')
+            return -1
+
+        order, crit_scores = ranking
+        self.set_ranking([arrays.ids[i] for i in order.tolist()],
+            crit_scores)
+        return 0
+
+    def set_ranking(self, nodes_sorted, crit_scores):
+        self.nodes_sorted = nodes_sorted
+        for node, crit_score in zip(self.nodes_sorted, crit_scores.tolist()):
+            self._node[node]["crit_score"] = crit_score
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('Sorted nodes with criticality scores:')
+            for node in self.nodes_sorted:
+                logging.debug(f'{self.nodes[node]["id"]}\t' +
+                    f'{self.nodes[node]["crit_score"]}')
+
+    def attack_step_frequency(self):
+        return sum(data["frequency"] for data in self._node.values()
+            if not data["isDefense"])
+
+    def _ranked_attack_steps(self):
+        return self.nodes_sorted
+
+    def _defenses(self, attack_step):
+        return [pred_node for pred_node in self.predecessors(attack_step)
+            if self.nodes[pred_node]["isDefense"]]
+
+    def _blocked_frequency(self, defense):
+        return sum(self.nodes[child]["frequency"]
+            for child in self.successors(defense))
+
+    def _node_id(self, node):
+        return node
+
+
+class StringTable:
+    '''
+    Interns strings by mapping every distinct string to an integer code, so
+    that columns of repeated strings like class names fit in integer arrays.
+    '''
+
+    def __init__(self):
+        self.strings = []
+        self.codes = {}
+        self.lock = threading.Lock()
+
+    def encode(self, values):
+        result = []
+        with self.lock:
+            for value in values:
+                code = self.codes.get(value)
+                if code is None:
+                    code = self.codes[value] = len(self.strings)
+                    self.strings.append(value)
+                result.append(code)
+        return np.array(result, dtype = np.int32)
+
+    def decode(self, code):
+        return self.strings[code]
+
+
+STRINGS = StringTable()
+
+
+class CompactNodeView:
+    '''
+    Mapping from node id to the attributes of the node, like the nodes of
+    an AttackGraph. The attribute dictionary of a node is only built when
+    it is looked up and then kept, so that attributes set on it, such as
+    the ref of an applied defense, are not lost.
+    '''
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, node_id):
+        return self.graph._attributes(self.graph._position(node_id))
+
+    def __iter__(self):
+        return iter(self.graph.ids)
+
+    def __len__(self):
+        return len(self.graph.ids)
+
+    def __contains__(self, node_id):
+        return node_id in self.graph._positions()
+
+    def __str__(self):
+        return str(self.graph.ids)
+
+
+class CompactAttackGraph(_DefenseSelection):
+    '''
+    Attack graph backend storing the node attributes in typed arrays, with
+    the eid, name, class and attack step strings interned in STRINGS, and
+    the edges in compressed sparse row successor and predecessor arrays.
+
+    It supports what the analyser does with an AttackGraph, building it
+    from a critical path, merging, ranking the attack steps and selecting
+    defenses, with identical results, including the order of the nodes and
+    edges that ties are broken by. Internally nodes are identified by
+    their position in the arrays.
+    '''
+
+    def __init__(self, path = None, target = None, metadata = None,
+        defense_index = None):
+        self.ids = []
+        self.positions = {}
+        self.index = np.zeros(0, dtype = np.int64)
+        self.eid = np.zeros(0, dtype = np.int32)
+        self.name = np.zeros(0, dtype = np.int32)
+        self.asset_class = np.zeros(0, dtype = np.int32)
+        self.attackstep = np.zeros(0, dtype = np.int32)
+        self.frequency = np.zeros(0, dtype = np.int64)
+        self.is_defense = np.zeros(0, dtype = bool)
+        self.ttc = np.zeros(0, dtype = np.float64)
+        self.succ_ptr = np.zeros(1, dtype = np.int64)
+        self.succ = np.zeros(0, dtype = np.int64)
+        self.pred_ptr = np.zeros(1, dtype = np.int64)
+        self.pred = np.zeros(0, dtype = np.int64)
+        self.order = np.zeros(0, dtype = np.int64)
+        self.crit_score = None
+        self.out_weights = None
+        self.materialized = {}
+        self.nodes = CompactNodeView(self)
+        self._get_params_from_json(path, target, metadata, defense_index)
+
+    def _get_params_from_json(self, path = None, target = None,
+        metadata = None, defense_index = None):
+        if path is None:
+            return
+        if defense_index is None:
+            defense_index = build_defense_index(metadata)
+        mapping = {}
+        for node in path[target]["nodes"]:
+            if node["isDefense"] == True:
+                defense = defense_index.get((node["class"], node["attackstep"]))
+                if defense and not defense["suppressed"]:
+                    mapping[node["index"]] = node["id"]
+            else:
+                mapping[node["index"]] = node["id"]
+
+        # nodes are numbered in the order networkx would add them
+        positions = self.positions
+        edges = {}
+        for link in path[target]["links"]:
+            source = mapping.get(link["source"], False)
+            target_id = mapping.get(link["target"], False)
+            if source and target_id:
+                edge = (positions.setdefault(source, len(positions)),
+                    positions.setdefault(target_id, len(positions)))
+                edges.setdefault(edge, None)
+        self.ids = list(positions)
+
+        columns = [[None] * len(positions) for i in range(8)]
+        for node in path[target]["nodes"]:
+            if mapping.get(node["index"], False):
+                i = positions[node["id"]]
+                temp = node["name"]
+                columns[0][i] = node["index"]
+                columns[1][i] = node["eid"]
+                columns[2][i] = temp[temp.index(' ')+1:]
+                columns[3][i] = node["class"]
+                columns[4][i] = node["attackstep"]
+                columns[5][i] = node["frequency"]
+                columns[6][i] = node["isDefense"]
+                columns[7][i] = node["ttc"]
+        self.index = np.array(columns[0], dtype = np.int64)
+        self.eid = STRINGS.encode(columns[1])
+        self.name = STRINGS.encode(columns[2])
+        self.asset_class = STRINGS.encode(columns[3])
+        self.attackstep = STRINGS.encode(columns[4])
+        self.frequency = np.array(columns[5]) if columns[5] \
+            else np.zeros(0, dtype = np.int64)
+        self.is_defense = np.array(columns[6], dtype = bool)
+        self.ttc = np.array(columns[7], dtype = np.float64)
+
+        edges = np.array(list(edges), dtype = np.int64).reshape(-1, 2)
+        self._set_edges(edges[:, 0], edges[:, 1],
+            np.argsort(edges[:, 1], kind = 'stable'))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Loaded the following graph nodes from json:\n" +
+                str(self.nodes))
+
+    def _set_edges(self, sources, targets, pred_order):
+        '''
+        Build the successor and predecessor arrays from the edges, listed
+        in the order the successors of a node are in. pred_order sorts the
+        edges by target into the order the predecessors of a node are in.
+        '''
+        n = len(self.ids)
+        self.succ_ptr = np.zeros(n + 1, dtype = np.int64)
+        np.cumsum(np.bincount(sources, minlength = n), out = self.succ_ptr[1:])
+        self.succ = targets[np.argsort(sources, kind = 'stable')]
+        self.pred_ptr = np.zeros(n + 1, dtype = np.int64)
+        np.cumsum(np.bincount(targets, minlength = n), out = self.pred_ptr[1:])
+        self.pred = sources[pred_order]
+
+    def number_of_nodes(self):
+        return len(self.ids)
+
+    def number_of_edges(self):
+        return len(self.succ)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def successors(self, node_id):
+        i = self._position(node_id)
+        for j in self.succ[self.succ_ptr[i]:self.succ_ptr[i + 1]].tolist():
+            yield self.ids[j]
+
+    def predecessors(self, node_id):
+        i = self._position(node_id)
+        for j in self.pred[self.pred_ptr[i]:self.pred_ptr[i + 1]].tolist():
+            yield self.ids[j]
+
+    @property
+    def nodes_sorted(self):
+        return [self.ids[i] for i in self.order.tolist()]
+
+    def find_critical_attack_step(self, metric):
+        logging.debug("Find critical attack step according to metric: " +
+            f"{metric}")
+        ranking = rank_attack_steps(self, metric)
+        if ranking is None:
+            logging.error('find_critical_attack_step was given ' +
+                f'unkwnown metric: {metric}')
+            return -1
+
+        self.order, crit_scores = ranking
+        self.crit_score = np.full(len(self.ids), -1, dtype = np.int64)
+        self.crit_score[self.order] = crit_scores
+        for i, attributes in self.materialized.items():
+            if self.crit_score[i] >= 0:
+                attributes["crit_score"] = int(self.crit_score[i])
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('Sorted nodes with criticality scores:')
+            for i in self.order.tolist():
+                logging.debug(f'{self.ids[i]}\t{self.crit_score[i]}')
+        return 0
+
+    def _out_weights(self):
+        if self.out_weights is None:
+            self.out_weights = out_weights(self)
+        return self.out_weights
+
+    def attack_step_frequency(self):
+        return self.frequency[~self.is_defense].sum().item()
+
+    def _ranked_attack_steps(self):
+        return self.order.tolist()
+
+    def _defenses(self, attack_step):
+        preds = self.pred[self.pred_ptr[attack_step]:
+            self.pred_ptr[attack_step + 1]]
+        return preds[self.is_defense[preds]].tolist()
+
+    def _blocked_frequency(self, defense):
+        return self._out_weights()[defense].item()
+
+    def _node_id(self, node):
+        return self.ids[node]
+
+    def _positions(self):
+        if len(self.positions) != len(self.ids):
+            self.positions = {node_id: i for i, node_id in
+                enumerate(self.ids)}
+        return self.positions
+
+    def _position(self, node_id):
+        return self._positions()[node_id]
+
+    def _attributes(self, i):
+        attributes = self.materialized.get(i)
+        if attributes is None:
+            attributes = {"id": self.ids[i],
+                "index": self.index[i].item(),
+                "eid": STRINGS.decode(self.eid[i]),
+                "name": STRINGS.decode(self.name[i]),
+                "class": STRINGS.decode(self.asset_class[i]),
+                "attackstep": STRINGS.decode(self.attackstep[i]),
+                "frequency": self.frequency[i].item(),
+                "isDefense": self.is_defense[i].item(),
+                "ttc": self.ttc[i].item()}
+            if self.crit_score is not None and self.crit_score[i] >= 0:
+                attributes["crit_score"] = self.crit_score[i].item()
+            self.materialized[i] = attributes
+        return attributes
+
 
 def merge_attack_graphs(graphs):
+    '''
+    Merge the attack graphs into a single attack graph in one pass over
+    their nodes and edges. The frequencies of the nodes present in several
+    graphs are added up, while their other attributes are taken from the
+    last graph containing them.
+
+    The result is the same as composing the graphs one after the other
+    with networkx, including the order of the nodes, successors and
+    predecessors, which decides ties when ranking attack steps and
+    defenses. Repeated composition lists the predecessors of a node first
+    by node order for the edges already known before the last graph, then
+    in the order of the last graph for the edges it adds.
+
+    Compact attack graphs are merged into a compact attack graph.
+    '''
+    if graphs and isinstance(graphs[0], CompactAttackGraph):
+        return merge_compact_attack_graphs(graphs)
     res = AttackGraph()
-    freq_of_i = {}
     logging.debug(f"Merge {len(graphs)} attack graphs.")
-    for i in range(len(graphs)):
-        for node in graphs[i].nodes:
-            if node in res.nodes:
-                freq_of_i[node] = res.nodes[node]["frequency"]
+    nodes = res._node
+    succ = res._succ
+    pred = res._pred
+    position = {}
+    earlier_preds = {}
+    last_preds = {}
+    last = len(graphs) - 1
+    for i, graph in enumerate(graphs):
+        res.graph.update(graph.graph)
+        for node, data in graph.nodes(data = True):
+            if node in nodes:
+                frequency = nodes[node]["frequency"] + data["frequency"]
+                nodes[node].update(data)
+                nodes[node]["frequency"] = frequency
+            else:
+                position[node] = len(position)
+                nodes[node] = data.copy()
+                succ[node] = {}
+                pred[node] = {}
+        for u, v, data in graph.edges(data = True):
+            if v in succ[u]:
+                succ[u][v].update(data)
+                continue
+            succ[u][v] = data.copy()
+            if i < last:
+                earlier_preds.setdefault(v, []).append(u)
             else:
-                freq_of_i[node] = 0
-        res = nx.algorithms.operators.binary.compose(res, graphs[i])
-        for node in graphs[i].nodes:
-            res.nodes[node]["frequency"] = freq_of_i[node] + graphs[i].nodes[node]["frequency"]
-    logging.debug(f"Attack graphs merger result:\n" + str(res.nodes))
+                last_preds.setdefault(v, []).append(u)
+
+    for v in pred:
+        for u in sorted(earlier_preds.get(v, []), key = position.get):
+            pred[v][u] = succ[u][v]
+        for u in last_preds.get(v, []):
+            pred[v][u] = succ[u][v]
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"Attack graphs merger result:\n" + str(res.nodes))
     return res
 
+
+def merge_compact_attack_graphs(graphs):
+    '''
+    Merge compact attack graphs with the same result as merge_attack_graphs,
+    working on whole arrays instead of one node or edge at a time.
+    '''
+    res = CompactAttackGraph()
+    logging.debug(f"Merge {len(graphs)} compact attack graphs.")
+    positions = res.positions
+    merged_positions = []
+    for graph in graphs:
+        merged_positions.append(np.array([positions.setdefault(node_id,
+            len(positions)) for node_id in graph.ids], dtype = np.int64))
+    res.ids = list(positions)
+    n = len(res.ids)
+    if not n:
+        return res
+
+    # attributes come from the last graph containing the node, so from its
+    # first occurrence when looking at the graphs backwards
+    occurrences = np.concatenate(merged_positions)
+    first_backwards = np.unique(occurrences[::-1], return_index = True)[1]
+    last = len(occurrences) - 1 - first_backwards
+    for column in ["index", "eid", "name", "asset_class", "attackstep",
+        "is_defense", "ttc"]:
+        setattr(res, column, np.concatenate([getattr(graph, column)
+            for graph in graphs])[last])
+    frequencies = np.concatenate([graph.frequency for graph in graphs])
+    res.frequency = np.zeros(n, dtype = frequencies.dtype)
+    np.add.at(res.frequency, occurrences, frequencies)
+
+    # edges in the order of their first occurrence, graph by graph
+    sources = np.concatenate([merged[np.repeat(np.arange(len(graph.ids)),
+        np.diff(graph.succ_ptr))] for graph, merged in
+        zip(graphs, merged_positions)])
+    targets = np.concatenate([merged[graph.succ] for graph, merged in
+        zip(graphs, merged_positions)])
+    graph_numbers = np.repeat(np.arange(len(graphs)),
+        [len(graph.succ) for graph in graphs])
+    first = np.sort(np.unique(sources * n + targets, return_index = True)[1])
+    sources = sources[first]
+    targets = targets[first]
+    # predecessors known before the last graph come in node order, the
+    # ones the last graph adds after them in the order of that graph
+    added_last = graph_numbers[first] == len(graphs) - 1
+    pred_order = np.lexsort((np.where(added_last, np.arange(len(first)),
+        sources), added_last, targets))
+    res._set_edges(sources, targets, pred_order)
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"Attack graphs merger result:\n" + str(res.nodes))
+    return res
+
+
+class IncrementalMerge:
+    '''
+    Merged attack graph that is kept up to date while the attack graphs it
+    is merged from are replaced, added and dropped, with the same result as
+    merge_attack_graphs, including the order of the nodes, successors and
+    predecessors. An update only visits the nodes and edges of the attack
+    graphs that changed, and the ranking by frequency is updated by moving
+    the attack steps whose frequency or position changed instead of
+    sorting all of them again.
+
+    Every attack graph is merged from a numbered slot, in slot order. For
+    every node and edge, the slots of the attack graphs containing it are
+    tracked together with its position in them: the first slot decides its
+    position in the merged graph, the last one its attributes, and the
+    frequency of a node is the sum over all of them. Only AttackGraph is
+    supported.
+    '''
+
+    def __init__(self):
+        self.graph = AttackGraph()
+        self.keys = []
+        self.slots = {}
+        self.slot_graphs = {}
+        self.node_slots = {}
+        self.edge_slots = {}
+        self.node_order = {}
+        self.edge_order = {}
+        self.ranking = None
+        self.rank_entries = {}
+        self.unranked = set()
+
+    def update(self, graphs):
+        '''
+        Merge the attack graphs, given as a list of (key, attack graph)
+        pairs in merge order, and return the merged graph. The attack graph
+        of a key is taken to be unchanged if the same object was passed for
+        the key in the previous update. Keys passed before have to keep
+        their relative order and new keys can only follow them, otherwise
+        the attack graphs are merged from scratch.
+        '''
+        known = [self.slots[key] for key, graph in graphs if key in self.slots]
+        if known != sorted(known) or \
+            any(key not in self.slots for key, graph in graphs[:len(known)]):
+            logging.debug("The order of the attack graphs changed, " +
+                "merging them from scratch.")
+            self.__init__()
+
+        old_last = self.slots[self.keys[-1]] if self.keys else None
+        current = dict(graphs)
+        touched_nodes = set()
+        touched_edges = set()
+        for key in self.keys:
+            slot = self.slots[key]
+            if current.get(key) is not self.slot_graphs[slot]:
+                self._remove(slot, touched_nodes, touched_edges)
+                if key not in current:
+                    del self.slots[key]
+        next_slot = max(self.slots.values(), default = -1) + 1
+        for key, graph in graphs:
+            if key not in self.slots:
+                self.slots[key] = next_slot
+                next_slot += 1
+            if self.slots[key] not in self.slot_graphs:
+                self._add(self.slots[key], graph, touched_nodes,
+                    touched_edges)
+        self.keys = [key for key, graph in graphs]
+        last = self.slots[self.keys[-1]] if self.keys else None
+
+        logging.debug(f"Merge {len(touched_nodes)} changed nodes and " +
+            f"{len(touched_edges)} changed edges of {len(graphs)} attack " +
+            "graphs incrementally.")
+        self._merge(touched_nodes, touched_edges,
+            {old_last, last} if last != old_last else set())
+        return self.graph
+
+    def _remove(self, slot, touched_nodes, touched_edges):
+        graph = self.slot_graphs.pop(slot)
+        for node in graph._node:
+            del self.node_slots[node][slot]
+            touched_nodes.add(node)
+        for edge in graph.edges():
+            del self.edge_slots[edge][slot]
+            touched_edges.add(edge)
+
+    def _add(self, slot, graph, touched_nodes, touched_edges):
+        self.slot_graphs[slot] = graph
+        for i, node in enumerate(graph._node):
+            self.node_slots.setdefault(node, {})[slot] = i
+            touched_nodes.add(node)
+        for i, edge in enumerate(graph.edges()):
+            self.edge_slots.setdefault(edge, {})[slot] = i
+            touched_edges.add(edge)
+
+    def _merge(self, touched_nodes, touched_edges, relast):
+        '''
+        Bring the merged graph up to date with the slots of the touched
+        nodes and edges. relast holds the previous and the current last
+        slot if the last attack graph changed, since the predecessors the
+        last attack graph adds are ordered differently.
+        '''
+        nodes = self.graph._node
+        succ = self.graph._succ
+        pred = self.graph._pred
+        moved = []
+        dropped = []
+        for node in touched_nodes:
+            slots = self.node_slots[node]
+            if not slots:
+                dropped.append(node)
+                continue
+            first = min(slots)
+            order = (first, slots[first])
+            data = self.slot_graphs[max(slots)]._node[node].copy()
+            data["frequency"] = sum(self.slot_graphs[slot]._node[node]
+                ["frequency"] for slot in sorted(slots))
+            if node not in nodes:
+                succ[node] = {}
+                pred[node] = {}
+            nodes[node] = data
+            if self.node_order.get(node) != order:
+                self.node_order[node] = order
+                moved.append(node)
+        self.unranked.update(touched_nodes)
+
+        reordered_succ = set()
+        reordered_pred = set()
+        for edge in touched_edges:
+            u, v = edge
+            slots = self.edge_slots[edge]
+            if not slots:
+                del self.edge_slots[edge]
+                del self.edge_order[edge]
+                del succ[u][v]
+                del pred[v][u]
+                continue
+            first = min(slots)
+            order = (first, slots[first])
+            if edge not in self.edge_order:
+                # the edges of critical paths have no attributes
+                succ[u][v] = {}
+                pred[v][u] = succ[u][v]
+            if self.edge_order.get(edge) != order:
+                self.edge_order[edge] = order
+                reordered_succ.add(u)
+                reordered_pred.add(v)
+
+        for node in dropped:
+            del self.node_slots[node]
+            del self.node_order[node]
+            del nodes[node]
+            del succ[node]
+            del pred[node]
+
+        if moved:
+            order = sorted(self.node_order, key = self.node_order.get)
+            for mapping in [nodes, succ, pred]:
+                items = [(node, mapping[node]) for node in order]
+                mapping.clear()
+                mapping.update(items)
+            # predecessors that come from earlier attack graphs are in node
+            # order
+            for node in moved:
+                reordered_pred.update(succ[node])
+        if relast:
+            reordered_pred.update(v for (u, v), order in
+                self.edge_order.items() if order[0] in relast)
+
+        for u in reordered_succ:
+            if u in succ:
+                self._reorder(succ[u], lambda v: self.edge_order[(u, v)])
+        last = self.slots[self.keys[-1]] if self.keys else None
+        for v in reordered_pred:
+            if v in pred:
+                self._reorder(pred[v], lambda u: self._pred_order(u, v, last))
+
+    def _pred_order(self, u, v, last):
+        # the predecessors the last attack graph adds follow the others in
+        # the order of that attack graph
+        first, i = self.edge_order[(u, v)]
+        return (1, i) if first == last else (0, self.node_order[u])
+
+    @staticmethod
+    def _reorder(mapping, key):
+        items = sorted(mapping.items(), key = lambda item: key(item[0]))
+        mapping.clear()
+        mapping.update(items)
+
+    def find_critical_attack_step(self, metric):
+        '''
+        Rank the attack steps of the merged graph like its
+        find_critical_attack_step does. The ranking by frequency is kept
+        between updates and only the attack steps that changed are moved,
+        unless most of them did.
+        '''
+        if metric != 'frequency':
+            return self.graph.find_critical_attack_step(metric)
+        logging.debug("Find critical attack step according to metric: " +
+            f"{metric}, incrementally")
+        nodes = self.graph._node
+        if self.ranking is None or len(self.unranked) > len(nodes) // 4:
+            # sorting from scratch is cheaper than moving most of the steps
+            self.rank_entries = {node: (-data["frequency"],
+                self.node_order[node], node) for node, data in nodes.items()
+                if not data["isDefense"]}
+            self.ranking = sorted(self.rank_entries.values())
+        else:
+            for node in self.unranked:
+                entry = self.rank_entries.pop(node, None)
+                if entry is not None:
+                    del self.ranking[bisect.bisect_left(self.ranking, entry)]
+                if node in nodes and not nodes[node]["isDefense"]:
+                    entry = (-nodes[node]["frequency"], self.node_order[node],
+                        node)
+                    self.rank_entries[node] = entry
+                    bisect.insort(self.ranking, entry)
+        self.unranked = set()
+
+        nodes_sorted = [entry[2] for entry in self.ranking]
+        self.graph.set_ranking(nodes_sorted, dense_scores(np.array(
+            [nodes[node]["frequency"] for node in nodes_sorted])))
+        return 0
+
+
+def attack_graph_differences(graph, expected, limit = 10):
+    '''
+    Describe up to limit differences between the ranked attack graph and
+    the expected one, in the order and attributes of the nodes, the order
+    of the successors and predecessors of every node and the ranking. The
+    ref that apply_defense writes into the nodes is not compared.
+    '''
+    differences = []
+    if list(graph._node) != list(expected._node):
+        differences.append('the nodes differ: ' +
+            f'{len(graph._node.keys() - expected._node.keys())} extra, ' +
+            f'{len(expected._node.keys() - graph._node.keys())} missing, ' +
+            'or they are in a different order')
+    for node, data in expected._node.items():
+        if node not in graph._node:
+            continue
+        attributes = {key: value for key, value in graph._node[node].items()
+            if key != "ref"}
+        if attributes != {key: value for key, value in data.items()
+            if key != "ref"}:
+            differences.append(f'the attributes of {node} differ: ' +
+                f'{attributes} instead of {data}')
+        for name, adjacency in [("successors", "_succ"),
+            ("predecessors", "_pred")]:
+            if list(getattr(graph, adjacency)[node]) != \
+                list(getattr(expected, adjacency)[node]):
+                differences.append(f'the {name} of {node} differ: ' +
+                    f'{list(getattr(graph, adjacency)[node])} instead of ' +
+                    f'{list(getattr(expected, adjacency)[node])}')
+    if graph.nodes_sorted != expected.nodes_sorted:
+        differences.append('the ranking differs')
+    return differences[:limit]
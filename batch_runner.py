@@ -0,0 +1,213 @@
+from analyser import SUCCESS, ERROR_INCORRECT_CONFIG, ERROR_FAILED_SIM, \
+    ERROR_NO_DEFENCE, ERROR_UNKNOWN_METRIC, get_language_metadata, \
+    open_client, parse_arguments, run_coa, update_costs_from_file
+from attack_graph import build_defense_index
+from json_helpers import read_json_file, write_json_file_atomic
+from simulation_cache import SimulationCache
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import configparser
+import copy
+import os
+import sys
+import time
+
+ERROR_FAILED_JOBS = 1
+ERROR_INCORRECT_MANIFEST = 2
+
+STATUS_NAMES = {
+    SUCCESS: "success",
+    ERROR_INCORRECT_CONFIG: "incorrect_config",
+    ERROR_FAILED_SIM: "failed_simulation",
+    ERROR_NO_DEFENCE: "no_defense",
+    ERROR_UNKNOWN_METRIC: "unknown_metric",
+    # run_coa returns nothing when it runs out of iterations
+    None: "max_iterations",
+}
+
+# language metadata and its defense index, set up once per worker process
+shared_lang_meta = None
+shared_defense_index = None
+
+
+def init_worker(lang_meta, defense_index):
+    global shared_lang_meta, shared_defense_index
+    shared_lang_meta = lang_meta
+    shared_defense_index = defense_index
+
+
+def job_arguments(job, job_dir, arguments):
+    '''
+    Command line arguments of the analyser for the job, writing all of its
+    files into job_dir.
+    '''
+    argv = ["-l", os.path.join(job_dir, "log.txt"),
+        "--metricsfile", os.path.join(job_dir, "metrics.json"),
+        "-r", os.path.join(job_dir, "results.json"),
+        "-j", os.path.join(job_dir, "results.jsonl"),
+        "-s", os.path.join(job_dir, "checkpoint.json")]
+    if "budget" in job:
+        argv += ["-b", str(job["budget"])]
+    if "metric" in job:
+        argv += ["-m", job["metric"]]
+    return argv + arguments + job.get("arguments", [])
+
+
+def job_config(job, configfile):
+    '''
+    The configuration of the job: the enterprise client section of the
+    configuration file and the project settings of the job.
+    '''
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    config["project"] = {"name": job["project"],
+        "scenario": job["scenario"]}
+    for key in ["model", "simID"]:
+        if key in job:
+            config["project"][key] = str(job[key])
+    return config
+
+
+def run_job(job, argv, configfile):
+    '''
+    Run a single job in a worker process on its own copy of the shared
+    language metadata, since the use counters of the defenses are written
+    into it. The defense index is copied along with it, so that it refers
+    to the copy. Returns the status of the job and its wall time.
+    '''
+    start = time.perf_counter()
+    lang_meta, defense_index = copy.deepcopy((shared_lang_meta,
+        shared_defense_index))
+    status = run_coa(parse_arguments(argv), job_config(job, configfile),
+        lang_meta, defense_index)
+    return status, time.perf_counter() - start
+
+
+def read_manifest(manifestfile):
+    '''
+    Read and check the manifest, a JSON file holding the list of "jobs" and
+    optionally the "arguments" passed to the analyser for all of them.
+    Every job has a unique "name", a "project", a "scenario" and a "model"
+    or "simID", and optionally a "budget", a "metric" and "arguments" of
+    its own. Returns the manifest, or None if it is incorrect.
+    '''
+    manifest = read_json_file(manifestfile)
+    if not manifest or not isinstance(manifest.get("jobs"), list):
+        print(f'No list of jobs found in the manifest {manifestfile}.')
+        return None
+    names = set()
+    for i, job in enumerate(manifest["jobs"]):
+        missing = [key for key in ["name", "project", "scenario"]
+            if not job.get(key)]
+        if not job.get("model") and not job.get("simID"):
+            missing.append("model or simID")
+        if missing:
+            print(f'Job {i} of the manifest is missing: ' +
+                ", ".join(missing))
+            return None
+        if job["name"] in names:
+            print(f'Job name {job["name"]} is used more than once.')
+            return None
+        names.add(job["name"])
+    return manifest
+
+
+def write_summary(summaryfile, summary):
+    print(f'{"job":<24} {"status":<18} {"wall time":>10}')
+    for name, outcome in summary["jobs"].items():
+        print(f'{name:<24} {outcome["status"]:<18} ' +
+            f'{outcome["wall_time"]:>9.1f}s')
+    print(f'{len(summary["jobs"])} jobs in {summary["wall_time"]:.1f}s, ' +
+        f'{summary["failed"]} failed.')
+    write_json_file_atomic(summaryfile, summary, indent = 4)
+
+
+def run_batch():
+    parser = argparse.ArgumentParser(description='Run the analyser for ' +
+        'every job of a manifest on a pool of processes, sharing the ' +
+        'language metadata between them.')
+    parser.add_argument('manifestfile',
+        help='filename of the JSON manifest listing the jobs')
+    parser.add_argument('-c', '--configfile', default='coa.ini',
+        help='filename of the configuration holding the enterprise ' +
+            'client settings (default: %(default)s)')
+    parser.add_argument('-o', '--costsfile',
+        help='filename of the costs applied to the language metadata of ' +
+            'all the jobs')
+    parser.add_argument('-d', '--output_dir', default='batch',
+        help='directory the files of every job are written to, in a ' +
+            'subdirectory named after the job (default: %(default)s)')
+    parser.add_argument('-w', '--max_workers', type=int, default=2,
+        help='number of jobs that run concurrently (default: %(default)s)')
+    parser.add_argument('--summaryfile', default=None,
+        help='filename to use for the summary of the jobs ' +
+            '(default: summary.json in the output directory)')
+
+    args = vars(parser.parse_args())
+    manifest = read_manifest(args['manifestfile'])
+    if manifest is None:
+        return ERROR_INCORRECT_MANIFEST
+    arguments = manifest.get("arguments", [])
+
+    jobs = []
+    for job in manifest["jobs"]:
+        job_dir = os.path.join(args['output_dir'], job["name"])
+        argv = job_arguments(job, job_dir, arguments)
+        # invalid arguments exit here rather than in a worker
+        parse_arguments(argv)
+        jobs.append((job, job_dir, argv))
+
+    # the language metadata is downloaded the way the jobs would, through
+    # the cache, recording or replay the arguments of all of them ask for
+    shared_args = parse_arguments(arguments)
+    config = configparser.ConfigParser()
+    config.read(args['configfile'])
+    cache = SimulationCache(shared_args['cache_dir'],
+        shared_args['cache_size'] << 20) if shared_args['cache_dir'] else None
+    lang_meta = get_language_metadata(open_client(shared_args, config), cache,
+        config.get("enterprise-client", "url", fallback = None),
+        shared_args['language_version'], shared_args['refresh_metadata'])
+    if args['costsfile']:
+        update_costs_from_file(args['costsfile'], lang_meta)
+    defense_index = build_defense_index(lang_meta)
+
+    start = time.perf_counter()
+    summary = {"jobs": {}}
+    # every worker runs a single job, so nothing a job leaves behind in
+    # its process carries over to the next one
+    with ProcessPoolExecutor(max_workers = args['max_workers'],
+        initializer = init_worker, initargs = (lang_meta, defense_index),
+        max_tasks_per_child = 1) as executor:
+        futures = {}
+        for job, job_dir, argv in jobs:
+            os.makedirs(job_dir, exist_ok = True)
+            futures[executor.submit(run_job, job, argv,
+                args['configfile'])] = job
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                status, wall_time = future.result()
+                outcome = {"status": STATUS_NAMES.get(status, str(status)),
+                    "return_code": status, "wall_time": round(wall_time, 3)}
+            except Exception as e:
+                outcome = {"status": "exception", "return_code": None,
+                    "error": repr(e), "wall_time": 0}
+            metrics = read_json_file(os.path.join(args['output_dir'],
+                job["name"], "metrics.json"))
+            if metrics:
+                outcome["phases"] = metrics["phases"]
+            summary["jobs"][job["name"]] = outcome
+
+    # report the jobs in the order of the manifest
+    summary["jobs"] = {job["name"]: summary["jobs"][job["name"]]
+        for job, job_dir, argv in jobs}
+    summary["wall_time"] = round(time.perf_counter() - start, 3)
+    summary["failed"] = sum(1 for outcome in summary["jobs"].values()
+        if outcome["status"] != "success")
+    write_summary(args['summaryfile'] or
+        os.path.join(args['output_dir'], "summary.json"), summary)
+    return ERROR_FAILED_JOBS if summary["failed"] else SUCCESS
+
+
+if __name__ == "__main__":
+    sys.exit(run_batch())
@@ -0,0 +1,244 @@
+from attack_graph import AttackGraph, CompactAttackGraph, \
+    build_defense_index, build_model_index, merge_attack_graphs
+from graph_generator import generate_attack_graph, generate_critical_paths, \
+    generate_lang_meta, generate_merged_graph
+from json_helpers import read_json_file, write_json_file_atomic
+import argparse
+import logging
+import random
+import sys
+import time
+import tracemalloc
+
+SUCCESS = 0
+ERROR_REGRESSION = 1
+ERROR_BASELINE_MISMATCH = 2
+
+GRAPH_BACKENDS = {"networkx": AttackGraph, "compact": CompactAttackGraph}
+
+# differences below these are considered noise whatever the tolerance
+NOISE_FLOOR = {"time": 0.001, "peak_memory": 64 << 10}
+
+
+def setup_get_params_from_json(size, rnd, params):
+    '''
+    Parse the critical paths of a synthetic model into attack graphs.
+    '''
+    lang_meta = generate_lang_meta(rnd, params["suppression_rate"])
+    nodes, links, model_dict_list = generate_attack_graph(size, rnd,
+        params["branching"], params["defense_density"])
+    crit_paths = generate_critical_paths(nodes, links, params["targets"])
+    defense_index = build_defense_index(lang_meta)
+    graph_class = GRAPH_BACKENDS[params["graph_backend"]]
+
+    def run():
+        for target in crit_paths:
+            graph_class(crit_paths, target, lang_meta, defense_index)
+
+    return run, sum(len(path["nodes"]) for path in crit_paths.values())
+
+
+def setup_merge_attack_graphs(size, rnd, params):
+    '''
+    Merge the overlapping attack graphs of the critical paths of a
+    synthetic model.
+    '''
+    lang_meta = generate_lang_meta(rnd, params["suppression_rate"])
+    nodes, links, model_dict_list = generate_attack_graph(size, rnd,
+        params["branching"], params["defense_density"])
+    crit_paths = generate_critical_paths(nodes, links, params["targets"])
+    defense_index = build_defense_index(lang_meta)
+    graph_class = GRAPH_BACKENDS[params["graph_backend"]]
+    attack_graphs = [graph_class(crit_paths, target, lang_meta,
+        defense_index) for target in crit_paths]
+
+    def run():
+        merge_attack_graphs(attack_graphs)
+
+    return run, sum(graph.number_of_nodes() for graph in attack_graphs)
+
+
+def setup_find_critical_attack_step(size, rnd, params,
+    metric = "frequency"):
+    '''
+    Rank the attack steps of a synthetic merged attack graph.
+    '''
+    graph_class = GRAPH_BACKENDS[params["graph_backend"]]
+    graph, lang_meta, model_dict_list = generate_merged_graph(size, rnd,
+        params["branching"], params["defense_density"],
+        params["suppression_rate"], graph_class)
+
+    def run():
+        graph.find_critical_attack_step(metric)
+
+    return run, graph.number_of_nodes()
+
+
+def setup_weighted_out_degrees(size, rnd, params):
+    return setup_find_critical_attack_step(size, rnd, params,
+        "weighted_out_degrees")
+
+
+def setup_path_count(size, rnd, params):
+    return setup_find_critical_attack_step(size, rnd, params, "path_count")
+
+
+def setup_ttc_weighted_path_count(size, rnd, params):
+    return setup_find_critical_attack_step(size, rnd, params,
+        "ttc_weighted_path_count")
+
+
+def setup_find_best_defense(size, rnd, params):
+    '''
+    Worst case defense selection: the budget is too low for any defense,
+    so every defense of every ranked attack step is evaluated.
+    '''
+    graph_class = GRAPH_BACKENDS[params["graph_backend"]]
+    graph, lang_meta, model_dict_list = generate_merged_graph(size, rnd,
+        params["branching"], params["defense_density"],
+        params["suppression_rate"], graph_class)
+    graph.find_critical_attack_step("frequency")
+    defense_index = build_defense_index(lang_meta)
+    model_index = build_model_index(model_dict_list)
+
+    def run():
+        graph.find_best_defense(lang_meta, model_index, 0, None,
+            defense_index)
+
+    return run, graph.number_of_nodes()
+
+
+BENCHMARKS = {
+    "get_params_from_json": setup_get_params_from_json,
+    "merge_attack_graphs": setup_merge_attack_graphs,
+    "find_critical_attack_step": setup_find_critical_attack_step,
+    "weighted_out_degrees": setup_weighted_out_degrees,
+    "path_count": setup_path_count,
+    "ttc_weighted_path_count": setup_ttc_weighted_path_count,
+    "find_best_defense": setup_find_best_defense,
+}
+
+
+def run_benchmark(name, size, seed, repeat, params):
+    '''
+    Return the best wall time out of repeat runs of the benchmark, the
+    peak memory allocated by one more run traced with tracemalloc, and the
+    number of nodes the benchmark works on. Generating the input is not
+    measured.
+    '''
+    run, nodes = BENCHMARKS[name](size, random.Random(seed), params)
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+
+    # tracing slows the code down, so memory is measured separately
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        run()
+        peak_memory = tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return min(timings), peak_memory, nodes
+
+
+def find_regressions(measurements, baseline, tolerance):
+    regressions = []
+    for key, measurement in measurements.items():
+        if key not in baseline:
+            continue
+        for quantity in ["time", "peak_memory"]:
+            limit = max(baseline[key][quantity] * (1 + tolerance),
+                baseline[key][quantity] + NOISE_FLOOR[quantity])
+            if measurement[quantity] > limit:
+                regressions.append(f'{key} {quantity}: ' +
+                    f'{measurement[quantity]:.6g} exceeds the baseline ' +
+                    f'{baseline[key][quantity]:.6g} by more than ' +
+                    f'{tolerance:.0%}')
+    return regressions
+
+
+def run_benchmarks():
+    parser = argparse.ArgumentParser(description='Benchmark the ' +
+        'attack_graph module on synthetic attack graphs.')
+    parser.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS),
+        metavar='benchmark', help='benchmarks to run, out of ' +
+            ", ".join(BENCHMARKS) + ' (default: all of them)')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+        default=[100, 1000, 10000, 100000],
+        help='graph sizes in nodes (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='number of timed runs per size, the best one is reported ' +
+            '(default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+        help='seed of the synthetic graph generator (default: %(default)s)')
+    parser.add_argument('--branching', type=int, default=2,
+        help='number of attack steps of earlier objects every object is ' +
+            'reached from (default: %(default)s)')
+    parser.add_argument('--defense_density', type=float, default=0.3,
+        help='probability of an object having each of the defenses ' +
+            '(default: %(default)s)')
+    parser.add_argument('--suppression_rate', type=float, default=0.1,
+        help='probability of a defense being suppressed in the language ' +
+            '(default: %(default)s)')
+    parser.add_argument('--targets', type=int, default=10,
+        help='number of critical paths cut out of the graph ' +
+            '(default: %(default)s)')
+    parser.add_argument('--graph_backend', default='networkx',
+        choices=list(GRAPH_BACKENDS),
+        help='attack graph implementation to benchmark ' +
+            '(default: %(default)s)')
+    parser.add_argument('--baseline',
+        help='filename of a stored baseline to compare the results with')
+    parser.add_argument('--save_baseline',
+        help='filename to store the results in as a new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+        help='relative increase in time or peak memory over the baseline ' +
+            'that is reported as a regression (default: %(default)s)')
+
+    args = vars(parser.parse_args())
+    for name in args['benchmarks']:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark: {name}')
+    params = {name: args[name] for name in
+        ["seed", "repeat", "branching", "defense_density",
+        "suppression_rate", "targets", "graph_backend"]}
+    logging.disable(logging.CRITICAL)
+
+    baseline = None
+    if args['baseline']:
+        baseline = read_json_file(args['baseline'])
+        if baseline["parameters"] != params:
+            print(f'The baseline in {args["baseline"]} was measured with ' +
+                f'different parameters: {baseline["parameters"]}')
+            return ERROR_BASELINE_MISMATCH
+
+    measurements = {}
+    for name in args['benchmarks']:
+        for size in args['sizes']:
+            elapsed, peak_memory, nodes = run_benchmark(name, size,
+                args['seed'], args['repeat'], params)
+            measurements[f'{name}/{size}'] = {"time": elapsed,
+                "peak_memory": peak_memory, "nodes": nodes}
+            print(f'{name:<26} size={size:<8} nodes={nodes:<8} ' +
+                f'time={elapsed:.4f}s peak={peak_memory / 2**20:.1f}MiB')
+
+    if args['save_baseline']:
+        write_json_file_atomic(args['save_baseline'],
+            {"parameters": params, "measurements": measurements},
+            indent = 4)
+
+    if baseline is not None:
+        regressions = find_regressions(measurements,
+            baseline["measurements"], args['tolerance'])
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return ERROR_REGRESSION
+    return SUCCESS
+
+
+if __name__ == "__main__":
+    sys.exit(run_benchmarks())
@@ -0,0 +1,316 @@
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+from types import SimpleNamespace
+
+PROJECT_ATTRIBUTES = ["pid", "name"]
+SCENARIO_ATTRIBUTES = ["pid", "tid", "name"]
+
+
+class ReplayError(Exception):
+    '''
+    Raised when the replayed run makes a request that was not recorded.
+    '''
+    pass
+
+
+def request_key(call, *args):
+    '''
+    Identify a request by its kind and its arguments.
+    '''
+    content = json.dumps([call, *args], sort_keys = True)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def _attributes(obj, names):
+    return {name: getattr(obj, name) for name in names if hasattr(obj, name)}
+
+
+class RecordingClient:
+    '''
+    Wraps an enterprise client and records the response of every request
+    the analyser makes to a JSON lines archive, which ReplayClient serves
+    the run from again later without a server.
+
+    The critical paths are recorded per attack step, so that a replay does
+    not depend on how the paths were grouped into requests. Attributes the
+    analyser does not use are passed through to the client unrecorded.
+    A resumed run appends to the archive of the interrupted one.
+    '''
+
+    def __init__(self, client, archivefile, append = False):
+        self.client = client
+        self.archivefile = archivefile
+        self.lock = threading.Lock()
+        self.recorded = set()
+        if not append:
+            open(archivefile, 'w').close()
+        self.projects = SimpleNamespace(
+            get_project_by_name = self._get_project_by_name)
+        self.scenarios = SimpleNamespace(
+            get_scenario_by_name = self._get_scenario_by_name)
+        self.models = SimpleNamespace(
+            get_model_by_name = self._get_model_by_name)
+        self.simulations = SimpleNamespace(
+            create_simulation = self._create_simulation,
+            get_simulation_by_simid = self._get_simulation_by_simid)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def record(self, call, key, response, once = False):
+        '''
+        Append a response to the archive. Responses recorded once are only
+        written the first time their key is seen, e.g. the results of a
+        simulation that are requested again by a resumed run.
+        '''
+        with self.lock:
+            if once:
+                if key in self.recorded:
+                    return
+                self.recorded.add(key)
+            with open(self.archivefile, 'a') as f:
+                f.write(json.dumps({"call": call, "key": key,
+                    "response": response}, separators = (',', ':')) + "\n")
+
+    def _get(self, path, *args, **kwargs):
+        response = self.client._get(path, *args, **kwargs)
+        self.record("get", request_key("get", path), response)
+        return response
+
+    def _post(self, path, data = None, *args, **kwargs):
+        response = self.client._post(path, data, *args, **kwargs)
+        self.record("post", request_key("post", path, data), response)
+        return response
+
+    def _get_project_by_name(self, name):
+        project = self.client.projects.get_project_by_name(name = name)
+        self.record("project", request_key("project", name),
+            _attributes(project, PROJECT_ATTRIBUTES))
+        return project
+
+    def _get_scenario_by_name(self, project, name):
+        scenario = self.client.scenarios.get_scenario_by_name(
+            project = project, name = name)
+        self.record("scenario",
+            request_key("scenario", getattr(project, "pid", None), name),
+            _attributes(scenario, SCENARIO_ATTRIBUTES))
+        return scenario
+
+    def _get_model_by_name(self, project, name):
+        modelinfo = self.client.models.get_model_by_name(project, name)
+        return RecordingModelInfo(self, modelinfo,
+            getattr(project, "pid", None), name)
+
+    def _create_simulation(self, scenario, name, model, raw_tunings):
+        simulation = self.client.simulations.create_simulation(scenario,
+            name = name, model = model, raw_tunings = raw_tunings)
+        self.record("create_simulation", request_key("create_simulation",
+            getattr(scenario, "tid", None), name, model.model, raw_tunings),
+            {"simid": simulation.simid, "name": name})
+        return RecordingSimulation(self, simulation)
+
+    def _get_simulation_by_simid(self, scenario, simid):
+        simulation = self.client.simulations.get_simulation_by_simid(
+            scenario, simid)
+        self.record("simulation", request_key("simulation", simid),
+            {"simid": simid, "name": getattr(simulation, "name", None)},
+            once = True)
+        return RecordingSimulation(self, simulation)
+
+
+class RecordingModelInfo:
+
+    def __init__(self, recorder, modelinfo, pid, name):
+        self.recorder = recorder
+        self.modelinfo = modelinfo
+        self.pid = pid
+        self.name = name
+
+    def get_model(self):
+        model = self.modelinfo.get_model()
+        self.recorder.record("model",
+            request_key("model", self.pid, self.name), model.model,
+            once = True)
+        return model
+
+    def get_scad(self):
+        scad = self.modelinfo.get_scad()
+        self.recorder.record("scad",
+            request_key("scad", self.pid, self.name),
+            base64.b64encode(scad).decode("ascii"), once = True)
+        return scad
+
+
+class RecordingSimulation:
+
+    def __init__(self, recorder, simulation):
+        self.recorder = recorder
+        self.simulation = simulation
+
+    def __getattr__(self, name):
+        return getattr(self.simulation, name)
+
+    def get_results(self):
+        simres = self.simulation.get_results()
+        if simres:
+            self.recorder.record("results",
+                request_key("results", self.simulation.simid), simres,
+                once = True)
+        return simres
+
+    def get_critical_paths(self, risks):
+        crit_paths = self.simulation.get_critical_paths(risks)
+        for attackstep_id, crit_path in crit_paths.items():
+            self.recorder.record("critical_path", request_key(
+                "critical_path", self.simulation.simid, attackstep_id),
+                crit_path, once = True)
+        return crit_paths
+
+
+class ReplayClient:
+    '''
+    Stand-in for the enterprise client that serves the responses recorded
+    by RecordingClient. Every request is delayed by latency seconds and
+    the results of a simulation only become available simulation_time
+    seconds after it was created, with the progress reported accordingly.
+
+    Requests that were recorded several times, such as simulations that
+    were created again, are answered in the order they were recorded, the
+    last response being repeated once they run out.
+
+    Models are served as their recorded model dictionary, the only part of
+    a securiCAD model the analyser uses, so replaying a run of a model
+    given by name does not need the securiCAD SDK.
+    '''
+
+    def __init__(self, archivefile, latency = 0, simulation_time = 0):
+        self.latency = latency
+        self.simulation_time = simulation_time
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.names = {}
+        self.created = {}
+        with open(archivefile, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a torn last record left behind by a crash
+                    break
+                self.responses.setdefault(record["key"], []).append(
+                    record["response"])
+                if record["call"] in ["create_simulation", "simulation"]:
+                    self.names.setdefault(record["response"]["simid"],
+                        record["response"]["name"])
+        logging.info(f'Replaying {len(self.responses)} recorded requests ' +
+            f'from {archivefile}.')
+        self.projects = SimpleNamespace(
+            get_project_by_name = self._get_project_by_name)
+        self.scenarios = SimpleNamespace(
+            get_scenario_by_name = self._get_scenario_by_name)
+        self.models = SimpleNamespace(
+            get_model_by_name = self._get_model_by_name)
+        self.simulations = SimpleNamespace(
+            create_simulation = self._create_simulation,
+            get_simulation_by_simid = self._get_simulation_by_simid)
+
+    def respond(self, call, key, default = ReplayError):
+        time.sleep(self.latency)
+        return self.lookup(call, key, default)
+
+    def lookup(self, call, key, default = ReplayError):
+        with self.lock:
+            responses = self.responses.get(key)
+            if not responses:
+                if default is ReplayError:
+                    raise ReplayError(f'No recorded response for {call} ' +
+                        'request.')
+                return default
+            return responses.pop(0) if len(responses) > 1 else responses[0]
+
+    def _get(self, path, *args, **kwargs):
+        return self.respond("get " + path, request_key("get", path))
+
+    def _post(self, path, data = None, *args, **kwargs):
+        return self.respond("post " + path, request_key("post", path, data))
+
+    def _get_project_by_name(self, name):
+        return SimpleNamespace(**self.respond("project",
+            request_key("project", name)))
+
+    def _get_scenario_by_name(self, project, name):
+        return SimpleNamespace(**self.respond("scenario",
+            request_key("scenario", getattr(project, "pid", None), name)))
+
+    def _get_model_by_name(self, project, name):
+        return ReplayModelInfo(self, getattr(project, "pid", None), name)
+
+    def _create_simulation(self, scenario, name, model, raw_tunings):
+        response = self.respond("create_simulation " + name,
+            request_key("create_simulation", getattr(scenario, "tid", None),
+            name, model.model, raw_tunings))
+        with self.lock:
+            self.created[response["simid"]] = time.monotonic()
+        return ReplaySimulation(self, response["simid"], name)
+
+    def _get_simulation_by_simid(self, scenario, simid):
+        time.sleep(self.latency)
+        if simid not in self.names:
+            raise ReplayError(f'No recorded simulation with simulation id ' +
+                f'{simid}.')
+        with self.lock:
+            self.created.setdefault(simid, time.monotonic())
+        return ReplaySimulation(self, simid, self.names[simid])
+
+
+class ReplayModelInfo:
+
+    def __init__(self, replay, pid, name):
+        self.replay = replay
+        self.pid = pid
+        self.name = name
+
+    def get_model(self):
+        return SimpleNamespace(model = self.replay.respond("model",
+            request_key("model", self.pid, self.name)))
+
+    def get_scad(self):
+        return base64.b64decode(self.replay.respond("scad",
+            request_key("scad", self.pid, self.name)))
+
+
+class ReplaySimulation:
+
+    def __init__(self, replay, simid, name):
+        self.replay = replay
+        self.simid = simid
+        self.name = name
+
+    def elapsed(self):
+        return time.monotonic() - self.replay.created[self.simid]
+
+    @property
+    def progress(self):
+        if not self.replay.simulation_time:
+            return 100
+        return min(100,
+            int(self.elapsed() / self.replay.simulation_time * 100))
+
+    def get_results(self):
+        time.sleep(max(0, self.replay.simulation_time - self.elapsed()))
+        return self.replay.respond("results",
+            request_key("results", self.simid))
+
+    def get_critical_paths(self, risks):
+        time.sleep(self.replay.latency)
+        crit_paths = {}
+        for attackstep_id in risks:
+            crit_path = self.replay.lookup("critical_path", request_key(
+                "critical_path", self.simid, attackstep_id), None)
+            if crit_path is not None:
+                crit_paths[attackstep_id] = crit_path
+        return crit_paths
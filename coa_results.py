@@ -0,0 +1,147 @@
+from json_helpers import read_json_file, write_json_file_atomic
+import argparse
+
+COMPACT_FORMAT = "compact"
+
+
+def is_compact(results):
+    return results.get("format") == COMPACT_FORMAT
+
+
+def compact_results(results):
+    '''
+    Convert results in the regular format into the compact format, where
+    every CoA only holds the defense it added ("defense" instead of the
+    full "defenses" list, or "addedDefenses" if it added several of them
+    at once) and the TTCs that changed since the previous CoA,
+    or since the initial TTCs for the first one. Risks that disappeared are
+    listed in "removedTTC". All the other fields are kept as they are.
+    '''
+    compact = {"format": COMPACT_FORMAT}
+    previous_ttcs = results.get("initial_TTC", {})
+    previous_defenses = []
+    for key, value in results.items():
+        if key != "CoAs":
+            compact[key] = value
+            continue
+        compact["CoAs"] = []
+        for coa in value:
+            compact_coa = {}
+            for coa_key, coa_value in coa.items():
+                if coa_key == "defenses":
+                    added = coa_value[len(previous_defenses):]
+                    if len(added) == 1:
+                        compact_coa["defense"] = added[0]
+                    else:
+                        compact_coa["addedDefenses"] = added
+                    previous_defenses = coa_value
+                elif coa_key == "coaTTC":
+                    compact_coa["coaTTC"] = {risk: ttc for risk, ttc in
+                        coa_value.items() if previous_ttcs.get(risk) != ttc}
+                    removed = [risk for risk in previous_ttcs
+                        if risk not in coa_value]
+                    if removed:
+                        compact_coa["removedTTC"] = removed
+                    previous_ttcs = coa_value
+                else:
+                    compact_coa[coa_key] = coa_value
+            compact["CoAs"].append(compact_coa)
+    return compact
+
+
+def expand_results(compact):
+    '''
+    Convert results in the compact format back into the regular format.
+    '''
+    results = {}
+    for key, value in compact.items():
+        if key == "format":
+            continue
+        if key == "CoAs":
+            results["CoAs"] = list(CompactResults(compact).coas())
+        else:
+            results[key] = value
+    return results
+
+
+class CompactResults:
+    '''
+    Read access to results in the compact format, expanding individual CoAs
+    to the regular format on demand.
+    '''
+
+    def __init__(self, compact):
+        if not is_compact(compact):
+            raise ValueError('The results are not in the compact format.')
+        self.compact = compact
+
+    def __len__(self):
+        return len(self.compact["CoAs"])
+
+    def coa(self, index):
+        '''
+        Return the CoA at the given index in the regular format, that is
+        with all the defenses applied so far and the TTCs of all the risks.
+        '''
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('CoA index out of range')
+        defenses = []
+        ttcs = dict(self.compact.get("initial_TTC", {}))
+        for compact_coa in self.compact["CoAs"][:index + 1]:
+            self._accumulate(compact_coa, defenses, ttcs)
+        return self._expand(self.compact["CoAs"][index], defenses, ttcs)
+
+    def coas(self):
+        '''
+        Generator yielding every CoA in the regular format.
+        '''
+        defenses = []
+        ttcs = dict(self.compact.get("initial_TTC", {}))
+        for compact_coa in self.compact["CoAs"]:
+            self._accumulate(compact_coa, defenses, ttcs)
+            yield self._expand(compact_coa, defenses, ttcs)
+
+    @staticmethod
+    def _accumulate(compact_coa, defenses, ttcs):
+        if "defense" in compact_coa:
+            defenses.append(compact_coa["defense"])
+        defenses.extend(compact_coa.get("addedDefenses", []))
+        if "coaTTC" in compact_coa:
+            for risk in compact_coa.get("removedTTC", []):
+                del ttcs[risk]
+            ttcs.update(compact_coa["coaTTC"])
+
+    @staticmethod
+    def _expand(compact_coa, defenses, ttcs):
+        coa = {}
+        for key, value in compact_coa.items():
+            if key in ["defense", "addedDefenses"]:
+                coa["defenses"] = list(defenses)
+            elif key == "coaTTC":
+                coa["coaTTC"] = dict(ttcs)
+            elif key != "removedTTC":
+                coa[key] = value
+        return coa
+
+
+def convert_results():
+    parser = argparse.ArgumentParser(description='Convert results between ' +
+        'the regular and the compact format.')
+    parser.add_argument('inputfile',
+        help='filename of the results to convert')
+    parser.add_argument('outputfile',
+        help='filename to write the converted results to')
+    args = vars(parser.parse_args())
+
+    results = read_json_file(args['inputfile'])
+    if is_compact(results):
+        converted = expand_results(results)
+    else:
+        converted = compact_results(results)
+    write_json_file_atomic(args['outputfile'], converted, indent = 4)
+
+
+if __name__ == "__main__":
+    convert_results()
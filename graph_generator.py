@@ -0,0 +1,125 @@
+from attack_graph import AttackGraph, build_defense_index
+
+ASSET_CLASSES = ["Host", "Network", "Application", "Data", "Identity"]
+DEFENSES = ["patched", "encrypted", "firewall", "hardened", "monitored"]
+ATTACK_STEPS = ["access", "compromise", "read", "write", "deny"]
+
+
+def generate_lang_meta(rnd, suppression_rate = 0.1):
+    '''
+    Generate language metadata covering the synthetic asset classes, where
+    every defense is suppressed with the given probability.
+    '''
+    lang_meta = {"assets": {}}
+    for asset in ASSET_CLASSES:
+        defenses = []
+        for i, name in enumerate(DEFENSES):
+            defenses.append({"name": name,
+                "tags": ["suppress"] if rnd.random() < suppression_rate else [],
+                "metaInfo": {"cost": [str(50 + 10 * i), str(100 + 10 * i)]}})
+        lang_meta["assets"][asset] = {"defenses": defenses}
+    return lang_meta
+
+
+def generate_attack_graph(size, rnd, branching = 2, defense_density = 0.3):
+    '''
+    Generate the nodes and links of a synthetic attack graph with roughly
+    size nodes, in the format of the critical paths returned by securiCAD,
+    together with the matching model dictionary list.
+
+    Every object contributes a chain of attack steps, the first of which
+    is reached from up to branching attack steps of earlier objects.
+    Defenses are attached as predecessors of attack steps of the same
+    object, each with the probability defense_density.
+    '''
+    nodes = []
+    links = []
+    model_dict_list = []
+    steps = []
+    eid = 0
+    while len(nodes) < size:
+        eid += 1
+        asset_class = rnd.choice(ASSET_CLASSES)
+        model_dict_list.append({"name": f"Object{eid}",
+            "metaConcept": asset_class, "exportedId": str(eid),
+            "attributesJsonString": {"ref": f"ref{eid}"}})
+        object_steps = []
+        for attackstep in ATTACK_STEPS:
+            index = len(nodes) + 1
+            nodes.append({"index": index, "id": f"{eid}.{attackstep}",
+                "eid": str(eid), "name": f"({eid}) Object{eid}",
+                "class": asset_class, "attackstep": attackstep,
+                "frequency": rnd.randint(1, 100), "isDefense": False,
+                "ttc": rnd.random() * 10})
+            if object_steps:
+                links.append({"source": object_steps[-1], "target": index})
+            object_steps.append(index)
+        for defense in DEFENSES:
+            if rnd.random() >= defense_density:
+                continue
+            index = len(nodes) + 1
+            nodes.append({"index": index, "id": f"{eid}.{defense}",
+                "eid": str(eid), "name": f"({eid}) Object{eid}",
+                "class": asset_class, "attackstep": defense,
+                "frequency": rnd.randint(1, 100), "isDefense": True,
+                "ttc": 0})
+            links.append({"source": index,
+                "target": rnd.choice(object_steps)})
+        if steps:
+            for source in rnd.sample(steps, min(branching, len(steps))):
+                links.append({"source": source, "target": object_steps[0]})
+        steps.extend(object_steps)
+    return nodes, links, model_dict_list
+
+
+def generate_critical_paths(nodes, links, targets = 4):
+    '''
+    Cut the critical paths of targets attack steps, spread evenly over the
+    generated attack graph, out of it. The critical path of a target holds
+    all the attack steps it can be reached from and their defenses, so the
+    paths overlap like the ones of a real model do. Returns the paths keyed
+    by the id of their target, like get_critical_paths does.
+    '''
+    predecessors = {}
+    for link in links:
+        predecessors.setdefault(link["target"], []).append(link["source"])
+    steps = [node["index"] for node in nodes if not node["isDefense"]]
+
+    crit_paths = {}
+    for k in range(min(targets, len(steps))):
+        target = steps[(k + 1) * len(steps) // targets - 1]
+        reached = set()
+        stack = [target]
+        while stack:
+            index = stack.pop()
+            if index in reached:
+                continue
+            reached.add(index)
+            for source in predecessors.get(index, []):
+                if not nodes[source - 1]["isDefense"]:
+                    stack.append(source)
+        included = set(reached)
+        for index in reached:
+            included.update(predecessors.get(index, []))
+        crit_paths[nodes[target - 1]["id"]] = {
+            "nodes": [nodes[index - 1] for index in sorted(included)],
+            "links": [link for link in links if link["source"] in included
+                and link["target"] in reached]
+        }
+    return crit_paths
+
+
+def generate_merged_graph(size, rnd, branching = 2, defense_density = 0.3,
+    suppression_rate = 0.1, graph_class = AttackGraph):
+    '''
+    Generate a merged attack graph with roughly size nodes, together with
+    matching language metadata and model dictionary list. The graph is
+    parsed like a critical path by graph_class, so suppressed defenses are
+    left out.
+    '''
+    lang_meta = generate_lang_meta(rnd, suppression_rate)
+    nodes, links, model_dict_list = generate_attack_graph(size, rnd,
+        branching, defense_density)
+    graph = graph_class({"merged": {"nodes": nodes, "links": links}},
+        "merged", lang_meta, build_defense_index(lang_meta))
+    return graph, lang_meta, model_dict_list
@@ -0,0 +1,79 @@
+from json_helpers import write_json_file_atomic
+from contextlib import contextmanager
+import logging
+import time
+
+
+class PhaseTimer:
+    '''
+    Records the wall time spent in the phases of a run, such as waiting for
+    simulations, fetching critical paths or persisting results, both in
+    total and per iteration.
+
+    Time spent outside of an iteration, e.g. in the initial simulation, only
+    counts towards the totals. The metrics are written to metricsfile as
+    JSON at the end of every iteration, so they can be inspected while the
+    run is still going.
+    '''
+
+    def __init__(self, metricsfile = None):
+        self.metricsfile = metricsfile
+        self.start = time.perf_counter()
+        self.totals = {}
+        self.iterations = []
+        self.current = None
+        self.iteration_start = None
+
+    def start_iteration(self, iteration):
+        self.end_iteration()
+        self.current = {"iteration": iteration, "wall_time": 0,
+            "phases": {}}
+        self.iteration_start = time.perf_counter()
+
+    def end_iteration(self):
+        if self.current is None:
+            return
+        self.current["wall_time"] = round(
+            time.perf_counter() - self.iteration_start, 6)
+        self.iterations.append(self.current)
+        logging.info(f'Iteration {self.current["iteration"]} took ' +
+            f'{self.current["wall_time"]:.3f}s: ' +
+            ", ".join(f'{name} {elapsed:.3f}s' for name, elapsed in
+                self.current["phases"].items()))
+        self.current = None
+        self.write()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, elapsed):
+        self.totals[name] = round(self.totals.get(name, 0) + elapsed, 6)
+        if self.current is not None:
+            phases = self.current["phases"]
+            phases[name] = round(phases.get(name, 0) + elapsed, 6)
+
+    def metrics(self):
+        return {
+            "wall_time": round(time.perf_counter() - self.start, 6),
+            "phases": self.totals,
+            "iterations": self.iterations
+        }
+
+    def write(self):
+        if self.metricsfile:
+            write_json_file_atomic(self.metricsfile, self.metrics(),
+                indent = 4)
+
+    def close(self):
+        '''
+        End the current iteration, if any, and write the final metrics.
+        '''
+        if self.current is not None:
+            self.end_iteration()
+        else:
+            self.write()
@@ -1,6 +1,10 @@
+import codecs
 import json
 import os
 
+# the characters that can follow a value in a JSON document
+DELIMITERS = " \t\n\r,:]}"
+
 def read_json_file(filename):
     if os.path.isfile(filename):
         with open(filename, 'r') as json_file:
@@ -9,7 +13,131 @@ def read_json_file(filename):
         return {}
 
 
-def write_json_file(filename, data):
-    with open(filename, 'w') as f:
-        json.dump(data, f, indent=4)
+def write_json_file_atomic(filename, data, indent = None):
+    '''
+    Write the data to a temporary file first and move it over filename, so
+    that an interrupted write never leaves a truncated file behind.
+    '''
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, 'w') as f:
+        json.dump(data, f, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_filename, filename)
+
+
+class JsonStreamReader:
+    '''
+    Reads a JSON document from a binary or text stream a chunk at a time.
+    The objects and arrays of the document are walked with keys and
+    elements, and the values in them are decoded one at a time with
+    read_value or skipped with skip_value, so only the current value and a
+    chunk of the document are held in memory.
+    '''
+
+    def __init__(self, stream, chunk_size = 1 << 16):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.position = 0
+        self.end_of_stream = False
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+
+    def peek(self):
+        '''
+        Return the next character that is not whitespace without consuming
+        it, or an empty string at the end of the document.
+        '''
+        while True:
+            while self.position < len(self.buffer) and \
+                self.buffer[self.position] in " \t\n\r":
+                self.position += 1
+            if self.position < len(self.buffer) or not self._fill():
+                return self.buffer[self.position:self.position + 1]
+
+    def expect(self, characters):
+        '''
+        Consume the next character, which has to be one of characters, and
+        return it.
+        '''
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f'Expected one of {characters!r} in the JSON ' +
+                f'document but found {character or "its end"!r}.')
+        self.position += 1
+        return character
+
+    def keys(self):
+        '''
+        Walk an object, yielding its keys. The value of a key has to be
+        read or skipped before the next key is requested.
+        '''
+        self.expect("{")
+        if self.peek() == "}":
+            self.position += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def elements(self):
+        '''
+        Walk an array, yielding once for every element, which has to be
+        read or skipped before the next one is requested.
+        '''
+        self.expect("[")
+        if self.peek() == "]":
+            self.position += 1
+            return
+        while True:
+            yield
+            if self.expect(",]") == "]":
+                return
+
+    def read_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer,
+                    self.position)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a value is complete once a delimiter follows it, a number at
+            # the end of the buffer may go on in the next chunk
+            if (end < len(self.buffer) and self.buffer[end] in DELIMITERS) \
+                or not self._fill():
+                self.position = end
+                return value
+
+    def skip_value(self):
+        character = self.peek()
+        if character == "{":
+            for key in self.keys():
+                self.skip_value()
+        elif character == "[":
+            for element in self.elements():
+                self.skip_value()
+        else:
+            self.read_value()
 
+    def _fill(self):
+        '''
+        Append the next chunk of the stream to the buffer, dropping what was
+        consumed already. Returns False once the end of the stream was
+        reached before.
+        '''
+        if self.end_of_stream:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        self.end_of_stream = not chunk
+        if isinstance(chunk, bytes):
+            chunk = self.text_decoder.decode(chunk, final = self.end_of_stream)
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
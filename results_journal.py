@@ -0,0 +1,141 @@
+from coa_results import compact_results
+from json_helpers import write_json_file_atomic
+import argparse
+import copy
+import json
+import os
+
+
+def apply_record(results, record):
+    '''
+    Apply a single journal record to the results dictionary. This is the
+    only place where the journal records are interpreted, both while
+    running and when replaying a journal.
+    '''
+    match record["event"]:
+        case "snapshot":
+            results.clear()
+            results.update(copy.deepcopy(record["results"]))
+        case "set":
+            results[record["key"]] = record["value"]
+        case "initial_ttcs":
+            results["initial_TTC"] = record["ttcs"]
+        case "coa":
+            defenses = results["CoAs"][-1]["defenses"].copy() \
+                if results["CoAs"] else []
+            defenses.append(record["defense"])
+            results["CoAs"].append({"monetary_cost": {"1": record["cost"]},
+                "defenses": defenses})
+        case "coa_defense":
+            coa = results["CoAs"][-1]
+            coa["defenses"].append(record["defense"])
+            coa["monetary_cost"]["1"] += record["cost"]
+        case "coa_ttcs":
+            coa = results["CoAs"][record["coa"]]
+            coa.setdefault("coaTTC", {}).update(record["ttcs"])
+            coa["report_url"] = record["report_url"]
+        case "efficiency":
+            results["CoAs"][record["coa"]]["efficiency"] = record["efficiency"]
+        case _:
+            raise ValueError(f'Unknown journal record: {record["event"]}')
+
+
+def read_journal(journalfile, offset = None):
+    '''
+    Rebuild the results from the journal, optionally only from its first
+    offset bytes. A torn last record left behind by a crash is ignored.
+    '''
+    results = {"CoAs": [], "initial_TTC": {}}
+    with open(journalfile, 'rb') as f:
+        data = f.read() if offset is None else f.read(offset)
+    for line in data.splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            break
+        apply_record(results, record)
+    return results
+
+
+class ResultsJournal:
+    '''
+    Keeps the results of a run in memory and appends one compact record per
+    change to a JSON lines journal. Every record is flushed to disk before
+    the call returns, so the journal survives a crash at any point, and the
+    results file in the usual format is only written by write().
+    '''
+
+    def __init__(self, journalfile, results = None, offset = None):
+        '''
+        Start a new journal, or continue an existing one from the first
+        offset bytes, discarding whatever was recorded after them.
+        '''
+        self.journalfile = journalfile
+        if offset is None:
+            self.results = {"CoAs": [], "initial_TTC": {}}
+            self.f = open(journalfile, 'wb')
+            if results:
+                self._append({"event": "snapshot", "results": results})
+        else:
+            self.results = read_journal(journalfile, offset)
+            self.f = open(journalfile, 'r+b')
+            self.f.truncate(offset)
+            self.f.seek(offset)
+
+    def tell(self):
+        return self.f.tell()
+
+    def set(self, key, value):
+        self._append({"event": "set", "key": key, "value": value})
+
+    def set_initial_ttcs(self, ttcs):
+        self._append({"event": "initial_ttcs", "ttcs": ttcs})
+
+    def add_coa(self, cost, defense):
+        self._append({"event": "coa", "cost": cost, "defense": defense})
+
+    def extend_coa(self, cost, defense):
+        '''
+        Add another defense to the last CoA, for defenses that are
+        simulated together.
+        '''
+        self._append({"event": "coa_defense", "cost": cost,
+            "defense": defense})
+
+    def set_coa_ttcs(self, ttcs, report_url):
+        self._append({"event": "coa_ttcs", "coa": len(self.results["CoAs"]) - 1,
+            "ttcs": ttcs, "report_url": report_url})
+
+    def set_efficiency(self, efficiency):
+        self._append({"event": "efficiency",
+            "coa": len(self.results["CoAs"]) - 1, "efficiency": efficiency})
+
+    def write(self, resultsfile, compact = False):
+        results = compact_results(self.results) if compact else self.results
+        write_json_file_atomic(resultsfile, results, indent = 4)
+
+    def close(self):
+        self.f.close()
+
+    def _append(self, record):
+        apply_record(self.results, record)
+        self.f.write(json.dumps(record, separators = (',', ':'))
+            .encode("utf-8") + b"\n")
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+
+def convert_journal():
+    parser = argparse.ArgumentParser(description='Rebuild a results file ' +
+        'from a results journal, e.g. after an interrupted run.')
+    parser.add_argument('journalfile',
+        help='filename of the results journal')
+    parser.add_argument('resultsfile',
+        help='filename to write the results to')
+    args = vars(parser.parse_args())
+    write_json_file_atomic(args['resultsfile'],
+        read_journal(args['journalfile']), indent = 4)
+
+
+if __name__ == "__main__":
+    convert_journal()
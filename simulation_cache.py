@@ -0,0 +1,189 @@
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import threading
+
+DEFAULT_CACHE_SIZE = 1 << 30
+
+
+class SimulationCache:
+    '''
+    Content addressed on-disk cache for simulation results, critical paths
+    and language metadata.
+
+    Simulations are identified by a hash of the scenario, the model, the
+    tunings and the requested number of samples, so any run that submits
+    the same sequence of tunings on the same model can replay the
+    simulations from disk. Each cached item is stored in its own JSON file
+    and the least recently used files are evicted once the total size of
+    the cache exceeds max_size bytes.
+    '''
+
+    def __init__(self, directory, max_size = DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        files = []
+        for filename in os.listdir(directory):
+            if not filename.endswith(".json"):
+                continue
+            stat = os.stat(os.path.join(directory, filename))
+            files.append((stat.st_mtime, filename, stat.st_size))
+        for mtime, filename, size in sorted(files):
+            self.entries[filename] = size
+            self.size += size
+
+    @staticmethod
+    def simulation_key(scenario, model, tunings, samples):
+        model_json = {k: v for k, v in model.model.items() if k != "samples"}
+        content = json.dumps({
+            "pid": getattr(scenario, "pid", None),
+            "tid": getattr(scenario, "tid", None),
+            "model": model_json,
+            "tunings": tunings,
+            "samples": samples
+        }, sort_keys = True)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def metadata_key(url, language_version):
+        content = json.dumps({"url": url, "language": language_version},
+            sort_keys = True)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key, item):
+        filename = self._filename(key, item)
+        with self.lock:
+            if filename not in self.entries:
+                return None
+            path = os.path.join(self.directory, filename)
+            try:
+                with open(path, 'r') as f:
+                    payload = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f'Dropping unreadable cache entry {path}:\n{e}')
+                self._remove(filename)
+                return None
+            self.entries.move_to_end(filename)
+            os.utime(path)
+        return payload
+
+    def open(self, key, item):
+        '''
+        Open the cached item as a binary file to be read incrementally
+        instead of loading it, or return None if it is not cached. The
+        file stays readable if the entry is evicted in the meantime.
+        '''
+        filename = self._filename(key, item)
+        with self.lock:
+            if filename not in self.entries:
+                return None
+            path = os.path.join(self.directory, filename)
+            try:
+                f = open(path, 'rb')
+            except OSError as e:
+                logging.warning(f'Dropping unreadable cache entry {path}:\n{e}')
+                self._remove(filename)
+                return None
+            self.entries.move_to_end(filename)
+            os.utime(path)
+        return f
+
+    def put(self, key, item, payload):
+        filename = self._filename(key, item)
+        path = os.path.join(self.directory, filename)
+        data = json.dumps(payload)
+        with self.lock:
+            temp_path = path + ".tmp"
+            with open(temp_path, 'w') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            if filename in self.entries:
+                self.size -= self.entries.pop(filename)
+            self.entries[filename] = len(data)
+            self.size += len(data)
+            while self.size > self.max_size and len(self.entries) > 1:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, filename):
+        self.size -= self.entries.pop(filename)
+        try:
+            os.remove(os.path.join(self.directory, filename))
+        except OSError:
+            pass
+
+    @staticmethod
+    def _filename(key, item):
+        return hashlib.sha256(f'{key}/{item}'.encode("utf-8")).hexdigest() + \
+            ".json"
+
+
+class CachedSimulation:
+    '''
+    Simulation whose results and critical paths are served from the cache.
+
+    Critical paths that are not in the cache are fetched from the
+    underlying simulation and stored. When the simulation results were
+    replayed from the cache there is no underlying simulation yet, so it is
+    only obtained, by calling resimulate, if a missing critical path is
+    requested. Depending on the caller this retrieves the simulation from
+    the server or runs it again.
+    '''
+
+    def __init__(self, cache, key, simres, simulation = None,
+        resimulate = None):
+        self.cache = cache
+        self.key = key
+        self.simres = simres
+        self.simulation = simulation
+        self.resimulate = resimulate
+        self.lock = threading.Lock()
+
+    def get_results(self):
+        return self.simres
+
+    def get_critical_paths(self, risks):
+        crit_paths = {}
+        missing = []
+        for attackstep_id in risks:
+            crit_path = self.cache.get(self.key, "path:" + attackstep_id)
+            if crit_path is None:
+                missing.append(attackstep_id)
+            else:
+                crit_paths[attackstep_id] = crit_path
+        if missing:
+            fetched = self._get_simulation().get_critical_paths(missing)
+            for attackstep_id in missing:
+                if attackstep_id in fetched:
+                    self.cache.put(self.key, "path:" + attackstep_id,
+                        fetched[attackstep_id])
+            crit_paths.update(fetched)
+        return crit_paths
+
+    def open_critical_paths(self, risks):
+        '''
+        Open the cached critical paths of the risks as binary files, for the
+        attack graphs to be built from them incrementally. Returns a
+        dictionary mapping the attack step ids of the cached ones to their
+        files.
+        '''
+        streams = {}
+        for attackstep_id in risks:
+            f = self.cache.open(self.key, "path:" + attackstep_id)
+            if f is not None:
+                streams[attackstep_id] = f
+        return streams
+
+    def _get_simulation(self):
+        with self.lock:
+            if self.simulation is None:
+                logging.warning('Critical paths missing from the cache, ' +
+                    'obtaining the cached simulation to fetch them.')
+                self.simulation = self.resimulate()
+            return self.simulation
@@ -0,0 +1,355 @@
+from simulation_cache import CachedSimulation, SimulationCache
+import asyncio
+import copy
+import json
+import logging
+import math
+import random
+import sys
+import threading
+
+DEFAULT_SAMPLES = 100
+
+# ttc95 - ttc5 spans this many standard deviations of a normal distribution
+TTC_SPREAD = 3.29
+# standard errors of the 5th and 50th percentiles of a normal distribution
+# estimated from n samples, in standard deviations divided by sqrt(n)
+QUANTILE_ERRORS = (2.113, 1.253)
+
+
+def simulation_ttcs(simres):
+    return {risk["attackstep_id"]: [float(risk["ttc5"]), float(risk["ttc50"]),
+        float(risk["ttc95"])] for risk in simres["results"]["risks"]}
+
+
+def estimate_ttc_errors(ttcs, samples):
+    '''
+    Estimate the standard errors of the ttc5 and ttc50 values in ttcs, a
+    dictionary mapping attack step ids to [ttc5, ttc50, ttc95] like
+    get_ttcs returns, of a simulation with the given number of samples.
+    The ttcs are taken to be normally distributed with the standard
+    deviation implied by the spread between ttc5 and ttc95, which is rough
+    but tells noisy results apart. Attack steps with an infinite ttc95 are
+    left out.
+    '''
+    errors = {}
+    for attackstep_id, (ttc5, ttc50, ttc95) in ttcs.items():
+        if ttc95 >= sys.float_info.max:
+            continue
+        deviation = max(ttc95 - ttc5, 0) / TTC_SPREAD / math.sqrt(samples)
+        errors[attackstep_id] = [QUANTILE_ERRORS[0] * deviation,
+            QUANTILE_ERRORS[1] * deviation]
+    return errors
+
+
+def relative_ttc_error(ttcs, samples):
+    '''
+    The largest estimated standard error of a ttc5 or ttc50 value relative
+    to the ttc50 of its attack step, 0 if no attack step has finite ttcs.
+    '''
+    errors = estimate_ttc_errors(ttcs, samples)
+    return max((max(errors[x]) / max(ttcs[x][1], 0.001) for x in errors),
+        default = 0)
+
+
+class SimulationError(Exception):
+    '''
+    Raised when a simulation itself failed, as opposed to the transport
+    towards the enterprise server.
+    '''
+    pass
+
+
+def is_transport_error(e):
+    '''
+    Connection problems, request timeouts, rate limiting and server side
+    errors are considered transient. The requests exceptions raised by the
+    enterprise client are all derived from OSError. Everything else is
+    treated as a failure of the simulation itself.
+    '''
+    if not isinstance(e, OSError):
+        return False
+    response = getattr(e, "response", None)
+    status = getattr(response, "status_code", None)
+    return status is None or status >= 500 or status == 429
+
+
+class SimulationRunner:
+    '''
+    Submits simulations to the enterprise server and polls for their
+    results on an asyncio event loop that runs in a background thread.
+
+    submit() returns a concurrent.futures.Future right away, so the caller
+    can keep fetching paths or persisting results while the simulation is
+    in flight, and several simulations can be in flight at the same time.
+
+    Transport errors are retried with jittered exponential backoff. Only
+    genuine simulation failures are retried with more samples. A simulation
+    that does not finish before the deadline is given up on.
+
+    If a SimulationCache is given, simulations that were already run with
+    the same model, tunings and samples are replayed from it, and the
+    results and critical paths of new simulations are stored in it.
+
+    The number of samples a simulation ran with is added to its results as
+    "samples". Simulations submitted with max_samples are run again with
+    twice the samples, up to max_samples, for as long as the estimated
+    relative error of their ttcs exceeds noise_threshold.
+    '''
+
+    def __init__(self, client, scenario, poll_interval = 5, deadline = None,
+        max_retries = 5, transport_retries = 5, backoff_base = 1,
+        backoff_max = 60, cache = None, noise_threshold = None):
+        self.client = client
+        self.scenario = scenario
+        self.cache = cache
+        self.noise_threshold = noise_threshold
+        self.poll_interval = poll_interval
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.transport_retries = transport_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target = self.loop.run_forever,
+            name = "simulation-runner", daemon = True)
+        self.thread.start()
+
+    def submit(self, name, iteration, model, tunings = [],
+        samples = DEFAULT_SAMPLES, max_samples = None):
+        '''
+        Start a simulation and return a future that resolves to the
+        (simulation, simulation results) pair, or to (None, None) if the
+        simulation could not be completed.
+        '''
+        # the tunings are copied since the caller keeps extending them, and
+        # the model since the number of samples is set on it for every run
+        tunings = list(tunings)
+        model = copy.deepcopy(model)
+
+        def simulate(samples):
+            if self.cache is None:
+                return self._simulate(name, iteration, model, tunings,
+                    samples)
+            key = SimulationCache.simulation_key(self.scenario, model,
+                tunings, samples)
+            return self._simulate_cached(key, name, iteration, model,
+                tunings, samples)
+
+        if max_samples and self.noise_threshold is not None:
+            coroutine = self._simulate_adaptive(simulate, name, samples,
+                max_samples)
+        else:
+            coroutine = simulate(samples)
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def resume(self, simid, name, iteration, model, tunings = [],
+        samples = DEFAULT_SAMPLES):
+        '''
+        Attach to a simulation that was created earlier, for instance by an
+        interrupted run, instead of creating a new one. Returns a future
+        like submit() does. The tunings and samples are only used to find
+        the simulation in the cache, samples is the number of samples the
+        simulation was run with.
+        '''
+        key = None
+        if self.cache is not None:
+            tunings = list(tunings)
+            key = SimulationCache.simulation_key(self.scenario, model,
+                tunings, samples)
+        return asyncio.run_coroutine_threadsafe(
+            self._resume(key, simid, name, iteration, samples), self.loop)
+
+    def close(self):
+        '''
+        Cancel the simulations still in flight, wait for the client calls
+        they are making to return and stop the event loop and its thread.
+        '''
+        if self.loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def _shutdown(self):
+        tasks = [task for task in asyncio.all_tasks()
+            if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions = True)
+        await self.loop.shutdown_default_executor()
+
+    async def _simulate_adaptive(self, simulate, name, samples,
+        max_samples):
+        while True:
+            simulation, simres = await simulate(samples)
+            if not simres:
+                return simulation, simres
+            error = relative_ttc_error(simulation_ttcs(simres),
+                simres["samples"])
+            if error <= self.noise_threshold or \
+                simres["samples"] >= max_samples:
+                return simulation, simres
+            samples = min(2 * simres["samples"], max_samples)
+            logging.info(f'The ttcs of simulation {name} with ' +
+                f'{simres["samples"]} samples have an estimated error of ' +
+                f'{error:.1%}, above the noise threshold of ' +
+                f'{self.noise_threshold:.1%}. Running it again with ' +
+                f'{samples} samples.')
+
+    async def _simulate_cached(self, key, name, iteration, model, tunings,
+        samples):
+        simres = await asyncio.to_thread(self.cache.get, key, "results")
+        if simres:
+            logging.info(f'Simulation {name} for iteration {iteration} ' +
+                'replayed from the cache.')
+            simres.setdefault("samples", samples)
+
+            def resimulate():
+                simulation, simres = asyncio.run_coroutine_threadsafe(
+                    self._simulate(name, iteration, model, tunings, samples),
+                    self.loop).result()
+                if not simres:
+                    raise SimulationError(f'Simulation {name} failed.')
+                return simulation
+
+            return CachedSimulation(self.cache, key, simres,
+                resimulate = resimulate), simres
+
+        simulation, simres = await self._simulate(name, iteration, model,
+            tunings, samples)
+        if not simres:
+            return simulation, simres
+        await asyncio.to_thread(self.cache.put, key, "results", simres)
+        return CachedSimulation(self.cache, key, simres,
+            simulation = simulation), simres
+
+    async def _resume(self, key, simid, name, iteration, samples):
+        if key is not None:
+            simres = await asyncio.to_thread(self.cache.get, key, "results")
+            if simres and simres["simid"] == simid:
+                logging.info(f'Simulation {name} for iteration {iteration} ' +
+                    'replayed from the cache.')
+
+                def resimulate():
+                    return asyncio.run_coroutine_threadsafe(self._call(
+                        self.client.simulations.get_simulation_by_simid,
+                        self.scenario, simid), self.loop).result()
+
+                return CachedSimulation(self.cache, key, simres,
+                    resimulate = resimulate), simres
+        try:
+            simulation = await self._call(
+                self.client.simulations.get_simulation_by_simid,
+                self.scenario, simid)
+            simres = await asyncio.wait_for(
+                self._wait_for_results(simulation, name), self.deadline)
+        except Exception as e:
+            logging.error(f'Failed to resume simulation {name} with ' +
+                f'simulation id {simid}:\n{e}')
+            return None, None
+        logging.info(f'Resumed simulation {name} with simulation id {simid}')
+        simres.setdefault("samples", samples)
+        if key is None:
+            return simulation, simres
+        await asyncio.to_thread(self.cache.put, key, "results", simres)
+        return CachedSimulation(self.cache, key, simres,
+            simulation = simulation), simres
+
+    async def _simulate(self, name, iteration, model, tunings, samples):
+        retries = 0
+        while retries < self.max_retries:
+            try:
+                model.model["samples"] = samples
+                if logging.getLogger().isEnabledFor(logging.INFO):
+                    logging.info(f'For iteration {iteration} create new ' +
+                        'simulation with the following tunings:\n' +
+                        json.dumps(tunings, indent = 2))
+                simulation, simres = await asyncio.wait_for(
+                    self._run(name + " s=" + str(samples), model, tunings),
+                    self.deadline)
+                logging.info(f'Simulation {name} ran successfully')
+                simres["samples"] = samples
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug(f'Simulation results for {name}:\n' +
+                        json.dumps(simres, indent = 2))
+                return simulation, simres
+
+            except asyncio.TimeoutError:
+                logging.error(f'Simulation {name} did not finish within ' +
+                    f'the deadline of {self.deadline} seconds.')
+                break
+
+            except Exception as e:
+                if is_transport_error(e):
+                    logging.error(f'Giving up on simulation {name} after ' +
+                        f'{self.transport_retries} transport retries:\n{e}')
+                    break
+                retries += 1
+                if retries < self.max_retries:
+                    samples = samples + 100 * retries
+                    logging.warning(f"Simulation failed with:\n{e}\n" +
+                        "Retrying failed simulation with more samples.\n" +
+                        f"Retries:{retries}. Retrying with {samples} " +
+                        "samples.")
+
+        logging.error("Simulation failed")
+        print("Simulation failed")
+        return None, None
+
+    async def _run(self, name, model, tunings):
+        simulation = await self._call(
+            self.client.simulations.create_simulation, self.scenario,
+            name = name, model = model, raw_tunings = tunings)
+        return simulation, await self._wait_for_results(simulation, name)
+
+    async def _wait_for_results(self, simulation, name):
+        while True:
+            progress = await self._call(self._get_progress, simulation)
+            if progress is None or progress >= 100:
+                break
+            if progress < 0:
+                raise SimulationError(f'Simulation {name} failed on the ' +
+                    'server.')
+            logging.debug(f'Simulation {name} progress: {progress}%')
+            await asyncio.sleep(self.poll_interval)
+
+        # without progress information this blocks until the results are in
+        simres = await self._call(simulation.get_results)
+        if not simres:
+            raise SimulationError(f'Simulation {name} returned no results.')
+        return simres
+
+    def _get_progress(self, simulation):
+        '''
+        Return the current progress of the simulation in percent, or None
+        if the server does not report it.
+        '''
+        simid = getattr(simulation, "simid", None)
+        if simid is None:
+            return None
+        current = self.client.simulations.get_simulation_by_simid(
+            self.scenario, simid)
+        return getattr(current, "progress", None)
+
+    async def _call(self, function, *args, **kwargs):
+        '''
+        Run a blocking client call in a worker thread, retrying transport
+        errors with jittered exponential backoff.
+        '''
+        attempt = 0
+        while True:
+            try:
+                return await asyncio.to_thread(function, *args, **kwargs)
+            except Exception as e:
+                if not is_transport_error(e) or \
+                    attempt >= self.transport_retries:
+                    raise
+                delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+                delay = random.uniform(delay / 2, delay)
+                attempt += 1
+                logging.warning(f'Transport error while calling ' +
+                    f'{function.__name__}:\n{e}\nRetry {attempt} of ' +
+                    f'{self.transport_retries} in {delay:.1f} seconds.')
+                await asyncio.sleep(delay)
@@ -0,0 +1,101 @@
+from json_helpers import read_json_file
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SUCCESS = 0
+ERROR_FAILED_RUN = 1
+
+ANALYSER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "analyser.py")
+
+
+def measure_import(repeat):
+    '''
+    Best wall time of starting the interpreter and importing the analyser.
+    '''
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import analyser"],
+            cwd = os.path.dirname(ANALYSER), check = True)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run_analyser(archivefile, configfile, cache_dir, latency, arguments):
+    '''
+    Replay the start of a run, up to the initial simulation, and return the
+    time the analyser took from being called to submitting the initial
+    simulation together with the wall time of the whole process, or None if
+    the run failed.
+    '''
+    with tempfile.TemporaryDirectory() as run_dir:
+        metricsfile = os.path.join(run_dir, "metrics.json")
+        command = [sys.executable, ANALYSER, "--replay", archivefile,
+            "--replay_latency", str(latency), "-c", configfile,
+            "--cache_dir", cache_dir, "-i", "0",
+            "-l", os.path.join(run_dir, "log.txt"),
+            "--metricsfile", metricsfile,
+            "-r", os.path.join(run_dir, "results.json"),
+            "-j", os.path.join(run_dir, "results.jsonl"),
+            "-s", os.path.join(run_dir, "checkpoint.json")] + arguments
+        start = time.perf_counter()
+        completed = subprocess.run(command, stdout = subprocess.DEVNULL)
+        wall_time = time.perf_counter() - start
+        metrics = read_json_file(metricsfile)
+        if completed.returncode != 0 or "startup" not in metrics["phases"]:
+            return None
+        return metrics["phases"]["startup"], wall_time
+
+
+def run_startup_benchmark():
+    parser = argparse.ArgumentParser(description='Measure the startup of ' +
+        'the analyser, up to submitting the initial simulation, with a ' +
+        'cold and a warm language metadata cache, by replaying a run ' +
+        'recorded with --record.')
+    parser.add_argument('archivefile',
+        help='archive recorded by the analyser with --record, without a ' +
+            'metadata cache so that it holds the language metadata')
+    parser.add_argument('-c', '--configfile', default='coa.ini',
+        help='configuration file of the recorded run ' +
+            '(default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='number of runs per cache state, the best one is reported ' +
+            '(default: %(default)s)')
+    parser.add_argument('--replay_latency', type=float, default=0.1,
+        help='seconds every replayed request is delayed by, standing in ' +
+            'for the server (default: %(default)s)')
+    parser.add_argument('arguments', nargs=argparse.REMAINDER,
+        help='further arguments passed to the analyser')
+
+    args = vars(parser.parse_args())
+    archivefile = os.path.abspath(args['archivefile'])
+    configfile = os.path.abspath(args['configfile'])
+
+    print(f'{"import":<6} {measure_import(args["repeat"]):.4f}s')
+    for state in ["cold", "warm"]:
+        timings = []
+        for i in range(args['repeat']):
+            with tempfile.TemporaryDirectory() as cache_dir:
+                if state == "warm":
+                    # an untimed run fills the cache
+                    run_analyser(archivefile, configfile, cache_dir,
+                        args['replay_latency'], args['arguments'])
+                timing = run_analyser(archivefile, configfile, cache_dir,
+                    args['replay_latency'], args['arguments'])
+            if timing is None:
+                print(f'The {state} cache run of the analyser failed.')
+                return ERROR_FAILED_RUN
+            timings.append(timing)
+        startup, wall_time = min(timings)
+        print(f'{state:<6} first submit after {startup:.4f}s, ' +
+            f'process {wall_time:.4f}s')
+    return SUCCESS
+
+
+if __name__ == "__main__":
+    sys.exit(run_startup_benchmark())
@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+
+# the estimate of a defense is pulled towards the rate of all the
+# observations as if it had this many observations with the average share
+PRIOR_WEIGHT = 2
+
+
+def defense_features(graph, node_id, total_frequency):
+    '''
+    What the impact model knows about the defense node of the attack graph:
+    the class of its asset, its name, the attack steps it blocks and the
+    share of the frequency of the attack steps of the graph they make up.
+    '''
+    node = graph.nodes[node_id]
+    blocked = list(graph.successors(node_id))
+    frequency = sum(graph.nodes[step]["frequency"] for step in blocked)
+    return {"id": node_id, "class": node["class"],
+        "defense": node["attackstep"], "blocked": blocked,
+        "share": frequency / total_frequency if total_frequency else 0}
+
+
+def read_observations(observationsfile):
+    '''
+    Read the observations recorded by an ImpactModel, ignoring a torn last
+    record.
+    '''
+    observations = []
+    with open(observationsfile, 'r') as f:
+        for line in f:
+            try:
+                observations.append(json.loads(line))
+            except ValueError:
+                break
+    return observations
+
+
+class ImpactModel:
+    '''
+    Surrogate estimating the efficiency of a defense, as calculated by
+    calculate_efficiency, without simulating it. It is fitted from the
+    efficiencies observed for the defenses simulated so far in the run.
+
+    The efficiency is estimated as the share of the frequency the defense
+    blocks times a rate, efficiency per share. The rate is the one observed
+    for similar defenses, the ones of the same class and name and the ones
+    blocking some of the same attack steps, shrunk towards the rate
+    observed for all of the defenses by PRIOR_WEIGHT. Observing a defense
+    only adds it to a few indices, so the model is cheap to update.
+
+    Every observation is appended to observationsfile, if given, as a JSON
+    line holding the iteration, the position of the defense among the
+    candidates, its cost and features, the observed efficiency and the
+    estimate the model had for it.
+    '''
+
+    def __init__(self, observationsfile = None, until_iteration = None):
+        '''
+        Start without observations, or, if until_iteration is given, with
+        the ones recorded in observationsfile for the iterations before it,
+        discarding the ones recorded after them.
+        '''
+        self.observations = []
+        self.by_defense = {}
+        self.by_attack_step = {}
+        self.efficiency_sum = 0
+        self.share_sum = 0
+        self.f = None
+        if observationsfile is None:
+            return
+        if until_iteration is not None and os.path.isfile(observationsfile):
+            for observation in read_observations(observationsfile):
+                if observation["iteration"] < until_iteration:
+                    self.add_observation(observation)
+        self.f = open(observationsfile, 'w')
+        for observation in self.observations:
+            self._write(observation)
+
+    def estimate(self, features):
+        '''
+        Estimated efficiency of the defense with the given features.
+        '''
+        if self.share_sum > 0:
+            prior_rate = self.efficiency_sum / self.share_sum
+            prior_share = PRIOR_WEIGHT * self.share_sum / len(self.observations)
+        else:
+            prior_rate = 1
+            prior_share = PRIOR_WEIGHT
+
+        similar = set(self.by_defense.get(
+            (features["class"], features["defense"]), []))
+        for step in features["blocked"]:
+            similar.update(self.by_attack_step.get(step, []))
+        efficiency = sum(self.observations[i]["efficiency"] for i in similar)
+        share = sum(self.observations[i]["features"]["share"]
+            for i in similar)
+        return features["share"] * (efficiency + prior_rate * prior_share) / \
+            (share + prior_share)
+
+    def add_features(self, graph, candidates):
+        '''
+        Add the features of their defense to the candidates returned by
+        find_defense_candidates, as "features", together with their
+        position among them, as "rank".
+        '''
+        total_frequency = graph.attack_step_frequency()
+        for rank, candidate in enumerate(candidates):
+            candidate["rank"] = rank
+            candidate["features"] = defense_features(graph,
+                candidate["node"], total_frequency)
+
+    def rank(self, candidates):
+        '''
+        Sort the candidates with features by estimated efficiency per unit
+        of cost, equal ones in their original order.
+        '''
+        for candidate in candidates:
+            candidate["estimate"] = self.estimate(candidate["features"])
+            logging.debug(f'Defense {candidate["features"]["id"]} has an ' +
+                f'estimated efficiency of {round(candidate["estimate"], 3)} ' +
+                f'with a cost of {candidate["cost"]}')
+        return sorted(candidates, key = lambda candidate:
+            -candidate["estimate"] / max(candidate["cost"], 1))
+
+    def observe(self, iteration, candidate, efficiency):
+        '''
+        Fit the model to the efficiency observed for the candidate with
+        features in the given iteration.
+        '''
+        observation = {"iteration": iteration, "rank": candidate["rank"],
+            "cost": candidate["cost"], "features": candidate["features"],
+            "efficiency": efficiency,
+            "estimate": self.estimate(candidate["features"])}
+        logging.info(f'Defense {candidate["features"]["id"]} was ' +
+            f'estimated to have an efficiency of ' +
+            f'{round(observation["estimate"], 3)} and has {efficiency}.')
+        self.add_observation(observation)
+        if self.f is not None:
+            self._write(observation)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+
+    def add_observation(self, observation):
+        i = len(self.observations)
+        self.observations.append(observation)
+        features = observation["features"]
+        self.by_defense.setdefault((features["class"], features["defense"]),
+            []).append(i)
+        for step in features["blocked"]:
+            self.by_attack_step.setdefault(step, []).append(i)
+        self.efficiency_sum += observation["efficiency"]
+        self.share_sum += features["share"]
+
+    def _write(self, observation):
+        self.f.write(json.dumps(observation, separators = (',', ':')) + "\n")
+        self.f.flush()
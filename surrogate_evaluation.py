@@ -0,0 +1,123 @@
+from surrogate import ImpactModel, read_observations
+import argparse
+import sys
+
+SUCCESS = 0
+ERROR_NO_OBSERVATIONS = 1
+
+
+def pairwise_agreement(order, scores):
+    '''
+    Fraction of the pairs of candidates with different scores that are in
+    the right order, or None if there are none.
+    '''
+    agreed = 0
+    pairs = 0
+    for i, first in enumerate(order):
+        for second in order[i + 1:]:
+            if scores[first] != scores[second]:
+                pairs += 1
+                agreed += scores[first] > scores[second]
+    return agreed / pairs if pairs else None
+
+
+def evaluate_run(observations, top):
+    '''
+    Replay the observations of a recorded run in iteration order, fitting
+    the impact model only to the ones of earlier iterations, the way the
+    analyser does. For every iteration that simulated several candidates,
+    the ranking by estimated efficiency per unit of cost is compared with
+    the ranking by observed efficiency per unit of cost, and so is the
+    ranking by frequency the candidates came in. Returns the statistics of
+    the run.
+    '''
+    stats = {"observations": len(observations), "iterations": 0,
+        "absolute_error": 0, "surrogate": {"top1": 0, "topn": 0,
+        "pairs": []}, "frequency": {"top1": 0, "topn": 0, "pairs": []}}
+    iterations = {}
+    for observation in observations:
+        iterations.setdefault(observation["iteration"], []).append(
+            observation)
+
+    model = ImpactModel()
+    for iteration in sorted(iterations):
+        candidates = sorted(iterations[iteration],
+            key = lambda observation: observation["rank"])
+        estimates = [model.estimate(observation["features"])
+            for observation in candidates]
+        for observation, estimate in zip(candidates, estimates):
+            stats["absolute_error"] += abs(estimate -
+                observation["efficiency"])
+        if len(candidates) > 1:
+            stats["iterations"] += 1
+            actual = [observation["efficiency"] /
+                max(observation["cost"], 1) for observation in candidates]
+            best = max(range(len(candidates)), key = lambda i: actual[i])
+            orders = {"frequency": list(range(len(candidates))),
+                "surrogate": sorted(range(len(candidates)), key = lambda i:
+                -estimates[i] / max(candidates[i]["cost"], 1))}
+            for name, order in orders.items():
+                stats[name]["top1"] += order[0] == best
+                stats[name]["topn"] += best in order[:top]
+                agreement = pairwise_agreement(order, actual)
+                if agreement is not None:
+                    stats[name]["pairs"].append(agreement)
+        for observation in candidates:
+            model.add_observation(observation)
+    return stats
+
+
+def print_ranking(run, name, iterations, ranking):
+    if not iterations:
+        print(f'{run[-32:]:<32} {name:<10} {0:>5} {"-":>6} {"-":>6} {"-":>6}')
+        return
+    pairs = sum(ranking["pairs"]) / len(ranking["pairs"]) \
+        if ranking["pairs"] else 0
+    print(f'{run[-32:]:<32} {name:<10} {iterations:>5} ' +
+        f'{ranking["top1"] / iterations:>6.1%} ' +
+        f'{ranking["topn"] / iterations:>6.1%} {pairs:>6.1%}')
+
+
+def run_evaluation():
+    parser = argparse.ArgumentParser(description='Evaluate how well the ' +
+        'surrogate impact model ranks defense candidates on runs recorded ' +
+        'with --observationsfile, ideally with --lookahead so that several ' +
+        'candidates are simulated every iteration, compared with the ' +
+        'ranking by frequency.')
+    parser.add_argument('observationsfiles', nargs='+',
+        metavar='observationsfile',
+        help='observations recorded by the analyser with --observationsfile')
+    parser.add_argument('-t', '--top', type=int, default=2,
+        help='number of best estimated candidates that count as a hit if ' +
+            'they include the best one (default: %(default)s)')
+    args = vars(parser.parse_args())
+
+    totals = {"observations": 0, "iterations": 0, "absolute_error": 0}
+    rankings = {name: {"top1": 0, "topn": 0, "pairs": []}
+        for name in ["surrogate", "frequency"]}
+    print(f'{"run":<32} {"ranking":<10} {"iters":>5} {"top1":>6} ' +
+        f'{"top" + str(args["top"]):>6} {"pairs":>6}')
+    for observationsfile in args['observationsfiles']:
+        stats = evaluate_run(read_observations(observationsfile),
+            args['top'])
+        for key in totals:
+            totals[key] += stats[key]
+        for name in rankings:
+            for key in ["top1", "topn", "pairs"]:
+                rankings[name][key] += stats[name][key]
+            print_ranking(observationsfile, name, stats["iterations"],
+                stats[name])
+
+    if not totals["observations"]:
+        print('No observations found.')
+        return ERROR_NO_OBSERVATIONS
+    for name in rankings:
+        print_ranking("all runs", name, totals["iterations"], rankings[name])
+    print(f'Mean absolute error of the estimated efficiency over ' +
+        f'{totals["observations"]} observations: ' +
+        f'{totals["absolute_error"] / totals["observations"]:.4f}')
+    return SUCCESS
+
+
+if __name__ == "__main__":
+    sys.exit(run_evaluation())
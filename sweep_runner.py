@@ -0,0 +1,318 @@
+from analyser import SUCCESS, ERROR_INCORRECT_CONFIG, ERROR_FAILED_SIM, \
+    ERROR_NO_DEFENCE, ERROR_UNKNOWN_METRIC, \
+    MAX_SIMULATION_CREATION_RETRIES, calculate_efficiency, check_config, \
+    configure_logging, defense_tuning, fetch_attack_graphs, \
+    get_language_metadata, get_ttcs, load_model_dictionary, load_project, \
+    open_client, parse_arguments, update_costs_from_file
+from attack_graph import AttackGraph, CompactAttackGraph, \
+    build_defense_index, merge_attack_graphs
+from batch_runner import STATUS_NAMES
+from json_helpers import write_json_file_atomic
+from results_journal import ResultsJournal
+from simulation_cache import SimulationCache
+from simulation_runner import SimulationRunner
+from concurrent.futures import FIRST_COMPLETED, wait
+import argparse
+import configparser
+import copy
+import json
+import logging
+import os
+import sys
+import time
+
+ERROR_FAILED_CONFIGURATIONS = 1
+
+# options of the analyser that need a run of their own
+UNSUPPORTED_OPTIONS = {
+    "resume": "--resume",
+    "incremental_merge": "--incremental_merge",
+    "adaptive_samples": "--adaptive_samples",
+    "surrogate_candidates": "--surrogate_candidates",
+    "observationsfile": "--observationsfile",
+}
+
+
+class Branch:
+    '''
+    One configuration of the sweep, a budget and a metric, with its own
+    copy of the language metadata and of the defense index referring to
+    it, since the use counters of the defenses are written into it, and its
+    own directory and results journal. simulations counts the simulations
+    an independent run of the configuration would have taken.
+    '''
+
+    def __init__(self, budget, metric, lang_meta, defense_index, output_dir,
+        results):
+        self.name = f'{metric}_{budget}'
+        self.branch_dir = os.path.join(output_dir, self.name)
+        os.makedirs(self.branch_dir, exist_ok = True)
+        self.budget = budget
+        self.metric = metric
+        self.budget_remaining = budget
+        self.lang_meta, self.defense_index = copy.deepcopy((lang_meta,
+            defense_index))
+        self.journal = ResultsJournal(os.path.join(self.branch_dir,
+            "results.jsonl"), results)
+        self.status = None
+        self.simulations = 0
+
+    def record(self, iteration, simres, ttcs, efficiency,
+        final_simid = False):
+        '''
+        Record the results of the simulation the branch continues from, the
+        way run_coa does in every iteration.
+        '''
+        risk_ttcs = {}
+        for risks_i in simres["results"]["risks"]:
+            risk_index = risks_i['object_id'] + "." + risks_i['attackstep']
+            risk_ttcs[risk_index] = ttcs[risks_i["attackstep_id"]]
+        if final_simid:
+            self.journal.set("final_simid", simres["simid"])
+        if iteration == 0:
+            self.journal.set_initial_ttcs(risk_ttcs)
+        elif risk_ttcs:
+            self.journal.set_coa_ttcs(risk_ttcs, simres["report_url"])
+        if iteration != 0:
+            logging.debug(f"Efficiency of {self.name} for step {iteration} " +
+                f"is {efficiency}")
+            self.journal.set_efficiency(str(efficiency))
+
+
+def select_defenses(graph, branches, iteration, model_index, raw_tunings):
+    '''
+    Rank the merged attack graph with the metric of every branch and let
+    every branch pick its next defense within its own budget. Returns the
+    branches that continue grouped by the tunings of their next
+    simulation, keyed by the defense they added, in the order the defenses
+    were first picked.
+    '''
+    children = {}
+    metrics = list(dict.fromkeys(branch.metric for branch in branches))
+    for metric in metrics:
+        # the branches share the graph, which holds a single ranking
+        if graph.find_critical_attack_step(metric) != 0:
+            for branch in branches:
+                if branch.metric == metric:
+                    branch.status = ERROR_UNKNOWN_METRIC
+            continue
+        for branch in branches:
+            if branch.metric != metric:
+                continue
+            best_def_info, budget_remaining = graph.find_best_defense(
+                branch.lang_meta, model_index, branch.budget_remaining,
+                branch.journal, branch.defense_index)
+            if not best_def_info:
+                logging.error("Failed to find an applicable defense for " +
+                    f"iteration {iteration} of {branch.name}.")
+                branch.status = ERROR_NO_DEFENCE
+                continue
+            branch.budget_remaining = budget_remaining
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                logging.info(f"Best defense of {branch.name} for iteration " +
+                    f"{iteration} is:\n" + json.dumps(best_def_info,
+                    indent = 2))
+            logging.info(f"Remaining budget of {branch.name} after " +
+                f"iteration {iteration} is {budget_remaining}")
+            tuning = defense_tuning(best_def_info["name"],
+                best_def_info["attackstep"], best_def_info["ref"])
+            key = json.dumps(tuning, sort_keys = True)
+            if key not in children:
+                children[key] = (raw_tunings + [tuning], [])
+            children[key][1].append(branch)
+    return list(children.values())
+
+
+def run_tree(runner, simulation_name, model, model_index, branches, args,
+    lang_meta, defense_index, graph_class, final_simid):
+    '''
+    Explore the configurations as a tree of simulations keyed by their
+    sequence of tunings. The branches share a simulation for as long as
+    they picked the same defenses, and every simulation is analysed as
+    soon as its results are available, while the simulations of the other
+    branches are still running. Like run_coa, every branch runs up to
+    max_iterations simulations after the initial one, and the results of
+    the last one are not analysed. Returns the number of simulations run.
+    '''
+    max_iterations = args['max_iterations']
+
+    def submit(iteration, raw_tunings):
+        # branches reach the same iteration with different simulations,
+        # which are told apart by their number
+        name = simulation_name + (f"i={iteration - 1} n={simulations}"
+            if iteration else "Initial Simulation")
+        return runner.submit(name, iteration - 1, model, raw_tunings)
+
+    simulations = 1
+    pending = {submit(0, []): (0, [], None, branches)}
+    while pending:
+        for future in wait(pending, return_when = FIRST_COMPLETED).done:
+            iteration, raw_tunings, previous_ttcs, group = \
+                pending.pop(future)
+            simulation, simres = future.result()
+            for branch in group:
+                branch.simulations += 1
+            if not simres:
+                for branch in group:
+                    branch.status = ERROR_FAILED_SIM
+                continue
+            if iteration >= max_iterations:
+                continue
+
+            ttcs = get_ttcs(simres)
+            efficiency = calculate_efficiency(previous_ttcs, ttcs) \
+                if iteration != 0 else None
+            for branch in group:
+                branch.record(iteration, simres, ttcs, efficiency,
+                    final_simid)
+
+            attack_paths = fetch_attack_graphs(simulation,
+                simres["results"]["risks"], lang_meta,
+                workers = args['fetch_workers'],
+                paths_per_request = args['paths_per_request'],
+                defense_index = defense_index, graph_class = graph_class)
+            if len(attack_paths) == 0:
+                logging.info("Branches " +
+                    ", ".join(branch.name for branch in group) +
+                    " terminating successfully after protecting all of " +
+                    "the high value assets.")
+                for branch in group:
+                    branch.status = SUCCESS
+                continue
+
+            graph = merge_attack_graphs(attack_paths)
+            for child_tunings, child_group in select_defenses(graph, group,
+                iteration, model_index, raw_tunings):
+                simulations += 1
+                pending[submit(iteration + 1, child_tunings)] = \
+                    (iteration + 1, child_tunings, ttcs, child_group)
+    return simulations
+
+
+def write_report(reportfile, report):
+    print(f'{"configuration":<32} {"status":<18} {"CoAs":>5} ' +
+        f'{"efficiency":>11} {"simulations":>12}')
+    for name, outcome in report["configurations"].items():
+        efficiency = outcome["efficiencies"][-1] \
+            if outcome["efficiencies"] else None
+        print(f'{name:<32} {outcome["status"]:<18} ' +
+            f'{len(outcome["CoAs"]):>5} {str(efficiency):>11} ' +
+            f'{outcome["simulations"]:>12}')
+    print(f'{len(report["configurations"])} configurations in ' +
+        f'{report["wall_time"]:.1f}s with {report["simulations"]} ' +
+        f'simulations, {report["saved_simulations"]} fewer than ' +
+        'independent runs, ' + f'{report["failed"]} failed.')
+    write_json_file_atomic(reportfile, report, indent = 4)
+
+
+def run_sweep():
+    parser = argparse.ArgumentParser(description='Run the analyser for ' +
+        'every combination of the given budgets and metrics, sharing the ' +
+        'simulations between them for as long as they pick the same ' +
+        'defenses.')
+    parser.add_argument('-b', '--budgets', type=int, nargs='+',
+        required=True, help='initial budgets to sweep')
+    parser.add_argument('-m', '--metrics', nargs='+', default=['frequency'],
+        help='metrics to sweep (default: %(default)s)')
+    parser.add_argument('-d', '--output_dir', default='sweep',
+        help='directory the results of every configuration are written ' +
+            'to, in a subdirectory named after the metric and budget ' +
+            '(default: %(default)s)')
+    parser.add_argument('--reportfile', default=None,
+        help='filename to use for the sweep report ' +
+            '(default: sweep.json in the output directory)')
+    parser.add_argument('arguments', nargs=argparse.REMAINDER,
+        help='further arguments of the analyser, after --, such as -c, ' +
+            '-i and --cache_dir, that apply to every configuration; the ' +
+            'budget and metric are the ones of the sweep')
+
+    sweep_args = vars(parser.parse_args())
+    output_dir = sweep_args['output_dir']
+    os.makedirs(output_dir, exist_ok = True)
+    arguments = sweep_args['arguments']
+    if arguments[:1] == ['--']:
+        arguments = arguments[1:]
+    args = parse_arguments(["-l", os.path.join(output_dir, "log.txt")] +
+        arguments)
+    if args['lookahead'] > 1 or args['defenses_per_iteration'] > 1:
+        parser.error('--lookahead and --defenses_per_iteration are not ' +
+            'supported by the sweep')
+    for key, option in UNSUPPORTED_OPTIONS.items():
+        if args[key]:
+            parser.error(f'{option} is not supported by the sweep')
+
+    configure_logging(args['logfile'], args['log_level'])
+    config = configparser.ConfigParser()
+    config.read(args['configfile'])
+    if check_config(config, args['configfile']) != SUCCESS:
+        return ERROR_INCORRECT_CONFIG
+
+    cache = SimulationCache(args['cache_dir'], args['cache_size'] << 20) \
+        if args['cache_dir'] else None
+    client = open_client(args, config)
+    lang_meta = get_language_metadata(client, cache,
+        config.get("enterprise-client", "url", fallback = None),
+        args['language_version'], args['refresh_metadata'])
+    if args['costsfile']:
+        update_costs_from_file(args['costsfile'], lang_meta)
+    defense_index = build_defense_index(lang_meta)
+
+    scenario, model, model_name, scad_dump, results = load_project(client,
+        config)
+    if args['simulation_name_prefix']:
+        simulation_name = args['simulation_name_prefix'] + " " + \
+            model_name + " "
+    else:
+        simulation_name = model_name + " "
+    results["CoAs"] = []
+    results["initial_TTC"] = {}
+
+    branches = [Branch(budget, metric, lang_meta, defense_index, output_dir,
+        results) for budget in dict.fromkeys(sweep_args['budgets'])
+        for metric in dict.fromkeys(sweep_args['metrics'])]
+    graph_class = CompactAttackGraph \
+        if args['graph_backend'] == 'compact' else AttackGraph
+
+    runner = SimulationRunner(client, scenario,
+        poll_interval = args['poll_interval'],
+        deadline = args['simulation_deadline'],
+        max_retries = MAX_SIMULATION_CREATION_RETRIES,
+        transport_retries = args['transport_retries'], cache = cache)
+    start = time.perf_counter()
+    try:
+        simulations = run_tree(runner, simulation_name, model,
+            load_model_dictionary(scad_dump, model_name), branches, args,
+            lang_meta, defense_index, graph_class,
+            bool(config["project"].get("simID")))
+    finally:
+        runner.close()
+        for branch in branches:
+            branch.journal.write(os.path.join(branch.branch_dir,
+                "results.json"), args['compact_results'])
+            branch.journal.close()
+
+    report = {"configurations": {}}
+    for branch in branches:
+        coas = branch.journal.results["CoAs"]
+        report["configurations"][branch.name] = {"budget": branch.budget,
+            "metric": branch.metric,
+            "status": STATUS_NAMES.get(branch.status, str(branch.status)),
+            "return_code": branch.status,
+            "efficiencies": [coa["efficiency"] for coa in coas
+                if "efficiency" in coa],
+            "CoAs": coas,
+            "simulations": branch.simulations}
+    independent = sum(branch.simulations for branch in branches)
+    report["simulations"] = simulations
+    report["independent_simulations"] = independent
+    report["saved_simulations"] = independent - simulations
+    report["wall_time"] = round(time.perf_counter() - start, 3)
+    report["failed"] = sum(1 for outcome in
+        report["configurations"].values() if outcome["status"] != "success")
+    write_report(sweep_args['reportfile'] or
+        os.path.join(output_dir, "sweep.json"), report)
+    return ERROR_FAILED_CONFIGURATIONS if report["failed"] else SUCCESS
+
+
+if __name__ == "__main__":
+    sys.exit(run_sweep())
@@ -0,0 +1,220 @@
+import copy
+import random
+import unittest
+from unittest import mock
+
+from attack_graph import AttackGraph, CompactAttackGraph, IncrementalMerge, \
+    attack_graph_differences, build_defense_index, build_model_index, \
+    merge_attack_graphs, merge_compact_attack_graphs
+from graph_generator import generate_attack_graph, generate_critical_paths, \
+    generate_lang_meta
+
+METRICS = ["frequency", "weighted_out_degrees", "path_count",
+    "ttc_weighted_path_count"]
+
+
+def graph_contents(graph):
+    '''
+    The nodes with their attributes and the successors and predecessors of
+    every node, in order.
+    '''
+    return [(node, dict(graph.nodes[node]), list(graph.successors(node)),
+        list(graph.predecessors(node))) for node in graph.nodes]
+
+
+def without_defense(crit_paths, defense):
+    '''
+    The critical paths once the defense is applied, without the defense and
+    the attack steps it blocks. Paths whose target is blocked are dropped
+    and the paths not containing the defense are kept as they are.
+    '''
+    result = {}
+    for target, path in crit_paths.items():
+        indices = {node["id"]: node["index"] for node in path["nodes"]}
+        if defense not in indices:
+            result[target] = path
+            continue
+        removed = {indices[defense]}
+        removed.update(link["target"] for link in path["links"]
+            if link["source"] == indices[defense])
+        if indices[target] in removed:
+            continue
+        result[target] = {
+            "nodes": [node for node in path["nodes"]
+                if node["index"] not in removed],
+            "links": [link for link in path["links"]
+                if link["source"] not in removed
+                and link["target"] not in removed]
+        }
+    return result
+
+
+class GraphBackendTest(unittest.TestCase):
+    '''
+    The compact backend has to give the results of the networkx one, ties
+    included, on the critical paths of generated models.
+    '''
+
+    def setUp(self):
+        rnd = random.Random(0)
+        self.lang_meta = generate_lang_meta(rnd)
+        nodes, links, model_dict_list = generate_attack_graph(400, rnd)
+        self.crit_paths = generate_critical_paths(nodes, links, 8)
+        self.model_index = build_model_index(model_dict_list)
+        # out of node order, the last graph adds predecessors to nodes of
+        # the earlier ones
+        self.targets = list(self.crit_paths)
+        random.Random(0).shuffle(self.targets)
+
+    def merged_graph(self, graph_class, merge, lang_meta):
+        defense_index = build_defense_index(lang_meta)
+        return merge([graph_class(self.crit_paths, target, lang_meta,
+            defense_index) for target in self.targets])
+
+    def test_critical_paths_are_parsed_alike(self):
+        defense_index = build_defense_index(self.lang_meta)
+        for target in self.crit_paths:
+            graph = AttackGraph(self.crit_paths, target, self.lang_meta,
+                defense_index)
+            compact = CompactAttackGraph(self.crit_paths, target,
+                self.lang_meta, defense_index)
+            self.assertEqual(graph_contents(compact), graph_contents(graph))
+
+    def test_merged_graphs_are_ranked_alike(self):
+        graph = self.merged_graph(AttackGraph, merge_attack_graphs,
+            self.lang_meta)
+        compact = self.merged_graph(CompactAttackGraph,
+            merge_compact_attack_graphs, self.lang_meta)
+        self.assertEqual(compact.number_of_nodes(), graph.number_of_nodes())
+        self.assertEqual(compact.number_of_edges(), graph.number_of_edges())
+        for metric in METRICS:
+            with self.subTest(metric = metric):
+                self.assertEqual(graph.find_critical_attack_step(metric), 0)
+                self.assertEqual(compact.find_critical_attack_step(metric),
+                    0)
+                self.assertEqual(compact.nodes_sorted, graph.nodes_sorted)
+                self.assertEqual(graph_contents(compact),
+                    graph_contents(graph))
+
+    def test_same_defenses_are_chosen(self):
+        for metric in METRICS:
+            with self.subTest(metric = metric):
+                chosen = []
+                for graph_class, merge in [
+                    (AttackGraph, merge_attack_graphs),
+                    (CompactAttackGraph, merge_compact_attack_graphs)]:
+                    # applying defenses raises the use counters
+                    lang_meta = copy.deepcopy(self.lang_meta)
+                    defense_index = build_defense_index(lang_meta)
+                    graph = self.merged_graph(graph_class, merge, lang_meta)
+                    graph.find_critical_attack_step(metric)
+                    candidates = graph.find_defense_candidates(lang_meta,
+                        self.model_index, 1000, 5, defense_index)
+                    journal = mock.Mock()
+                    best_defs, budget = graph.find_best_defenses(lang_meta,
+                        self.model_index, 1000, journal, 3, defense_index)
+                    chosen.append(([(candidate["node"], candidate["cost"])
+                        for candidate in candidates],
+                        [best_def["id"] for best_def in best_defs], budget,
+                        journal.mock_calls))
+                self.assertTrue(chosen[0][0])
+                self.assertEqual(chosen[1], chosen[0])
+
+
+
+class IncrementalMergeTest(unittest.TestCase):
+    '''
+    The incrementally merged graph has to match the one merged from scratch
+    while the analyser applies defenses and refetches the attack graphs
+    they change.
+    '''
+
+    def setUp(self):
+        rnd = random.Random(0)
+        self.lang_meta = generate_lang_meta(rnd)
+        self.defense_index = build_defense_index(self.lang_meta)
+        nodes, links, model_dict_list = generate_attack_graph(400, rnd)
+        crit_paths = generate_critical_paths(nodes, links, 8)
+        self.model_index = build_model_index(model_dict_list)
+        targets = list(crit_paths)
+        random.Random(0).shuffle(targets)
+        self.crit_paths = {target: crit_paths[target] for target in targets}
+
+    def attack_graphs(self, crit_paths, previous = {}):
+        '''
+        The attack graphs of the critical paths, reusing the previous ones
+        of the paths that did not change like update_attack_graphs does.
+        '''
+        graphs = {}
+        for target, path in crit_paths.items():
+            if target in previous and previous[target][0] is path:
+                graphs[target] = previous[target]
+            else:
+                graphs[target] = (path, AttackGraph(crit_paths, target,
+                    self.lang_meta, self.defense_index))
+        return graphs
+
+    def check_update(self, merge, graphs, metric):
+        merged = merge.update(graphs)
+        self.assertEqual(merge.find_critical_attack_step(metric), 0)
+        expected = merge_attack_graphs([graph for target, graph in graphs])
+        expected.find_critical_attack_step(metric)
+        self.assertEqual(attack_graph_differences(merged, expected), [])
+        return merged
+
+    def test_updates_match_full_merges(self):
+        for metric in ["frequency", "path_count"]:
+            with self.subTest(metric = metric):
+                merge = IncrementalMerge()
+                crit_paths = self.crit_paths
+                graphs = self.attack_graphs(crit_paths)
+                budget = 10000
+                lang_meta = copy.deepcopy(self.lang_meta)
+                defense_index = build_defense_index(lang_meta)
+                for iteration in range(6):
+                    merged = self.check_update(merge, [(target, graph)
+                        for target, (path, graph) in graphs.items()], metric)
+                    best_def, budget = merged.find_best_defense(lang_meta,
+                        self.model_index, budget, mock.Mock(), defense_index)
+                    self.assertIsNotNone(best_def)
+                    crit_paths = without_defense(crit_paths, best_def["id"])
+                    if iteration == 2:
+                        # the risk of the first attack graph is protected
+                        del crit_paths[next(iter(crit_paths))]
+                    graphs = self.attack_graphs(crit_paths, graphs)
+
+    def test_small_updates_move_ranked_steps(self):
+        # the attack graphs replaced are small enough for the ranking to
+        # be updated instead of sorted again
+        rnd = random.Random(0)
+        graphs = self.attack_graphs(self.crit_paths)
+        merge = IncrementalMerge()
+        self.check_update(merge, [(target, graph)
+            for target, (path, graph) in graphs.items()], "frequency")
+        small = sorted(graphs, key = lambda target:
+            len(graphs[target][0]["nodes"]))[:2]
+        for iteration in range(6):
+            target = small[iteration % 2]
+            path = graphs[target][0]
+            crit_paths = {target: {"nodes": [dict(node,
+                frequency = rnd.randint(1, 100)) for node in path["nodes"]],
+                "links": path["links"]}}
+            graphs[target] = (path, AttackGraph(crit_paths, target,
+                self.lang_meta, self.defense_index))
+            self.check_update(merge, [(target, graph)
+                for target, (path, graph) in graphs.items()], "frequency")
+
+    def test_changed_order_merges_from_scratch(self):
+        graphs = [(target, graph) for target, (path, graph) in
+            self.attack_graphs(self.crit_paths).items()]
+        merge = IncrementalMerge()
+        self.check_update(merge, graphs[2:], "frequency")
+        # a new attack graph ahead of the known ones, then the known ones
+        # in a different order
+        self.check_update(merge, graphs, "frequency")
+        self.check_update(merge, graphs[::-1], "frequency")
+        self.check_update(merge, graphs[::-1][1:], "frequency")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import copy
+import unittest
+
+from coa_results import COMPACT_FORMAT, CompactResults, compact_results, \
+    expand_results, is_compact
+
+
+def defense(eid):
+    return {"ref": f"host{eid}", "defenseName": "patched",
+        "assetName": f"Host{eid}", "eid": str(eid),
+        "defenseInfo": "patched is used"}
+
+
+RESULTS = {
+    "initial_ids": {"pid": "pid", "tid": "tid"},
+    "CoAs": [
+        {"monetary_cost": {"1": 100}, "defenses": [defense(1)],
+            "coaTTC": {"1.compromise": [1.0, 2.0, 4.0],
+                "2.compromise": [5.0, 6.0, 7.0],
+                "3.compromise": [1.5, 2.5, 3.5]},
+            "report_url": "https://report/1", "efficiency": "1.5"},
+        # two defenses simulated together, and a risk that disappeared
+        {"monetary_cost": {"1": 300},
+            "defenses": [defense(1), defense(2), defense(3)],
+            "coaTTC": {"1.compromise": [1.0, 2.0, 4.0],
+                "2.compromise": [8.0, 9.0, 10.0]},
+            "report_url": "https://report/2", "efficiency": "0.25"},
+        # the last CoA of a run has no simulation results
+        {"monetary_cost": {"1": 150},
+            "defenses": [defense(1), defense(2), defense(3), defense(4)]},
+    ],
+    "initial_TTC": {"1.compromise": [1.0, 2.0, 4.0],
+        "2.compromise": [3.0, 4.0, 5.0], "3.compromise": [1.0, 2.0, 3.0]},
+    "final_simid": "sim",
+}
+
+
+class CompactResultsTest(unittest.TestCase):
+
+    def test_expand_inverts_compact(self):
+        results = copy.deepcopy(RESULTS)
+        compact = compact_results(results)
+        self.assertEqual(results, RESULTS)
+        self.assertEqual(expand_results(compact), RESULTS)
+        self.assertEqual(list(expand_results(compact)), list(RESULTS))
+
+    def test_compact_only_holds_the_changes(self):
+        compact = compact_results(RESULTS)
+        self.assertTrue(is_compact(compact))
+        self.assertEqual(compact["format"], COMPACT_FORMAT)
+        first, second, last = compact["CoAs"]
+        self.assertEqual(first["defense"], defense(1))
+        self.assertEqual(first["coaTTC"], {"2.compromise": [5.0, 6.0, 7.0],
+            "3.compromise": [1.5, 2.5, 3.5]})
+        self.assertNotIn("removedTTC", first)
+        self.assertEqual(second["addedDefenses"], [defense(2), defense(3)])
+        self.assertEqual(second["coaTTC"],
+            {"2.compromise": [8.0, 9.0, 10.0]})
+        self.assertEqual(second["removedTTC"], ["3.compromise"])
+        self.assertEqual(last, {"monetary_cost": {"1": 150},
+            "defense": defense(4)})
+
+    def test_single_coas_are_expanded(self):
+        compact = CompactResults(compact_results(RESULTS))
+        self.assertEqual(len(compact), len(RESULTS["CoAs"]))
+        for index, coa in enumerate(RESULTS["CoAs"]):
+            self.assertEqual(compact.coa(index), coa)
+        self.assertEqual(compact.coa(-1), RESULTS["CoAs"][-1])
+        with self.assertRaises(IndexError):
+            compact.coa(len(RESULTS["CoAs"]))
+
+    def test_regular_results_are_rejected(self):
+        with self.assertRaises(ValueError):
+            CompactResults(RESULTS)
+
+    def test_results_without_coas(self):
+        results = {"CoAs": [], "initial_TTC": {}}
+        self.assertEqual(expand_results(compact_results(results)), results)
+
+
+if __name__ == "__main__":
+    unittest.main()
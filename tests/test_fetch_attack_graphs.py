@@ -0,0 +1,72 @@
+import io
+import json
+import random
+import unittest
+
+from analyser import fetch_attack_graphs
+from attack_graph import build_defense_index
+from graph_generator import generate_attack_graph, generate_critical_paths, \
+    generate_lang_meta
+
+
+class FetchError(Exception):
+    pass
+
+
+class StreamingSimulation:
+    '''
+    Serves the critical paths of the cached targets as files and fails to
+    fetch the others, keeping track of the files it opened.
+    '''
+
+    def __init__(self, crit_paths, cached):
+        self.crit_paths = crit_paths
+        self.cached = cached
+        self.opened = []
+
+    def open_critical_paths(self, risks):
+        streams = {}
+        for attackstep_id in risks:
+            if attackstep_id in self.cached:
+                stream = io.BytesIO(json.dumps(
+                    self.crit_paths[attackstep_id]).encode("utf-8"))
+                self.opened.append(stream)
+                streams[attackstep_id] = stream
+        return streams
+
+    def get_critical_paths(self, risks):
+        raise FetchError(f'Failed to fetch the critical paths of {risks}.')
+
+
+class FetchAttackGraphsTest(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(0)
+        self.lang_meta = generate_lang_meta(rnd)
+        nodes, links, model_dict_list = generate_attack_graph(200, rnd)
+        self.crit_paths = generate_critical_paths(nodes, links, 6)
+        self.risks = [{"attackstep_id": target, "ttc5": "1.0"}
+            for target in self.crit_paths]
+
+    def test_streams_are_read_into_attack_graphs(self):
+        simulation = StreamingSimulation(self.crit_paths, self.crit_paths)
+        graphs = fetch_attack_graphs(simulation, self.risks, self.lang_meta,
+            workers = 2, paths_per_request = 2,
+            defense_index = build_defense_index(self.lang_meta))
+        self.assertEqual(len(graphs), len(self.risks))
+        self.assertTrue(all(stream.closed for stream in simulation.opened))
+
+    def test_streams_are_closed_when_a_fetch_fails(self):
+        # every other target has to be fetched, which fails
+        cached = set(list(self.crit_paths)[::2])
+        simulation = StreamingSimulation(self.crit_paths, cached)
+        with self.assertRaises(FetchError):
+            fetch_attack_graphs(simulation, self.risks, self.lang_meta,
+                workers = 2, paths_per_request = 2,
+                defense_index = build_defense_index(self.lang_meta))
+        self.assertTrue(simulation.opened)
+        self.assertTrue(all(stream.closed for stream in simulation.opened))
+
+
+if __name__ == "__main__":
+    unittest.main()
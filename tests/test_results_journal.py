@@ -0,0 +1,92 @@
+import json
+import os
+import tempfile
+import unittest
+
+from results_journal import ResultsJournal, read_journal
+
+DEFENSE = {"ref": "host1", "defenseName": "patched", "assetName": "Host1",
+    "eid": "1", "defenseInfo": "patched is used"}
+OTHER_DEFENSE = {"ref": "host2", "defenseName": "patched",
+    "assetName": "Host2", "eid": "2", "defenseInfo": "patched is used"}
+
+
+class ResultsJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.journalfile = os.path.join(self.directory.name, "results.jsonl")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def record_iterations(self, journal):
+        journal.set_initial_ttcs({"1.compromise": [1, 2, 4]})
+        journal.add_coa(100, DEFENSE)
+        journal.set_coa_ttcs({"1.compromise": [2, 3, 5]}, "https://report/1")
+        journal.set_efficiency("0.5")
+        journal.add_coa(150, OTHER_DEFENSE)
+        journal.extend_coa(200, DEFENSE)
+
+    def test_records_are_applied(self):
+        journal = ResultsJournal(self.journalfile, {"initial_ids": {"pid": 1},
+            "CoAs": [], "initial_TTC": {}})
+        self.record_iterations(journal)
+        journal.close()
+
+        results = journal.results
+        self.assertEqual(results["initial_ids"], {"pid": 1})
+        self.assertEqual(results["initial_TTC"], {"1.compromise": [1, 2, 4]})
+        self.assertEqual(results["CoAs"][0], {"monetary_cost": {"1": 100},
+            "defenses": [DEFENSE], "coaTTC": {"1.compromise": [2, 3, 5]},
+            "report_url": "https://report/1", "efficiency": "0.5"})
+        # the second CoA holds the defenses of the first one as well
+        self.assertEqual(results["CoAs"][1], {"monetary_cost": {"1": 350},
+            "defenses": [DEFENSE, OTHER_DEFENSE, DEFENSE]})
+        self.assertEqual(read_journal(self.journalfile), results)
+
+    def test_torn_last_record_is_ignored(self):
+        journal = ResultsJournal(self.journalfile)
+        journal.set_initial_ttcs({"1.compromise": [1, 2, 4]})
+        journal.add_coa(100, DEFENSE)
+        expected = json.loads(json.dumps(journal.results))
+        journal.close()
+        with open(self.journalfile, 'ab') as f:
+            f.write(b'{"event":"efficiency","coa":0,"effi')
+
+        self.assertEqual(read_journal(self.journalfile), expected)
+
+    def test_resume_truncates_the_journal_to_the_offset(self):
+        journal = ResultsJournal(self.journalfile)
+        journal.set_initial_ttcs({"1.compromise": [1, 2, 4]})
+        journal.add_coa(100, DEFENSE)
+        offset = journal.tell()
+        expected = json.loads(json.dumps(journal.results))
+        # recorded after the checkpoint, lost when the run is killed
+        journal.set_coa_ttcs({"1.compromise": [2, 3, 5]}, "https://report/1")
+        journal.set_efficiency("0.5")
+        journal.close()
+
+        journal = ResultsJournal(self.journalfile, offset = offset)
+        self.assertEqual(journal.results, expected)
+        self.assertEqual(os.path.getsize(self.journalfile), offset)
+        journal.set_efficiency("0.7")
+        journal.close()
+
+        results = read_journal(self.journalfile)
+        self.assertEqual(results["CoAs"], [{"monetary_cost": {"1": 100},
+            "defenses": [DEFENSE], "efficiency": "0.7"}])
+        self.assertEqual(read_journal(self.journalfile, offset), expected)
+
+    def test_write_produces_the_results_file(self):
+        journal = ResultsJournal(self.journalfile)
+        self.record_iterations(journal)
+        resultsfile = os.path.join(self.directory.name, "results.json")
+        journal.write(resultsfile)
+        journal.close()
+        with open(resultsfile) as f:
+            self.assertEqual(json.load(f), journal.results)
+
+
+if __name__ == "__main__":
+    unittest.main()
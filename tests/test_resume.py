@@ -0,0 +1,225 @@
+import configparser
+import io
+import json
+import logging
+import os
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+import analyser
+from surrogate import read_observations
+
+ASSETS = 5
+INFINITY = str(analyser.TEMP_INF)
+
+
+class Crash(BaseException):
+    '''
+    Stands in for the process being killed, it is not caught on the way
+    out of run_coa.
+    '''
+    pass
+
+
+class FakeModel:
+    def __init__(self):
+        self.model = {"name": "model"}
+
+
+class FakeSimulation:
+    '''
+    Every asset HostN has an access and a compromise attack step, the
+    compromise is the risk and the access can be patched. Patched assets
+    cannot be reached any more, so every iteration protects one asset.
+    '''
+
+    def __init__(self, client, name, samples, raw_tunings):
+        self.client = client
+        self.name = name
+        self.patched = sorted(tuning["filter"]["object_name"]
+            for tuning in raw_tunings)
+        self.simid = f"sim{samples}-" + "-".join(self.patched)
+        self.progress = 100
+
+    def get_results(self):
+        risks = []
+        for i in range(1, ASSETS + 1):
+            if f"Host{i}" in self.patched:
+                ttcs = [INFINITY] * 3
+            else:
+                ttcs = [str(i), str(2 * i), str(4 * i)]
+            risks.append({"attackstep_id": f"{i}.compromise",
+                "object_id": str(i), "attackstep": "compromise",
+                "ttc5": ttcs[0], "ttc50": ttcs[1], "ttc95": ttcs[2]})
+        return {"simid": self.simid,
+            "report_url": "https://fake/" + self.simid,
+            "results": {"risks": risks}}
+
+    def get_critical_paths(self, attackstep_ids):
+        if len(self.patched) == self.client.crash_after:
+            raise Crash()
+        crit_paths = {}
+        for attackstep_id in attackstep_ids:
+            i = int(attackstep_id.split(".")[0])
+            nodes = []
+            for k, (step, is_defense) in enumerate([("patched", True),
+                ("access", False), ("compromise", False)]):
+                nodes.append({"index": 3 * i + k, "id": f"{i}.{step}",
+                    "eid": str(i), "name": f"({i}) Host{i}",
+                    "class": "Host", "attackstep": step,
+                    "frequency": 10 * i + k,
+                    "isDefense": is_defense, "ttc": 0 if is_defense else i})
+            crit_paths[attackstep_id] = {"nodes": nodes,
+                "links": [{"source": 3 * i, "target": 3 * i + 1},
+                    {"source": 3 * i + 1, "target": 3 * i + 2}]}
+        return crit_paths
+
+
+class FakeSimulations:
+    def __init__(self, client):
+        self.client = client
+        self.simulations = {}
+        self.created = 0
+
+    def create_simulation(self, scenario, name, model, raw_tunings):
+        self.created += 1
+        simulation = FakeSimulation(self.client, name,
+            model.model.get("samples"), raw_tunings)
+        self.simulations[simulation.simid] = simulation
+        return simulation
+
+    def get_simulation_by_simid(self, scenario, simid):
+        return self.simulations[simid]
+
+
+class FakeModelInfo:
+    def get_model(self):
+        return FakeModel()
+
+    def get_scad(self):
+        objects = "".join(f'<objects name="Host{i}" metaConcept="Host" ' +
+            f'exportedId="{i}" attributesJsonString=' +
+            f'\'{{"ref": "host{i}"}}\'/>' for i in range(1, ASSETS + 1))
+        scad = io.BytesIO()
+        with zipfile.ZipFile(scad, 'w') as zip_ref:
+            zip_ref.writestr("model.eom", f"<model>{objects}</model>")
+        return scad.getvalue()
+
+
+class FakeClient:
+    '''
+    Enterprise client serving the fake model, which keeps its simulations
+    across runs like the server does.
+    '''
+
+    def __init__(self):
+        self.crash_after = None
+        self.simulations = FakeSimulations(self)
+        self.projects = mock.Mock()
+        self.projects.get_project_by_name.return_value = \
+            mock.Mock(pid = "pid")
+        self.scenarios = mock.Mock()
+        self.scenarios.get_scenario_by_name.return_value = \
+            mock.Mock(tid = "tid")
+        self.models = mock.Mock()
+        self.models.get_model_by_name.return_value = FakeModelInfo()
+
+    def _get(self, path):
+        return {"assets": {"Host": {"defenses": [{"name": "patched",
+            "tags": [], "metaInfo": {"cost": ["100", "150", "200"]}}]}}}
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = configparser.ConfigParser()
+        self.config["project"] = {"name": "project", "scenario": "scenario",
+            "model": "model"}
+
+    def tearDown(self):
+        for handler in logging.getLogger().handlers:
+            handler.close()
+        self.directory.cleanup()
+
+    def run_coa(self, client, run_dir, arguments = []):
+        '''
+        Run the analyser in run_dir, {run_dir} in the arguments is replaced
+        by it.
+        '''
+        os.makedirs(run_dir, exist_ok = True)
+        argv = ["-l", os.path.join(run_dir, "log.txt"),
+            "--metricsfile", os.path.join(run_dir, "metrics.json"),
+            "-r", os.path.join(run_dir, "results.json"),
+            "-j", os.path.join(run_dir, "results.jsonl"),
+            "-s", os.path.join(run_dir, "checkpoint.json"),
+            "--log_level", "INFO", "--poll_interval", "0"] + \
+            [argument.format(run_dir = run_dir) for argument in arguments]
+        with mock.patch("analyser.create_client", return_value = client):
+            return analyser.run_coa(analyser.parse_arguments(argv),
+                self.config)
+
+    def read_results(self, run_dir):
+        with open(os.path.join(run_dir, "results.json")) as f:
+            return f.read()
+
+    def check_resume(self, arguments = []):
+        '''
+        Kill a run in its fourth iteration, resume it and check that it
+        ends up with the results of a run that was not interrupted. Returns
+        the clients of both runs.
+        '''
+        complete = FakeClient()
+        complete_dir = os.path.join(self.directory.name, "complete")
+        self.assertEqual(self.run_coa(complete, complete_dir, arguments),
+            analyser.SUCCESS)
+        results = json.loads(self.read_results(complete_dir))
+        self.assertEqual(len(results["CoAs"]), ASSETS)
+
+        client = FakeClient()
+        client.crash_after = 3
+        resumed_dir = os.path.join(self.directory.name, "resumed")
+        with self.assertRaises(Crash):
+            self.run_coa(client, resumed_dir, arguments)
+        interrupted = json.loads(self.read_results(resumed_dir))
+        self.assertEqual(len(interrupted["CoAs"]), 3)
+
+        client.crash_after = None
+        self.assertEqual(self.run_coa(client, resumed_dir,
+            arguments + ["--resume"]), analyser.SUCCESS)
+        self.assertEqual(self.read_results(resumed_dir),
+            self.read_results(complete_dir))
+        # the simulation the run was killed on is attached to, not run again
+        self.assertEqual(client.simulations.created,
+            complete.simulations.created)
+        return complete, client
+
+    def test_resume_matches_uninterrupted_run(self):
+        complete, client = self.check_resume()
+        self.assertEqual(client.simulations.created, ASSETS + 1)
+
+    def test_resume_with_adaptive_samples(self):
+        # the resumed run starts with the samples the killed one reached
+        # instead of --min_samples
+        complete, client = self.check_resume(["--adaptive_samples",
+            "--min_samples", "25", "--max_samples", "800",
+            "--noise_threshold", "0.05"])
+        self.assertGreater(complete.simulations.created, ASSETS + 1)
+
+    def test_resume_with_surrogate(self):
+        # the efficiency of the defense applied before the run was killed
+        # is observed after resuming it
+        self.check_resume(["--surrogate_candidates", "5",
+            "--observationsfile", "{run_dir}/observations.jsonl"])
+        observations = []
+        for run in ["complete", "resumed"]:
+            observations.append(read_observations(os.path.join(
+                self.directory.name, run, "observations.jsonl")))
+        self.assertEqual(len(observations[0]), ASSETS)
+        self.assertEqual(observations[1], observations[0])
+
+
+if __name__ == "__main__":
+    unittest.main()